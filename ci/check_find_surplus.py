@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Check find_surplus() against the original glob-based version.
+# All rights waived: https://creativecommons.org/publicdomain/zero/1.0/
+
+"""Randomized comparison of styrene.bundle.find_surplus().
+
+The single-pass find_surplus() is compared against the earlier
+glob-based version, kept below as the reference. Random trees are
+built in a temporary folder, and random delete and keep patterns are
+run against them with both functions.
+
+The reference returns every surplus path, including paths inside
+surplus folders, while find_surplus() returns only the top-most ones.
+The reference's results are reduced to the top-most paths before
+comparing.
+
+Usage: python3 ci/check_find_surplus.py
+
+"""
+
+import os
+import sys
+import glob
+import random
+import shutil
+import logging
+import tempfile
+import unittest
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+from styrene.bundle import find_surplus  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+SEEDS = range(4)
+TREES_PER_SEED = 400
+
+NAMES = [
+    "a", "b", "c", ".h", "lib", "bin", "x.dll", "y.exe", "share",
+    "icons", "README",
+]
+
+PATTERNS = [
+    "*", "**", "a", "a/**", "a/*", "*/b", "**/b", "**/*.dll", "lib/**",
+    "share/icons", "*.exe", "b/", "**/", "missing/**", "c/**/x.dll",
+    ".h", "**/.h", "*/*/*", "bin/*.dll", "a/b/c", "share/**/README",
+    "**/lib/**", "[ab]", "?", "a/missing/**", "*/",
+]
+
+
+# Reference:
+
+def reference_find_surplus(root, del_patterns, keep_patterns):
+    """Find "surplus" files and folders within a root."""
+
+    if not os.path.isdir(root):
+        raise ValueError("Root path %r is not a directory" % (root,))
+
+    root = os.path.abspath(root)
+    root = os.path.normpath(root)
+    root = os.path.normcase(root)
+
+    glob_opts = dict(recursive=True)
+    try:
+        glob.iglob("/nonexistent/**.foo", **glob_opts)
+    except Exception:
+        logger.error(
+            "Glob options %r are not supported on this Python version.",
+            glob_opts,
+        )
+        return []
+
+    # Keep every matched path, its contents if it's a folder,
+    # and every folder path between the root and the match.
+    keep_paths = set([root])
+    for pattern in keep_patterns:
+        pattern = os.path.join(glob.escape(root), pattern)
+        for path in glob.iglob(pattern, **glob_opts):
+            # Item itself
+            path = os.path.normpath(path)
+            keep_paths.add(path)
+            # Recursive contents
+            if os.path.isdir(path):
+                c_pattern = os.path.join(glob.escape(path), "**")
+                for c_path in glob.iglob(c_pattern, **glob_opts):
+                    c_path = os.path.normpath(c_path)
+                    keep_paths.add(c_path)
+            # Paths between root and match
+            p, t = path, None
+            root_pfx = root
+            if not root_pfx.endswith(os.path.sep):
+                root_pfx += os.path.sep
+            while p is not None and p.startswith(root_pfx):
+                p = os.path.normpath(p)
+                keep_paths.add(p)
+                p, t = os.path.split(p)
+
+    # Everything matched by the delete patterns minus those matched by
+    # the keep patterns is surplus.
+    surplus_paths = set()
+    for pattern in del_patterns:
+        pattern = os.path.join(glob.escape(root), pattern)
+        for path in glob.glob(pattern, **glob_opts):
+            path = os.path.normpath(path)
+            if path not in keep_paths:
+                surplus_paths.add(path)
+            if os.path.isdir(path):
+                c_pattern = os.path.join(glob.escape(path), "**")
+                for c_path in glob.glob(c_pattern, **glob_opts):
+                    c_path = os.path.normpath(c_path)
+                    if c_path not in keep_paths:
+                        surplus_paths.add(c_path)
+
+    return surplus_paths
+
+
+# Helper funcs:
+
+def make_tree(root, rnd, depth=0):
+    """Fill a folder with a random tree of empty files and folders."""
+    for name in rnd.sample(NAMES, rnd.randint(0, 5)):
+        path = os.path.join(root, name)
+        if depth < 3 and rnd.random() < 0.5:
+            os.mkdir(path)
+            make_tree(path, rnd, depth + 1)
+        else:
+            open(path, "w").close()
+
+
+def topmost(paths):
+    """Reduce a set of paths to those not inside another one."""
+    result = set()
+    for path in sorted(p for p in paths if os.path.lexists(p)):
+        if any(path.startswith(p + os.path.sep) for p in result):
+            continue
+        result.add(path)
+    return result
+
+
+# Tests:
+
+class FindSurplusTest (unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="styrene-check")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_random_trees(self):
+        for seed in SEEDS:
+            rnd = random.Random(seed)
+            for i in range(TREES_PER_SEED):
+                root = os.path.join(self.tmp, "root")
+                os.mkdir(root)
+                make_tree(root, rnd)
+                del_patterns = rnd.sample(PATTERNS, rnd.randint(0, 4))
+                keep_patterns = rnd.sample(PATTERNS, rnd.randint(0, 4))
+                expected = topmost(reference_find_surplus(
+                    root, del_patterns, keep_patterns,
+                ))
+                got = find_surplus(root, del_patterns, keep_patterns)
+                with self.subTest(seed=seed, tree=i, delete=del_patterns,
+                                  keep=keep_patterns):
+                    self.assertEqual(got, expected)
+                shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    unittest.main()
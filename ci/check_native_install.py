@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# Check the native package installer against a locally built package.
+# All rights waived: https://creativecommons.org/publicdomain/zero/1.0/
+
+"""Fixture-based check of styrene.pkgstore.install_package().
+
+A small .pkg.tar.zst is built from scratch, installed into an empty
+tree, and the unpacked files and the local database entry (desc,
+files, mtree, install) are compared with what pacman would write.
+Symlinks are checked to be copied where they can't be made.
+Pacman's MSYS2-style cache dirs and file URLs are checked to resolve
+to native paths under the MSYS2 root, both for installing and for the
+build plan's cached packages.
+This needs only Python and the zstd command line tool, so it runs on
+Linux as well as in MSYS2.
+
+Usage: python3 ci/check_native_install.py
+
+"""
+
+import os
+import io
+import sys
+import gzip
+import shutil
+import tarfile
+import tempfile
+import unittest
+import subprocess
+import unittest.mock
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+from styrene.pkgstore import install_package  # noqa: E402
+from styrene.pkgstore import pacman_cache_dirs  # noqa: E402
+from styrene.pkgstore import ALPM_DB_VERSION  # noqa: E402
+from styrene.pkgstore import PackageStore  # noqa: E402
+from styrene.pacman import LOCAL_DB_SUBDIR  # noqa: E402
+from styrene.bundle import NativeBundle  # noqa: E402
+from styrene.plan import BuildPlan  # noqa: E402
+from styrene.utils import msys2_native_path  # noqa: E402
+
+
+# Fixture:
+
+PKGINFO_TEMPLATE = """\
+# Generated by makepkg
+pkgname = fixture
+pkgbase = fixture
+pkgver = {version}
+pkgdesc = Fixture package for Styrene
+url = https://example.com/fixture
+builddate = 1500000000
+packager = Nobody <nobody@example.com>
+size = 123
+arch = any
+license = GPL3
+group = fixtures
+depend = bash
+depend = zlib>=1.2
+optdepend = python: for the script
+provides = fixture-lib=1
+"""
+
+MTREE = b"#mtree\n./usr/bin/fixture time=1500000000.0 size=5\n"
+
+INSTALL = b"post_install() {\n    echo installed\n}\n"
+
+FILES = [
+    ("usr/bin/fixture", b"#!/bin/sh\necho fixture\n", 0o755),
+    ("usr/share/fixture/data.txt", b"data\n", 0o644),
+]
+
+SYMLINKS = [
+    ("usr/share/fixture/link.txt", "data.txt"),
+]
+
+
+def build_package(path, version):
+    """Build a fixture .pkg.tar.zst like makepkg's."""
+    bio = io.BytesIO()
+    with tarfile.open(fileobj=bio, mode="w", format=tarfile.GNU_FORMAT) as t:
+        def add_file(name, data, mode=0o644):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            t.addfile(info, io.BytesIO(data))
+
+        def add_dir(name):
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            t.addfile(info)
+
+        pkginfo = PKGINFO_TEMPLATE.format(version=version)
+        add_file(".PKGINFO", pkginfo.encode("utf-8"))
+        add_file(".MTREE", gzip.compress(MTREE))
+        add_file(".INSTALL", INSTALL)
+        for d in ["usr", "usr/bin", "usr/share", "usr/share/fixture"]:
+            add_dir(d)
+        for name, data, mode in FILES:
+            add_file(name, data, mode)
+        for name, target in SYMLINKS:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            t.addfile(info)
+    with open(path, "wb") as fp:
+        subprocess.run(
+            ["zstd", "--quiet", "--stdout", "-"],
+            input=bio.getvalue(),
+            stdout=fp,
+            check=True,
+        )
+
+
+def build_sync_db(path, entries):
+    """Build a gzipped sync database of (name, version, csize, deps)."""
+    bio = io.BytesIO()
+    with tarfile.open(fileobj=bio, mode="w") as t:
+        for name, version, csize, deps in entries:
+            desc = "%FILENAME%\n{n}-{v}-any.pkg.tar\n\n".format(
+                n=name, v=version,
+            )
+            desc += "%NAME%\n{}\n\n%VERSION%\n{}\n\n".format(
+                name, version,
+            )
+            desc += "%CSIZE%\n{}\n\n%ARCH%\nany\n\n".format(csize)
+            if deps:
+                desc += "%DEPENDS%\n{}\n\n".format("\n".join(deps))
+            data = desc.encode("utf-8")
+            info = tarfile.TarInfo("%s-%s/desc" % (name, version))
+            info.size = len(data)
+            t.addfile(info, io.BytesIO(data))
+    with open(path, "wb") as fp:
+        fp.write(gzip.compress(bio.getvalue()))
+
+
+def parse_db_file(path):
+    """Parse a local db desc or files file into {section: [values]}."""
+    sections = {}
+    order = []
+    section = None
+    with open(path, encoding="utf-8") as fp:
+        for line in fp.read().splitlines():
+            if line.startswith("%") and line.endswith("%"):
+                section = line.strip("%")
+                sections[section] = []
+                order.append(section)
+            elif line:
+                sections[section].append(line)
+    return sections, order
+
+
+def symlinks_permitted():
+    """Whether os.symlink() works here.
+
+    On Windows, making symlinks needs a privilege or Developer Mode.
+
+    """
+    with tempfile.TemporaryDirectory(prefix="styrene-check") as tmp:
+        try:
+            os.symlink("target", os.path.join(tmp, "link"))
+        except (OSError, NotImplementedError):
+            return False
+    return True
+
+
+# Tests:
+
+class InstallPackageTest (unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="styrene-check")
+        self.root = os.path.join(self.tmp, "root")
+        os.makedirs(self.root)
+        self.local_dir = os.path.join(self.root, *LOCAL_DB_SUBDIR.split("/"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _install(self, version, explicit):
+        pkg = os.path.join(self.tmp, "fixture-%s-any.pkg.tar.zst" % version)
+        build_package(pkg, version)
+        return install_package(pkg, self.root, explicit=explicit)
+
+    def _entry(self, version):
+        return os.path.join(self.local_dir, "fixture-%s" % (version,))
+
+    def test_payload(self):
+        self._install("1.0-1", explicit=True)
+        for name, data, mode in FILES:
+            path = os.path.join(self.root, *name.split("/"))
+            with open(path, "rb") as fp:
+                self.assertEqual(fp.read(), data)
+            if os.name == "posix":
+                self.assertEqual(os.stat(path).st_mode & 0o777, mode)
+        for name, target in SYMLINKS:
+            path = os.path.join(self.root, *name.split("/"))
+            if symlinks_permitted():
+                self.assertEqual(os.readlink(path), target)
+            else:
+                # Copied instead: see test_symlink_fallback().
+                self.assertFalse(os.path.islink(path))
+        for meta in [".PKGINFO", ".MTREE", ".INSTALL"]:
+            self.assertFalse(os.path.lexists(os.path.join(self.root, meta)))
+
+    def test_symlink_fallback(self):
+        with unittest.mock.patch("os.symlink", side_effect=OSError):
+            self._install("1.0-1", explicit=True)
+        for name, target in SYMLINKS:
+            path = os.path.join(self.root, *name.split("/"))
+            self.assertFalse(os.path.islink(path))
+            with open(path, "rb") as fp:
+                self.assertEqual(fp.read(), b"data\n")
+
+    def test_store_install(self):
+        pkg = os.path.join(self.tmp, "fixture-1.0-1-any.pkg.tar.zst")
+        build_package(pkg, "1.0-1")
+        store = PackageStore(os.path.join(self.tmp, "store"))
+        with unittest.mock.patch("os.symlink", side_effect=OSError):
+            store.install(pkg, self.root, explicit=True)
+        for name, data, mode in FILES:
+            path = os.path.join(self.root, *name.split("/"))
+            with open(path, "rb") as fp:
+                self.assertEqual(fp.read(), data)
+        for name, target in SYMLINKS:
+            path = os.path.join(self.root, *name.split("/"))
+            with open(path, "rb") as fp:
+                self.assertEqual(fp.read(), b"data\n")
+        self.assertTrue(os.path.isdir(self._entry("1.0-1")))
+
+    def test_desc(self):
+        pkginfo = self._install("1.0-1", explicit=False)
+        self.assertEqual(pkginfo["pkgname"], ["fixture"])
+        with open(os.path.join(self.local_dir, "ALPM_DB_VERSION")) as fp:
+            self.assertEqual(fp.read().strip(), str(ALPM_DB_VERSION))
+        desc, order = parse_db_file(os.path.join(self._entry("1.0-1"),
+                                                 "desc"))
+        self.assertEqual(order, [
+            "NAME", "VERSION", "BASE", "DESC", "GROUPS", "URL", "ARCH",
+            "BUILDDATE", "INSTALLDATE", "PACKAGER", "SIZE", "REASON",
+            "LICENSE", "VALIDATION", "DEPENDS", "OPTDEPENDS", "PROVIDES",
+        ])
+        self.assertEqual(desc["NAME"], ["fixture"])
+        self.assertEqual(desc["VERSION"], ["1.0-1"])
+        self.assertEqual(desc["GROUPS"], ["fixtures"])
+        self.assertEqual(desc["SIZE"], ["123"])
+        self.assertEqual(desc["REASON"], ["1"])
+        self.assertEqual(desc["VALIDATION"], ["none"])
+        self.assertEqual(desc["DEPENDS"], ["bash", "zlib>=1.2"])
+        self.assertEqual(desc["OPTDEPENDS"], ["python: for the script"])
+        self.assertEqual(desc["PROVIDES"], ["fixture-lib=1"])
+        self.assertTrue(desc["INSTALLDATE"][0].isdigit())
+
+    def test_files_mtree_install(self):
+        self._install("1.0-1", explicit=True)
+        entry = self._entry("1.0-1")
+        files, order = parse_db_file(os.path.join(entry, "files"))
+        self.assertEqual(order, ["FILES"])
+        self.assertEqual(files["FILES"], [
+            "usr/",
+            "usr/bin/",
+            "usr/bin/fixture",
+            "usr/share/",
+            "usr/share/fixture/",
+            "usr/share/fixture/data.txt",
+            "usr/share/fixture/link.txt",
+        ])
+        with open(os.path.join(entry, "mtree"), "rb") as fp:
+            self.assertEqual(gzip.decompress(fp.read()), MTREE)
+        with open(os.path.join(entry, "install"), "rb") as fp:
+            self.assertEqual(fp.read(), INSTALL)
+
+    def test_upgrade_replaces_entry(self):
+        self._install("1.0-1", explicit=False)
+        self._install("1.1-1", explicit=True)
+        self.assertNotIn("fixture-1.0-1", os.listdir(self.local_dir))
+        desc, order = parse_db_file(os.path.join(self._entry("1.1-1"),
+                                                 "desc"))
+        self.assertEqual(desc["VERSION"], ["1.1-1"])
+        self.assertNotIn("REASON", desc)
+
+
+class PacmanPathsTest (unittest.TestCase):
+    """Pacman's paths are MSYS2 paths, relative to the MSYS2 root."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="styrene-check")
+        self.msys2_root = os.path.join(self.tmp, "msys64")
+        self.cache_dir = os.path.join(
+            self.msys2_root, "var", "cache", "pacman", "pkg",
+        )
+        os.makedirs(self.cache_dir)
+        self.pkg = os.path.join(self.cache_dir, "fixture-1.0-1-any.pkg.tar")
+        with open(self.pkg, "wb"):
+            pass
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _patch_root(self):
+        return unittest.mock.patch(
+            "styrene.utils.find_msys2_root",
+            return_value=self.msys2_root,
+        )
+
+    def test_native_path(self):
+        with self._patch_root():
+            self.assertEqual(
+                msys2_native_path("/var/cache/pacman/pkg/"),
+                os.path.join(self.cache_dir, ""),
+            )
+            self.assertEqual(
+                msys2_native_path(
+                    "file:///var/cache/pacman/pkg/"
+                    "fixture-1.0-1-any.pkg.tar"
+                ),
+                self.pkg,
+            )
+            self.assertEqual(msys2_native_path("relative/x"), "relative/x")
+        if os.name == "nt":
+            self.assertEqual(
+                msys2_native_path("/c/Users/x.pkg.tar"),
+                "C:\\Users\\x.pkg.tar",
+            )
+
+    def test_find_downloaded_package(self):
+        cache_dirs = [os.path.join(self.tmp, "missing"), self.cache_dir]
+        find = NativeBundle._find_downloaded_package
+        with self._patch_root():
+            for location in [
+                "file:///var/cache/pacman/pkg/fixture-1.0-1-any.pkg.tar",
+                "/var/cache/pacman/pkg/fixture-1.0-1-any.pkg.tar",
+                "https://example.com/msys/fixture-1.0-1-any.pkg.tar",
+            ]:
+                self.assertEqual(find(location, cache_dirs), self.pkg)
+            with self.assertRaises(RuntimeError):
+                find("https://example.com/msys/other.pkg.tar", cache_dirs)
+
+    def _fake_pacman(self):
+        """Put a fake MSYS2 pacman and pacman-conf on $PATH."""
+        bin_dir = os.path.join(self.msys2_root, "usr", "bin")
+        os.makedirs(bin_dir)
+        scripts = {
+            "pacman": "exit 0",
+            "pacman-conf": "echo /var/cache/pacman/pkg/",
+        }
+        for name, script in scripts.items():
+            path = os.path.join(bin_dir, name)
+            with open(path, "w") as fp:
+                fp.write("#!/bin/sh\n%s\n" % (script,))
+            os.chmod(path, 0o755)
+        path_var = bin_dir + os.pathsep + os.environ.get("PATH", "")
+        return unittest.mock.patch.dict(os.environ, {"PATH": path_var})
+
+    @unittest.skipUnless(os.name == "posix", "needs a fake pacman-conf")
+    def test_pacman_cache_dirs(self):
+        with self._fake_pacman():
+            self.assertEqual(
+                pacman_cache_dirs(),
+                [os.path.join(self.cache_dir, "")],
+            )
+
+    @unittest.skipUnless(os.name == "posix", "needs a fake pacman-conf")
+    def test_plan_cached(self):
+        db = os.path.join(self.tmp, "fixtures.db")
+        build_sync_db(db, [
+            ("fixture", "1.0-1", 1000, []),
+            ("other", "2.0-1", 300, []),
+        ])
+        with self._fake_pacman():
+            plan = BuildPlan(
+                ["fixture", "other"],
+                [("fixtures", db)],
+                cache_dirs=pacman_cache_dirs(),
+            )
+        cached = {m["name"]: m["cached"] for m in plan.packages}
+        self.assertEqual(cached, {"fixture": True, "other": False})
+        self.assertEqual(plan.download_size, 300)
+
+
+if __name__ == "__main__":
+    if shutil.which("zstd") is None:
+        sys.exit("check_native_install: the zstd tool is needed")
+    unittest.main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# Check the PE import reader against images built from scratch.
+# All rights waived: https://creativecommons.org/publicdomain/zero/1.0/
+
+"""Fixture-based check of styrene.pe.read_imports() and dll_closure().
+
+Small PE32 and PE32+ images are built in memory, with one section
+holding an import directory, a delay-load import directory, and the
+DLL names. Delay-load descriptors are written both the old VA-based
+way and the RVA-based way. Truncated and non-PE files must raise
+PEError, and dll_closure() must follow imports through a chain of
+several DLLs.
+
+Usage: python3 ci/check_pe_imports.py
+
+"""
+
+import os
+import sys
+import shutil
+import struct
+import logging
+import tempfile
+import unittest
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+from styrene.pe import read_imports  # noqa: E402
+from styrene.pe import dll_closure  # noqa: E402
+from styrene.pe import PEError  # noqa: E402
+
+
+# Fixture:
+
+PE_OFFSET = 0x40
+FILE_ALIGNMENT = 0x200
+SECTION_RVA = 0x1000
+NUM_DATA_DIRS = 16
+
+#: pe32_plus → (magic, machine, ImageBase, its format and offset,
+#: NumberOfRvaAndSizes offset).
+LAYOUTS = {
+    False: (0x10b, 0x14c, 0x400000, "<I", 28, 92),
+    True: (0x20b, 0x8664, 0x140000000, "<Q", 24, 108),
+}
+
+#: (pe32_plus, rva_based) combinations found in real images.
+VARIANTS = [(False, False), (False, True), (True, True)]
+
+IMPORT_DESCRIPTOR = struct.Struct("<IIIII")
+DELAY_IMPORT_DESCRIPTOR = struct.Struct("<IIIIIIII")
+DELAY_ATTR_RVA_BASED = 0x1
+
+
+def build_pe(imports=(), delay_imports=(), pe32_plus=False,
+             rva_based=True):
+    """Build a minimal PE image, as bytes.
+
+    :param list imports: DLL names for the import directory.
+    :param list delay_imports: DLL names for the delay-load directory.
+    :param bool pe32_plus: Build a 64-bit PE32+ image.
+    :param bool rva_based: Write RVAs in the delay-load descriptors,
+        rather than VAs.
+
+    """
+    (magic, machine, image_base, base_fmt, base_offset,
+     num_dirs_offset) = LAYOUTS[pe32_plus]
+    dirs_offset = num_dirs_offset + 4
+    opt_header_size = dirs_offset + NUM_DATA_DIRS * 8
+
+    # Section contents: descriptors first, then the names.
+    imports_size = IMPORT_DESCRIPTOR.size * (len(imports) + 1)
+    delay_size = DELAY_IMPORT_DESCRIPTOR.size * (len(delay_imports) + 1)
+    names = b""
+    name_rvas = []
+    names_rva = SECTION_RVA + imports_size + delay_size
+    for name in list(imports) + list(delay_imports):
+        name_rvas.append(names_rva + len(names))
+        names += name.encode("ascii") + b"\0"
+    section = b""
+    for name_rva in name_rvas[:len(imports)]:
+        section += IMPORT_DESCRIPTOR.pack(0, 0, 0, name_rva, 0)
+    section += IMPORT_DESCRIPTOR.pack(0, 0, 0, 0, 0)
+    for name_rva in name_rvas[len(imports):]:
+        if rva_based:
+            attributes, name_addr = DELAY_ATTR_RVA_BASED, name_rva
+        else:
+            attributes, name_addr = 0, image_base + name_rva
+        section += DELAY_IMPORT_DESCRIPTOR.pack(
+            attributes, name_addr, 0, 0, 0, 0, 0, 0,
+        )
+    section += DELAY_IMPORT_DESCRIPTOR.pack(0, 0, 0, 0, 0, 0, 0, 0)
+    section += names
+    raw_size = -(-len(section) // FILE_ALIGNMENT) * FILE_ALIGNMENT
+    section = section.ljust(raw_size, b"\0")
+
+    data_dirs = [(0, 0)] * NUM_DATA_DIRS
+    if imports:
+        data_dirs[1] = (SECTION_RVA, imports_size)
+    if delay_imports:
+        data_dirs[13] = (SECTION_RVA + imports_size, delay_size)
+    opt_header = bytearray(opt_header_size)
+    struct.pack_into("<H", opt_header, 0, magic)
+    struct.pack_into(base_fmt, opt_header, base_offset, image_base)
+    struct.pack_into("<I", opt_header, num_dirs_offset, NUM_DATA_DIRS)
+    for i, (rva, size) in enumerate(data_dirs):
+        struct.pack_into("<II", opt_header, dirs_offset + i * 8, rva, size)
+
+    dos_header = bytearray(PE_OFFSET)
+    dos_header[0:2] = b"MZ"
+    struct.pack_into("<I", dos_header, 0x3c, PE_OFFSET)
+    coff_header = struct.pack(
+        "<HHIIIHH", machine, 1, 0, 0, 0, opt_header_size, 0x2102,
+    )
+    section_header = struct.pack(
+        "<8sIIIIIIHHI", b".idata", len(section), SECTION_RVA,
+        raw_size, FILE_ALIGNMENT, 0, 0, 0, 0, 0xc0000040,
+    )
+    headers = (bytes(dos_header) + b"PE\0\0" + coff_header
+               + bytes(opt_header) + section_header)
+    assert len(headers) <= FILE_ALIGNMENT
+    return headers.ljust(FILE_ALIGNMENT, b"\0") + section
+
+
+# Tests:
+
+class ReadImportsTest (unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="styrene-check")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        return path
+
+    def test_imports(self):
+        # VA-based delay-load descriptors only fit 32-bit addresses.
+        for pe32_plus, rva_based in VARIANTS:
+            data = build_pe(
+                imports=["KERNEL32.dll", "libfoo-1.dll"],
+                delay_imports=["libbar-2.dll", "LIBFOO-1.DLL"],
+                pe32_plus=pe32_plus,
+                rva_based=rva_based,
+            )
+            path = self._write("test.exe", data)
+            with self.subTest(pe32_plus=pe32_plus, rva_based=rva_based):
+                self.assertEqual(
+                    read_imports(path),
+                    ["KERNEL32.dll", "libfoo-1.dll", "libbar-2.dll"],
+                )
+
+    def test_delay_imports_only(self):
+        for pe32_plus, rva_based in VARIANTS:
+            data = build_pe(
+                delay_imports=["libbar-2.dll"],
+                pe32_plus=pe32_plus,
+                rva_based=rva_based,
+            )
+            path = self._write("test.dll", data)
+            with self.subTest(pe32_plus=pe32_plus, rva_based=rva_based):
+                self.assertEqual(read_imports(path), ["libbar-2.dll"])
+
+    def test_no_imports(self):
+        path = self._write("test.dll", build_pe(pe32_plus=True))
+        self.assertEqual(read_imports(path), [])
+
+    def test_truncated(self):
+        data = build_pe(imports=["KERNEL32.dll"], pe32_plus=True)
+        for size in [0, 2, PE_OFFSET + 2, PE_OFFSET + 30, 0x150,
+                     FILE_ALIGNMENT + 8]:
+            path = self._write("truncated.exe", data[:size])
+            with self.subTest(size=size):
+                with self.assertRaises(PEError):
+                    read_imports(path)
+
+    def test_not_pe(self):
+        cases = {
+            "text": b"#!/bin/sh\necho not a PE image\n" * 4,
+            "dos-only": b"MZ".ljust(0x100, b"\0"),
+            "bad-magic": build_pe().replace(b"\x0b\x01", b"\x07\x01", 1),
+        }
+        for name, data in cases.items():
+            path = self._write(name, data)
+            with self.subTest(name=name):
+                with self.assertRaises(PEError):
+                    read_imports(path)
+
+
+class DLLClosureTest (unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="styrene-check")
+        self.bin_dir = os.path.join(self.tmp, "bin")
+        self.lib_dir = os.path.join(self.tmp, "lib")
+        os.makedirs(self.bin_dir)
+        os.makedirs(self.lib_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, folder, name, data):
+        path = os.path.join(folder, name)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        return path
+
+    def test_chain(self):
+        exe = self._write(self.bin_dir, "app.exe", build_pe(
+            imports=["KERNEL32.dll", "liba.dll"], pe32_plus=True,
+        ))
+        found = {
+            "liba.dll": self._write(self.bin_dir, "liba.dll", build_pe(
+                imports=["LIBB.DLL"], pe32_plus=True,
+            )),
+            "libb.dll": self._write(self.bin_dir, "libb.dll", build_pe(
+                imports=["libc.dll"], delay_imports=["libd.dll"],
+                pe32_plus=True,
+            )),
+            "libc.dll": self._write(self.bin_dir, "libc.dll", build_pe(
+                imports=["libbroken.dll", "liba.dll"], pe32_plus=True,
+            )),
+            "libd.dll": self._write(self.lib_dir, "libd.dll", build_pe(
+                pe32_plus=True,
+            )),
+            "libbroken.dll": self._write(
+                self.bin_dir, "libbroken.dll", b"not a DLL",
+            ),
+        }
+        self._write(self.bin_dir, "unused.dll", build_pe(pe32_plus=True))
+        self._write(self.lib_dir, "libc.dll", build_pe(pe32_plus=True))
+        logging.disable(logging.WARNING)
+        try:
+            needed = dll_closure([exe], [self.bin_dir, self.lib_dir])
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(needed, set(found.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
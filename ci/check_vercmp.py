@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Check the in-process version comparison against pacman's test table.
+# All rights waived: https://creativecommons.org/publicdomain/zero/1.0/
+
+"""Table-based check of styrene.pacman.vercmp().
+
+The table is the one in pacman's test/util/vercmptest.sh. Each pair is
+compared both ways round, as that script does. If pacman's vercmp
+binary is on $PATH, it is checked against the table too, to show the
+table is still current.
+
+Usage: python3 ci/check_vercmp.py
+
+"""
+
+import os
+import sys
+import shutil
+import unittest
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOPDIR)
+
+from styrene.pacman import vercmp  # noqa: E402
+from styrene.pacman import vercmp_external  # noqa: E402
+
+
+# Reference table: (v1, v2, expected result of vercmp(v1, v2)):
+
+VERCMP_TABLE = [
+    # all similar length, no pkgrel
+    ("1.5.0", "1.5.0", 0),
+    ("1.5.1", "1.5.0", 1),
+    # mixed length
+    ("1.5.1", "1.5", 1),
+    # with pkgrel, simple
+    ("1.5.0-1", "1.5.0-1", 0),
+    ("1.5.0-1", "1.5.0-2", -1),
+    ("1.5.0-1", "1.5.1-1", -1),
+    ("1.5.0-2", "1.5.1-1", -1),
+    # with pkgrel, mixed lengths
+    ("1.5-1", "1.5.1-1", -1),
+    ("1.5-2", "1.5.1-1", -1),
+    ("1.5-2", "1.5.1-2", -1),
+    # mixed pkgrel inclusion
+    ("1.5", "1.5-1", 0),
+    ("1.5-1", "1.5", 0),
+    ("1.1-1", "1.1", 0),
+    ("1.0-1", "1.1", -1),
+    ("1.1-1", "1.0", 1),
+    # alphanumeric versions
+    ("1.5b-1", "1.5-1", -1),
+    ("1.5b", "1.5", -1),
+    ("1.5b-1", "1.5", -1),
+    ("1.5b", "1.5.1", -1),
+    # from the manpage
+    ("1.0a", "1.0alpha", -1),
+    ("1.0alpha", "1.0b", -1),
+    ("1.0b", "1.0beta", -1),
+    ("1.0beta", "1.0rc", -1),
+    ("1.0rc", "1.0", -1),
+    # alpha-dotted versions
+    ("1.5.a", "1.5", 1),
+    ("1.5.b", "1.5.a", 1),
+    ("1.5.1", "1.5.b", 1),
+    # alpha dots and dashes
+    ("1.5.b-1", "1.5.b", 0),
+    ("1.5-1", "1.5.b", -1),
+    # same/similar content, differing separators
+    ("2.0", "2_0", 0),
+    ("2.0_a", "2_0.a", 0),
+    ("2.0a", "2.0.a", -1),
+    ("2___a", "2_a", 1),
+    # epoch included version comparisons
+    ("0:1.0", "0:1.0", 0),
+    ("0:1.0", "0:1.1", -1),
+    ("1:1.0", "0:1.0", 1),
+    ("1:1.0", "0:1.1", 1),
+    ("1:1.0", "2:1.1", -1),
+    # epoch + sometimes present pkgrel
+    ("1:1.0", "0:1.0-1", 1),
+    ("1:1.0-1", "0:1.1-1", 1),
+    # epoch included on one version
+    ("0:1.0", "1.0", 0),
+    ("0:1.0", "1.1", -1),
+    ("0:1.1", "1.0", 1),
+    ("1:1.0", "1.0", 1),
+    ("1:1.0", "1.1", 1),
+    ("1:1.1", "1.1", 1),
+]
+
+
+# Tests:
+
+class VercmpTest (unittest.TestCase):
+
+    def _check_table(self, func):
+        for v1, v2, expected in VERCMP_TABLE:
+            for a, b, result in [(v1, v2, expected), (v2, v1, -expected)]:
+                with self.subTest(v1=a, v2=b):
+                    got = func(a, b)
+                    self.assertEqual((got > 0) - (got < 0), result)
+
+    def test_vercmp(self):
+        self._check_table(vercmp)
+
+    @unittest.skipIf(shutil.which("vercmp") is None, "needs pacman's vercmp")
+    def test_vercmp_binary(self):
+        self._check_table(vercmp_external)
+
+
+if __name__ == "__main__":
+    unittest.main()
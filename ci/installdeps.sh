@@ -21,7 +21,8 @@ $PACMAN_SYNC \
     ${PKG_PREFIX}-binutils \
     ${PKG_PREFIX}-python3 \
     ${PKG_PREFIX}-python3-pip \
-    zip
+    zip \
+    zstd
 
 logmsg "ci/installdeps.sh: installing Python packages for this AppVeyor build..."
 pip3 install wheel
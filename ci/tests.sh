@@ -17,6 +17,18 @@ TEST_CFG_FILE="gtk3-examples.cfg"
 logmsg "ci/tests.sh: installing styrene with pip3"
 pip3 install .
 
+logmsg "ci/tests.sh: checking the native package installer"
+python3 ci/check_native_install.py
+
+logmsg "ci/tests.sh: checking version comparisons"
+python3 ci/check_vercmp.py
+
+logmsg "ci/tests.sh: checking find_surplus() against the reference"
+python3 ci/check_find_surplus.py
+
+logmsg "ci/tests.sh: checking the PE import reader"
+python3 ci/check_pe_imports.py
+
 tmpdir=/tmp/styrene.$$
 mkdir -p $tmpdir
 
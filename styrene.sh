@@ -10,13 +10,11 @@ export PYTHONPATH=.
 
 if test "x$MSYSTEM" = "xMSYS"; then
     echo >&2 "+++ MSYS shell detected, building all native architectures."
-    for s in MINGW64 MINGW32; do
-        echo >&2 "+++ Running $PACKAGE in a $s login shell..."
-        cmd="$PYTHON $PACKAGE"' "$@"'
-        MSYSTEM=$s \
-        CHERE_INVOKING=1 \
-            "$BASH" --login -c "$cmd" -- "$@"
-    done
+    echo >&2 "+++ Running $PACKAGE in a MINGW64 login shell..."
+    cmd="$PYTHON $PACKAGE --msystem=all"' "$@"'
+    MSYSTEM=MINGW64 \
+    CHERE_INVOKING=1 \
+        "$BASH" --login -c "$cmd" -- "$@"
 else
     echo >&2 "+++ Running $PACKAGE directly..."
     $PYTHON $PACKAGE "$@"
@@ -20,19 +20,54 @@
 """
 
 from .launchers import DesktopEntry
-from .utils import str2key
+from .launchers import LauncherStub
+from .icons import IconThemeIndex
 from .utils import nsis_escape
 from .utils import winsafe_filename
 from .utils import fix_tree_perms
+from .utils import remove_path
+from .utils import boolify
+from .utils import find_msys2_root
+from .utils import msys2_native_path
+from .utils import BufferedLogger
+from .stages import StageRecord
+from .cache import FileCache
+from .cache import get_cache_dir
+from .cache import SyncDBStore
+from .pkgstore import PackageStore
+from .pkgstore import install_package
+from .pkgstore import pacman_cache_dirs
+from .zipwriter import write_zip_tree
+from .zipwriter import CompressionPolicy
+from .inventory import TreeInventory
+from .matcher import GlobMatcher
+from .deletereport import DeleteReport
+from .pe import dll_closure
+from .pe import PE_FILE_EXTENSIONS
+from .pacman import vercmp
+from .pacman import checked_vercmp
+from .pacman import PackageDirIndex
+from .pacman import LocalPackageDB
+from .pacman import find_installed
+from .plan import BuildPlan
+from .plan import get_repo_list
+from .stages import fingerprint
+from .stages import file_digest
+from .stages import file_stat_info
+from .stages import files_fingerprint
+from .stages import tree_fingerprint
 from . import consts
 
 import os
 import re
 import subprocess
-import sys
 import glob
 import shutil
+import stat
+import tempfile
 import functools
+import concurrent.futures
+import filecmp
 from textwrap import dedent
 
 import logging
@@ -65,6 +100,15 @@ ARCH_OPTS = {
     ],
 }
 
+#: Ways of installing packages into the bundle tree.
+INSTALLERS = ("pacman", "native")
+
+#: Where sync databases live, relative to a pacman root.
+SYNC_DB_SUBDIR = "var/lib/pacman/sync"
+
+#: Packages the post-install scripting needs.
+POSTINST_PACKAGES = ["bash", "coreutils"]
+
 
 # Class defs:
 
@@ -78,28 +122,43 @@ class NativeBundle:
 
     _SECTION_NAME = "bundle"
 
-    def __init__(self, spec):
-        """Initializes a bundle from a specification."""
+    def __init__(self, spec, msystem=None):
+        """Initializes a bundle from a specification.
+
+        :param configparser.ConfigParser spec: The bundle specification.
+        :param consts.MSYSTEM msystem: Target (default: from environment).
+
+        """
         super().__init__()
         self.spec = spec
         #: The target architecture, prefixes etc.
-        self.msystem = consts.MSYSTEM.from_environ()
+        if msystem is None:
+            msystem = consts.MSYSTEM.from_environ()
+        self.msystem = msystem
         #: Collected metadata, only useful after package installation.
         self.metadata = {}
         self.icon = ""
         self.launchers = []
+        #: Where to keep persistent indexes, or None.
+        self.cache_dir = None
+        #: Store of unpacked packages to install from, or None.
+        self.pkg_store = None
+        #: Install packages in-process rather than with pacman.
+        self.use_native_installer = False
 
     def check_runtime_dependencies(self):
+        """Check that the host has the packages Styrene needs.
+
+        The host's package database is only read once per process
+        unless it changes: see .pacman.find_installed().
+
+        """
         deps = RUNTIME_DEPENDENCIES.get(self.msystem)
         assert deps is not None, "Runtime dependencies not defined?"
+        installed = find_installed(deps)
         missing = []
         for pkg in deps:
-            try:
-                subprocess.check_output(
-                    ["pacman", "-Qi", pkg],
-                    stderr=subprocess.STDOUT,
-                )
-            except subprocess.CalledProcessError:
+            if pkg not in installed:
                 missing.append(pkg)
                 logger.warning("Package %s is not installed.", pkg)
         if missing:
@@ -183,28 +242,323 @@ class NativeBundle:
         logger.debug("New launchers: %r", self.launchers)
 
     def write_distributables(self, output_dir, options):
-        """Create all distributable files for the bundle."""
+        """Create all distributable files for the bundle.
+
+        When building into a retained output dir, the fingerprints of
+        each build stage are recorded alongside the bundle tree, and
+        stages whose inputs have not changed since the last run are
+        skipped. See .stages.StageRecord.
 
+        """
+
+        self.cache_dir = get_cache_dir(options)
+        self.pkg_store = PackageStore.from_options(options)
+        installer = options.installer or self.installer
+        self.use_native_installer = (
+            installer == "native"
+            or self.pkg_store is not None
+        )
         distroot = os.path.join(output_dir, self.stub_name)
-        self._init_tree(distroot)
+        self._init_tree(distroot, options)
+        stages = StageRecord(
+            distroot,
+            enabled=bool(options.output_dir and not options.rebuild),
+        )
+        data_dir = os.path.join(
+            os.path.dirname(__file__),
+            consts.PACKAGE_DATA_SUBDIR,
+        )
 
-        self._cleanup(distroot)
-        self._install_native_packages(distroot, pkgdirs=options.pkgdirs)
+        def _install_all_packages():
+            self._install_native_packages(distroot, pkgdirs=options.pkgdirs)
+            self._install_packages(distroot, POSTINST_PACKAGES)
+
+        stages.run(
+            "packages", _install_all_packages,
+            inputs=[
+                self.msystem.value,
+                self._get_native_packages(),
+                self.assume_installed_packages,
+                POSTINST_PACKAGES,
+                self._get_local_packages_info(options.pkgdirs),
+                self._get_sync_db_info(distroot),
+            ],
+            outputs=lambda: self._get_installed_packages_fingerprint(
+                distroot,
+            ),
+        )
         self._init_metadata(distroot)
         self._init_launchers(distroot)
-        self._install_icons(distroot)
-        self._install_exe_launchers(distroot)
-        self._install_packages(distroot, ["bash", "coreutils"])  # for postinst
-        self._delete_surplus_files(distroot, options)
-        self._install_postinst_scripts(distroot, options)
+        inventory = TreeInventory(distroot)
+
+        def _install_icons():
+            self._cleanup(distroot, [consts.ICO_FILE_SUBDIR], inventory)
+            icons = self._install_icons(
+                distroot, inventory,
+                cache=FileCache.from_options(options, "icons"),
+            )
+            inventory.refresh(consts.ICO_FILE_SUBDIR)
+            return icons
+
+        icons = stages.run(
+            "icons", _install_icons,
+            inputs=[[launcher.icon for launcher in self.launchers]],
+            upstream=["packages"],
+            outputs=lambda: tree_fingerprint(
+                os.path.join(distroot, consts.ICO_FILE_SUBDIR),
+            ),
+        )
+        self.icon = icons[0] if icons else ""
+
+        def _install_exe_launchers():
+            self._cleanup(distroot, inventory.glob("*.exe"), inventory)
+            self._install_exe_launchers(
+                distroot,
+                cache=FileCache.from_options(options, "launchers"),
+            )
+            exe_pattern = os.path.join(glob.escape(distroot), "*.exe")
+            for path in glob.glob(exe_pattern):
+                inventory.refresh(os.path.basename(path))
+
+        stages.run(
+            "launchers", _install_exe_launchers,
+            inputs=[
+                [lr.get_exe_launcher_inputs(self) for lr in self.launchers],
+                file_digest(os.path.join(data_dir, "launcherstub.c")),
+            ],
+            upstream=["packages", "icons"],
+            outputs=lambda: files_fingerprint(glob.glob(
+                os.path.join(glob.escape(distroot), "*.exe"),
+            )),
+        )
+        delete_ran = []
+
+        def _delete_surplus_files():
+            delete_ran.append(True)
+            self._delete_surplus_files(distroot, options, inventory)
+
+        stages.run(
+            "delete", _delete_surplus_files,
+            inputs=[
+                self._section.get("delete", ""),
+                self._section.get("nodelete", ""),
+                self._section.get("dll_closure", ""),
+                bool(options.output_dir),
+            ],
+            upstream=["packages", "icons", "launchers"],
+        )
+        if options.explain_delete and not delete_ran:
+            logger.warning(
+                "The delete stage was skipped, so no delete rule report "
+                "was written. Use --rebuild to write one."
+            )
 
+        def _install_postinst_scripts():
+            self._cleanup(distroot, [
+                consts.SCRIPTS_SUBDIR,
+                consts.LAUNCHER_LOCATION_STATE_FILE,
+            ], inventory)
+            self._install_postinst_scripts(distroot, options)
+            inventory.refresh(consts.SCRIPTS_SUBDIR)
+
+        stages.run(
+            "postinst", _install_postinst_scripts,
+            always=True,
+            outputs=lambda: tree_fingerprint(
+                os.path.join(distroot, consts.SCRIPTS_SUBDIR),
+            ),
+        )
+
+        tree_stages = ["packages", "icons", "launchers", "delete", "postinst"]
         distfiles = []
         if options.build_exe:
-            distfiles.extend(self._write_nsis_distfile(distroot, output_dir))
+            nsis_script = self._get_nsis_script(distroot, inventory)
+            distfiles.extend(stages.run(
+                "nsis",
+                lambda: self._write_nsis_distfile(
+                    distroot, output_dir,
+                    nsis_script=nsis_script,
+                ),
+                inputs=[
+                    nsis_script,
+                    file_digest(os.path.join(data_dir, "assoc.nsh")),
+                ],
+                upstream=tree_stages,
+                outputs=lambda: files_fingerprint(
+                    [os.path.join(output_dir, nsis_script[0])],
+                    contents=False,
+                ),
+            ))
         if options.build_zip:
-            distfiles.extend(self._write_zip_distfile(distroot, output_dir))
+            distfiles.extend(stages.run(
+                "zip",
+                lambda: self._write_zip_distfile(
+                    distroot, output_dir,
+                    inventory=inventory,
+                ),
+                inputs=[
+                    self._get_zip_distfile_basename(),
+                    self._section.get("compression", ""),
+                ],
+                upstream=tree_stages,
+                outputs=lambda: files_fingerprint(
+                    [os.path.join(
+                        output_dir,
+                        self._get_zip_distfile_basename(),
+                    )],
+                    contents=False,
+                ),
+            ))
         return distfiles
 
+    def write_plan(self, options):
+        """Work out what building the bundle would do, without doing it.
+
+        :param options: Parsed command line options.
+        :returns: The plan.
+        :rtype: .plan.BuildPlan
+        :raises RuntimeError: if some dependency can't be met.
+
+        The dependency closure of the bundle's packages is resolved
+        from the shared sync databases in the cache dir, refreshed as
+        for a build, or else from the host's. If the host has files
+        databases too, the delete rules are applied to the predicted
+        tree. The plan is written as text and as JSON, next to where
+        the delete rule report would go.
+
+        """
+        self.cache_dir = get_cache_dir(options)
+        # Catch spec errors which a build would only hit much later.
+        self.check_late_spec_keys()
+
+        store = SyncDBStore.from_options(options, self.msystem.arch)
+        if store is not None:
+            with store.lock():
+                self._update_sync_db_store(store, options)
+            sync_dir = store.sync_dir
+        else:
+            msys2_root = find_msys2_root()
+            if msys2_root is None:
+                raise RuntimeError("Cannot find the MSYS2 installation")
+            sync_dir = os.path.join(msys2_root, *SYNC_DB_SUBDIR.split("/"))
+        repos = get_repo_list()
+        if repos is None:
+            repos = sorted(
+                os.path.basename(p)[:-len(".db")]
+                for p in glob.glob(os.path.join(glob.escape(sync_dir), "*.db"))
+            )
+        sync_dbs = []
+        for repo in repos:
+            path = os.path.join(sync_dir, repo + ".db")
+            if os.path.isfile(path):
+                sync_dbs.append((repo, path))
+        if not sync_dbs:
+            raise RuntimeError("No sync databases in “%s”" % (sync_dir,))
+
+        logger.info("Planning the installation…")
+        targets = self._get_native_packages() + POSTINST_PACKAGES
+        plan = BuildPlan(
+            targets, sync_dbs,
+            archs=("any", self.msystem.arch),
+            assume_installed=self.assume_installed_packages,
+            local_packages=self._find_local_packages(
+                targets, options.pkgdirs,
+            ),
+            cache_dirs=pacman_cache_dirs(),
+        )
+
+        files_dbs = self._find_files_dbs(sync_dir, [r for r, p in sync_dbs])
+        output_dir = options.output_dir or os.getcwd()
+        root = os.path.join(output_dir, self.stub_name)
+        inventory = None
+        if not plan.missing and files_dbs:
+            inventory = plan.files_inventory(root, files_dbs)
+        elif not files_dbs:
+            logger.warning(
+                "No files databases found: cannot predict the effect of "
+                "the delete rules. Run “pacman -Fy” to download them."
+            )
+        if inventory is not None:
+            delete_patterns, nodelete_patterns = self._get_delete_patterns(
+                options,
+            )
+            if self.dll_closure:
+                logger.warning("plan: dll_closure is not predicted")
+            surplus = find_surplus(
+                root, delete_patterns, nodelete_patterns,
+                inventory=inventory,
+            )
+            plan.predict(inventory, surplus)
+            if options.explain_delete:
+                report = DeleteReport(
+                    root, delete_patterns, nodelete_patterns, surplus,
+                    inventory=inventory,
+                )
+                self._write_delete_report(report, options)
+
+        plan.log_summary()
+        basename = os.path.join(output_dir, self.stub_name) + "-plan"
+        for suffix, write in [(".txt", plan.write_text),
+                              (".json", plan.write_json)]:
+            path = basename + suffix
+            with open(path, "w", encoding="utf-8") as fp:
+                write(fp)
+            logger.info("Wrote build plan “%s”", path)
+        if plan.missing:
+            raise RuntimeError(
+                "Cannot meet %d dependencies: see the plan"
+                % (len(plan.missing),)
+            )
+        return plan
+
+    @staticmethod
+    def _find_files_dbs(sync_dir, repos):
+        """Helper: find files databases for some repos.
+
+        The shared store only has sync databases, so the host's files
+        databases are used if they're not next to them.
+
+        """
+        dirs = [sync_dir]
+        msys2_root = find_msys2_root()
+        if msys2_root is not None:
+            dirs.append(os.path.join(msys2_root, *SYNC_DB_SUBDIR.split("/")))
+        files_dbs = []
+        for repo in repos:
+            for d in dirs:
+                path = os.path.join(d, repo + ".files")
+                if os.path.isfile(path):
+                    files_dbs.append(path)
+                    break
+        return files_dbs
+
+    def _get_local_packages_info(self, pkgdirs):
+        """Identifying info for the local package files to be installed."""
+        local_package_paths = self._find_local_packages(
+            self._get_native_packages(),
+            pkgdirs,
+        )
+        info = []
+        for pkg_name, path in sorted(local_package_paths.items()):
+            info.append((pkg_name, path, file_stat_info(path)))
+        return info
+
+    def _get_sync_db_info(self, root):
+        """Identifying info for the sync databases in a bundle tree."""
+        sync_dir = os.path.join(root, "var", "lib", "pacman", "sync")
+        info = []
+        for path in sorted(glob.glob(os.path.join(sync_dir, "*"))):
+            info.append((os.path.basename(path), file_stat_info(path)))
+        return info
+
+    def _get_installed_packages_fingerprint(self, root):
+        """Fingerprint of the names & versions of the installed packages."""
+        local_dir = os.path.join(root, "var", "lib", "pacman", "local")
+        entries = []
+        if os.path.isdir(local_dir):
+            entries = sorted(os.listdir(local_dir))
+        return fingerprint(entries)
+
     @property
     def version(self):
         """The bundle's version string.
@@ -270,6 +624,48 @@ class NativeBundle:
         packages_raw = packages_raw.format(**substs)
         return packages_raw.split()
 
+    @property
+    def compression_policy(self):
+        """How files are compressed in the standalone zipfile."""
+        spec = self._section.get("compression", "")
+        try:
+            return CompressionPolicy.from_spec(spec)
+        except ValueError as e:
+            raise SpecificationError(
+                "Bad [%s]→compression: %s" % (self._SECTION_NAME, e)
+            )
+
+    def check_late_spec_keys(self):
+        """Validate the spec keys which a build only reads near its end.
+
+        :returns: (installer, compression_policy), as parsed.
+        :rtype: tuple
+        :raises SpecificationError: if either key is invalid.
+
+        """
+        return (self.installer, self.compression_policy)
+
+    @property
+    def dll_closure(self):
+        """Whether to delete the DLLs which nothing needs."""
+        return boolify(self._section.get("dll_closure", "no"))
+
+    @property
+    def installer(self):
+        """How packages are installed: "pacman" or "native".
+
+        The --installer command line option overrides this.
+
+        """
+        installer = self._section.get("installer", "")
+        installer = installer.strip().lower() or "pacman"
+        if installer not in INSTALLERS:
+            raise SpecificationError(
+                "Bad [%s]→installer: %r (expected one of: %s)"
+                % (self._SECTION_NAME, installer, ", ".join(INSTALLERS))
+            )
+        return installer
+
     @property
     def display_name(self):
         """The name to display when referring to the bundle.
@@ -344,36 +740,24 @@ class NativeBundle:
         self.metadata.update(metadata)
 
     def _get_package_metadata(self, name, root):
-        """Get details about a package from the db of installed packages."""
-        cmd = [
-            "pacman", "--query",
-            "--info", name,
-            "--root", root,
-        ]
-        cmd += ARCH_OPTS.get(self.msystem)
+        """Get details about a package from the db of installed packages.
+
+        :param str name: The package name.
+        :param str root: The bundle tree.
+        :returns: Metadata, keyed like pacman --query --info's output.
+        :rtype: dict
+        :raises RuntimeError: if the package isn't installed.
+
+        The local database is read directly: see .pacman.LocalPackageDB.
+
+        """
+        db = LocalPackageDB.get(root)
         try:
-            info_str = subprocess.check_output(
-                cmd,
-                universal_newlines=True,
-                env={"LANG": "C"},  # we specifically want the default
+            return db.metadata(name)
+        except KeyError:
+            raise RuntimeError(
+                "Package %r is not installed in “%s”" % (name, root)
             )
-        except Exception:
-            logger.critical("Failed to run “%s”", " ".join(cmd))
-            sys.exit(2)
-        metadata = {}
-        current_header = None
-        header_line_re = re.compile(r'^([a-z][a-z\040]*):\s(.*)$', re.I)
-        for line in info_str.split("\n"):
-            m = header_line_re.match(line)
-            if m:
-                current_header = str2key(m.group(1))
-                line = m.group(2)
-                metadata[current_header] = line
-            else:
-                assert current_header is not None
-                new_value = "\n".join([metadata[current_header], line])
-                metadata[current_header] = new_value
-        return metadata
 
     @staticmethod
     def _parse_version(version):
@@ -389,7 +773,7 @@ class NativeBundle:
             minor = 0
         return (major, minor)
 
-    def _init_tree(self, root):
+    def _init_tree(self, root, options):
         """Initialize a tree that can be installed to, then distributed.
 
         Internally, a bundle's tree is a heavily stripped-down MSYS2
@@ -402,10 +786,21 @@ class NativeBundle:
 
         Normally these trees are packages in zipfiles or installers.
 
+        The sync databases are normally seeded from a shared store in
+        the cache dir, which is only refreshed when it's older than
+        --sync-ttl minutes, or if --refresh is used. Without a cache,
+        they're refreshed straight into the tree.
+
         """
         logger.info("Creating tree in “%s”…", root)
         for subpath in ["var/lib/pacman", "var/log", "tmp"]:
             os.makedirs(os.path.join(root, subpath), exist_ok=True)
+        store = SyncDBStore.from_options(options, self.msystem.arch)
+        if store is not None:
+            with store.lock():
+                self._update_sync_db_store(store, options)
+                store.seed(root)
+            return
         cmd = [
             "pacman", "--sync", "--refresh",
             "--quiet",
@@ -415,6 +810,20 @@ class NativeBundle:
         cmd += ARCH_OPTS.get(self.msystem)
         subprocess.check_call(cmd)
 
+    def _update_sync_db_store(self, store, options):
+        """Helper: refresh the shared sync databases if needed.
+
+        The caller must hold the store's lock.
+
+        """
+        if options.refresh or store.is_stale():
+            store.refresh(ARCH_OPTS.get(self.msystem))
+        else:
+            logger.info(
+                "Using the shared sync databases in “%s”",
+                store.root,
+            )
+
     def _install_packages(self, root, packages, pkgdirs=()):
         """Helper: installs named packages into the tree."""
         packages = list(packages)
@@ -438,45 +847,20 @@ class NativeBundle:
         # the online repositories. In both cases, styrene assumes you
         # want the most recent available version.
 
-        local_packages = set()
-        local_package_paths = set()
-        remaining_packages = set()
-        filename_re_tmpl = r'''
-            ^ {name}
-            - (?P<version> [^-]+ - \d+ )
-            - any
-            [.]pkg[.]tar
-            (?: [.](?:gz|xz) )?
-            $
-        '''
-        keyobj = functools.cmp_to_key(self._vercmp)
-        for pkg_name in packages:
-            filename_re = filename_re_tmpl.format(
-                name=re.escape(pkg_name),
+        local_package_paths = self._find_local_packages(packages, pkgdirs)
+        for pkg_name, package_path in sorted(local_package_paths.items()):
+            logger.info("Using “%s” for %s", package_path, pkg_name)
+        local_packages = set(local_package_paths.keys())
+        remaining_packages = set(packages) - local_packages
+        local_package_paths = set(local_package_paths.values())
+
+        if self.use_native_installer:
+            self._install_packages_natively(
+                root, cmd_common,
+                packages, local_package_paths,
+                remaining_packages, local_packages,
             )
-            filename_re = re.compile(filename_re, re.X | re.I)
-            matches = []
-            for pkgdir in pkgdirs:
-                for entry in os.listdir(pkgdir):
-                    m = filename_re.match(entry)
-                    if not m:
-                        continue
-                    version = m.groupdict()["version"]
-                    matchinfo = (version, os.path.join(pkgdir, entry))
-                    matches.append(matchinfo)
-                    logger.debug(
-                        "Found %s version %s in “%s”",
-                        pkg_name, version, pkgdir,
-                    )
-            if matches:
-                matches.sort(key=lambda vp: (keyobj(vp[0]), vp[1]))
-                most_recent_match = matches[-1]
-                _, package_path = most_recent_match
-                logger.info("Using “%s” for %s", package_path, pkg_name)
-                local_package_paths.add(package_path)
-                local_packages.add(pkg_name)
-            else:
-                remaining_packages.add(pkg_name)
+            return
 
         if local_package_paths:
             cmd = ["pacman", "--upgrade"]
@@ -494,16 +878,166 @@ class NativeBundle:
             logger.debug("Running “%s”…", " ".join(cmd))
             subprocess.check_call(cmd)
 
+    def _install_packages_natively(self, root, cmd_common, packages,
+                                   local_package_paths,
+                                   remaining_packages, local_packages):
+        """Helper: installs packages into the tree in-process.
+
+        Pacman resolves the transaction and downloads any package files
+        which aren't in its cache, but the package files are unpacked
+        by Styrene, several at a time. If there is a self.pkg_store,
+        they're installed from that. The tree's local package database
+        is written too, including the .INSTALL scriptlets, which the
+        post-install scripting runs later.
+
+        As with pacman, the local package files are installed first,
+        so that the sync targets are resolved against a tree which
+        already has them.
+
+        """
+        fmt = ["--print", "--print-format", "%r %n %v %l"]
+        wanted = {p.casefold() for p in packages}
+        if local_package_paths:
+            cmd = ["pacman", "--upgrade"] + fmt + cmd_common
+            cmd += list(local_package_paths)
+            self._run_native_transaction(root, cmd_common, cmd, wanted)
+        if remaining_packages:
+            cmd = ["pacman", "--sync"] + fmt + cmd_common
+            cmd += list(remaining_packages)
+            if local_packages:
+                cmd += ["--ignore", ",".join(local_packages)]
+            self._run_native_transaction(root, cmd_common, cmd, wanted)
+
+    def _run_native_transaction(self, root, cmd_common, cmd, wanted):
+        """Helper: resolves one pacman transaction, and installs it.
+
+        :param str root: The bundle tree.
+        :param list cmd_common: Common pacman options.
+        :param list cmd: The pacman command which prints the targets.
+        :param set wanted: Casefolded names of the explicit packages.
+
+        """
+        targets = {}
+        logger.debug("Running “%s”…", " ".join(cmd))
+        output = subprocess.check_output(cmd, universal_newlines=True)
+        for line in output.splitlines():
+            fields = line.split(" ", 3)
+            if len(fields) != 4:
+                continue
+            repo, name, version, location = fields
+            targets.setdefault(name, (repo, location))
+        if not targets:
+            return
+
+        cache_dirs = pacman_cache_dirs()
+        sync_targets = []
+        for name, (repo, location) in sorted(targets.items()):
+            try:
+                self._find_downloaded_package(location, cache_dirs)
+            except RuntimeError:
+                sync_targets.append("%s/%s" % (repo, name))
+        if sync_targets:
+            cmd = ["pacman", "--sync", "--downloadonly"]
+            cmd += ["--nodeps", "--nodeps"]
+            cmd += [a for a in cmd_common if a != "--needed"]
+            cmd += sync_targets
+            logger.debug("Running “%s”…", " ".join(cmd))
+            subprocess.check_call(cmd)
+
+        install_func = install_package
+        if self.pkg_store is not None:
+            install_func = self.pkg_store.install
+        max_workers = min(len(targets), os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            futures = {}
+            for name, (repo, location) in sorted(targets.items()):
+                path = self._find_downloaded_package(location, cache_dirs)
+                logger.info("Installing %s from “%s”", name, path)
+                future = pool.submit(
+                    install_func,
+                    path, root,
+                    explicit=(name.casefold() in wanted),
+                )
+                futures[future] = name
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    for f in futures:
+                        f.cancel()
+                    raise
+                logger.debug("Installed %s", futures[future])
+
     @staticmethod
-    def _vercmp(v1, v2):
-        """Compares package version strings."""
-        # Ugly way of doing this, but necessary if this is to run
-        # with the native MINGW64 and 32 Pythons.
-        v1 = str(v1)
-        v2 = str(v2)
-        sign_str = subprocess.check_output(["vercmp", v1, v2])
-        sign_str = sign_str.strip()
-        return int(sign_str)
+    def _find_downloaded_package(location, cache_dirs):
+        """Helper: find a package file printed by pacman --print.
+
+        :param str location: The file's path or download URL.
+        :param list cache_dirs: Pacman's package cache dirs.
+        :returns: Path to the package file.
+        :rtype: str
+
+        Pacman prints MSYS2 paths and "file://" URLs for package files
+        it already has, so they're converted to native paths.
+
+        """
+        if location.startswith(("/", "file://")):
+            path = msys2_native_path(location)
+            if os.path.isfile(path):
+                return path
+        elif os.path.isfile(location):
+            return location
+        filename = location.rstrip("/").rsplit("/", 1)[-1]
+        for cache_dir in cache_dirs:
+            path = os.path.join(cache_dir, filename)
+            if os.path.isfile(path):
+                return path
+        raise RuntimeError(
+            "Cannot find %r in pacman's cache dirs %r"
+            % (filename, cache_dirs),
+        )
+
+    def _find_local_packages(self, packages, pkgdirs=()):
+        """Finds the most recent local package files for named packages.
+
+        :param list packages: Names of packages to search for.
+        :param list pkgdirs: Folders to search for package files.
+        :returns: Mapping of package names to package file paths.
+        :rtype: dict
+
+        Packages that cannot be found in any of the pkgdirs are omitted
+        from the returned dict. Package files for "any" architecture
+        or the target's architecture are used. The pkgdirs are indexed
+        by .pacman.PackageDirIndex, and the indexes are saved in the
+        cache dir.
+
+        """
+        found = {}
+        index_dir = None
+        if self.cache_dir:
+            index_dir = os.path.join(self.cache_dir, "pkgdirs")
+        indexes = [PackageDirIndex.get(d, index_dir) for d in pkgdirs]
+        archs = ("any", self.msystem.arch)
+        # Debug mode cross-checks against pacman's own vercmp.
+        cmp = vercmp
+        if logger.isEnabledFor(logging.DEBUG):
+            cmp = checked_vercmp
+        keyobj = functools.cmp_to_key(cmp)
+        for pkg_name in packages:
+            matches = []
+            for index in indexes:
+                for version, path in index.find(pkg_name, archs):
+                    matches.append((version, path))
+                    logger.debug(
+                        "Found %s version %s in “%s”",
+                        pkg_name, version, index.pkgdir,
+                    )
+            if matches:
+                matches.sort(key=lambda vp: (keyobj(vp[0]), vp[1]))
+                most_recent_match = matches[-1]
+                _, package_path = most_recent_match
+                found[pkg_name] = package_path
+        return found
 
     def _install_postinst_scripts(self, root, options):
         """Installs specified post-install scripting for the bundle.
@@ -571,22 +1105,58 @@ class NativeBundle:
 
         """
         logger.info("Installing packages requested in the spec…")
+        packages = self._get_native_packages()
+        self._install_packages(root, packages, pkgdirs=pkgdirs)
+
+    def _get_native_packages(self):
+        """The spec's packages, plus the ones needed by postinst."""
         substs = self.msystem.substs
         packages = list(self.packages)
         packages.append("{pkg_prefix}win7appid".format(**substs))
-        self._install_packages(root, packages, pkgdirs=pkgdirs)
+        return packages
 
-    def _install_icons(self, root):
+    def _install_icons(self, root, inventory=None, cache=None):
         """Installs freedesktop icons specified in [bundle]→icons.
 
+        :param str root: The bundle tree.
+        :param .inventory.TreeInventory inventory: Index of the tree.
+        :param .cache.FileCache cache: Cache of converted icons.
+        :returns: The names of the icons installed.
+        :rtype: list
+
         This method converts PNG icons in the installed hicolor theme to
         an ICO file in the bundle root with PNG encoding for each size.
+        The icon themes are indexed once, and each distinct icon is
+        converted just once, concurrently with the others.
 
         """
         logger.info("Installing FreeDesktop icons…")
         converted = []
+        launchers_by_icon = {}
         for launcher in self.launchers:
-            icon = launcher.install_icon(root, self.msystem)
+            if launcher.icon:
+                launchers_by_icon.setdefault(launcher.icon, launcher)
+        if not launchers_by_icon:
+            return converted
+        icon_index = IconThemeIndex(
+            root, self.msystem.subdir,
+            inventory=inventory,
+        )
+        max_workers = min(len(launchers_by_icon), os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            futures = [
+                pool.submit(
+                    launcher.install_icon,
+                    root, self.msystem, inventory,
+                    icon_index=icon_index,
+                    cache=cache,
+                )
+                for launcher in launchers_by_icon.values()
+            ]
+            icons = [f.result() for f in futures]
+        if cache is not None:
+            cache.prune()
+        for icon in icons:
             if not icon:
                 continue
             if not self.icon:
@@ -594,27 +1164,95 @@ class NativeBundle:
             converted.append(icon)
         return converted
 
-    def _install_exe_launchers(self, root):
-        """Install binary stub launchers"""
+    def _install_exe_launchers(self, root, cache=None):
+        """Install binary stub launchers.
+
+        :param str root: The bundle tree.
+        :param .cache.FileCache cache: Cache of built launchers.
+
+        The launcher stub is compiled just once, and then the launchers
+        are built concurrently on a bounded pool of worker threads.
+        Launchers found in the cache are reused. Each launcher's log
+        messages are held back until it has finished building, so
+        that they stay together.
+        If any launcher fails to build, the launchers which have not
+        yet started are cancelled, and the first failure is raised.
+
+        """
         logger.info("Installing .exe launchers…")
-        for launcher in self.launchers:
-            launcher.write_exe_launcher(root, self)
-
-    def _cleanup(self, root):
-        """Clean up any wrapper scripts etc. left by previous runs."""
-        junk = [
-            os.path.join(root, consts.LAUNCHER_LOCATION_STATE_FILE),
-            os.path.join(root, consts.ICO_FILE_SUBDIR),
-            os.path.join(root, consts.SCRIPTS_SUBDIR),
-        ]
-        junk.extend(glob.glob(os.path.join(root, "*.exe")))
-        for path in junk:
+        if not self.launchers:
+            return
+        launchers_logger = logging.getLogger(DesktopEntry.__module__)
+        max_workers = min(len(self.launchers), os.cpu_count() or 1)
+        failures = []
+        with tempfile.TemporaryDirectory() as stub_dir, \
+                concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            stub = LauncherStub(stub_dir)
+            futures = {}
+            for launcher in self.launchers:
+                log = BufferedLogger(launchers_logger)
+                future = pool.submit(
+                    launcher.write_exe_launcher,
+                    root, self,
+                    stub=stub,
+                    cache=cache,
+                    log=log,
+                )
+                futures[future] = (launcher, log)
+            for future in concurrent.futures.as_completed(futures):
+                launcher, log = futures[future]
+                log.flush()
+                if future.cancelled():
+                    continue
+                try:
+                    future.result()
+                except Exception as e:
+                    failures.append((launcher, e))
+                    for f in futures:
+                        f.cancel()
+        if cache is not None:
+            cache.prune()
+        if not failures:
+            return
+        launcher, e = failures[0]
+        if isinstance(e, subprocess.CalledProcessError):
+            logger.error(
+                "Failed to build the launcher for %r: "
+                "“%s” exited with status %d.",
+                launcher, " ".join(e.cmd), e.returncode,
+            )
+            for line in (e.output or "").strip().splitlines():
+                logger.error("%s: %s", e.cmd[0], line)
+        else:
+            logger.error(
+                "Failed to build the launcher for %r: %s",
+                launcher, e,
+            )
+        if len(failures) > 1:
+            logger.error(
+                "%d other launchers also failed to build.",
+                len(failures) - 1,
+            )
+        raise e
+
+    def _cleanup(self, root, paths, inventory=None):
+        """Clean up any wrapper scripts etc. left by previous runs.
+
+        :param str root: The bundle tree.
+        :param list paths: Files or folders to remove, relative to root.
+        :param .inventory.TreeInventory inventory: Index to update.
+
+        """
+        for relpath in paths:
+            path = os.path.join(root, relpath)
             logger.debug("cleanup: removing “%s”", path)
             if os.path.isdir(path):
-                fix_tree_perms(path)
+                fix_tree_perms(path, inventory=inventory)
                 shutil.rmtree(path)
             elif os.path.isfile(path):
                 os.unlink(path)
+            if inventory is not None:
+                inventory.remove(inventory.relpath(path))
 
     def _search_path(self, root, exe_basename):
         """Gets win32 path elements for a native executable.
@@ -635,12 +1273,76 @@ class NativeBundle:
                     return win32_relpath + '\\' + name
         return None
 
-    def _delete_surplus_files(self, root, options):
-        """Delete unwanted files from the bundle."""
+    def _get_dll_closure_patterns(self, root, delete_patterns,
+                                  nodelete_patterns, inventory):
+        """Extra delete rules for the DLLs which nothing needs.
+
+        :param str root: The bundle tree.
+        :param list delete_patterns: The spec's delete patterns.
+        :param list nodelete_patterns: The spec's nodelete patterns.
+        :param .inventory.TreeInventory inventory: Index of the bundle.
+        :returns: Lists of extra (delete, nodelete) patterns.
+        :rtype: tuple
+
+        Every DLL in the target's bin folder is deleted, unless an
+        executable or module that's being kept needs it, directly or
+        indirectly. The executables and modules which are being kept
+        are the .exe, .dll, and .pyd files the delete rules leave in
+        the tree. So loadable modules like gdk-pixbuf loaders count,
+        and so do DLLs in the bin folder named by nodelete patterns.
+        Their imports are read by .pe.dll_closure().
+
+        """
+        subdir = self.msystem.subdir
+        bin_dir = os.path.join(root, subdir, "bin")
+        dll_pattern = glob.escape(subdir) + "/bin/*.dll"
+        delete_patterns = list(delete_patterns) + [dll_pattern]
+        surplus = find_surplus(
+            root, delete_patterns, nodelete_patterns,
+            inventory=inventory,
+        )
+        roots = list(find_retained_pe_files(root, surplus, inventory))
+        needed = dll_closure(roots, [bin_dir])
+        nodelete = sorted(
+            glob.escape(os.path.relpath(path, root).replace(os.path.sep, "/"))
+            for path in needed
+        )
+        logger.info(
+            "DLL closure: %d executables and modules need %d DLLs "
+            "from “%s”",
+            len(roots), len(needed), bin_dir,
+        )
+        return ([dll_pattern], nodelete)
+
+    def _write_delete_report(self, report, options):
+        """Write out a DeleteReport, as text and as JSON.
+
+        The files go next to the bundle tree if it's being kept, and
+        otherwise into the current folder with the distributables.
 
-        # TODO: Could this pass examine all wanted .EXE files and
-        #       automatically determine+keep their support .DLLs?
+        """
+        report.log_summary()
+        output_dir = options.output_dir or os.getcwd()
+        basename = os.path.join(output_dir, self.stub_name)
+        basename += "-deletereport"
+        for suffix, write in [(".txt", report.write_text),
+                              (".json", report.write_json)]:
+            path = basename + suffix
+            with open(path, "w", encoding="utf-8") as fp:
+                write(fp)
+            logger.info("Wrote delete rule report “%s”", path)
+
+    def _get_delete_patterns(self, options):
+        """Get the delete and nodelete patterns for the bundle tree.
+
+        :param options: Parsed command line options.
+        :returns: (delete_patterns, nodelete_patterns)
+        :rtype: tuple
+
+        The [bundle]→dll_closure patterns aren't included, because
+        they depend on the contents of the tree.
 
+        """
         section = self._section
         substs = self.msystem.substs
 
@@ -679,78 +1381,212 @@ class NativeBundle:
         delete_spec = delete_spec.format(**substs)
         delete_patterns = delete_spec.strip().split()
 
-        surplus = list(find_surplus(root, delete_patterns, nodelete_patterns))
+        return (delete_patterns, nodelete_patterns)
+
+    def _delete_surplus_files(self, root, options, inventory=None):
+        """Delete unwanted files from the bundle.
+
+        :param str root: The bundle tree.
+        :param options: Parsed command line options.
+        :param .inventory.TreeInventory inventory: Index of the bundle.
+            It is used for matching, and updated as files are deleted.
+
+        """
+        if inventory is None:
+            inventory = TreeInventory(root)
+
+        delete_patterns, nodelete_patterns = self._get_delete_patterns(
+            options,
+        )
+        if self.dll_closure:
+            dll_delete, dll_nodelete = self._get_dll_closure_patterns(
+                root, delete_patterns, nodelete_patterns, inventory,
+            )
+            delete_patterns.extend(dll_delete)
+            nodelete_patterns.extend(dll_nodelete)
+
+        surplus = list(find_surplus(
+            root, delete_patterns, nodelete_patterns,
+            inventory=inventory,
+        ))
+        if options.explain_delete:
+            report = DeleteReport(
+                root, delete_patterns, nodelete_patterns, surplus,
+                inventory=inventory,
+            )
+            self._write_delete_report(report, options)
         if len(surplus) == 0:
             logger.warning(
                 "No usable delete rules found, or nothing to delete."
             )
             return
-        surplus.sort(reverse=True)
-        removed = []
-        for item in surplus:
-            if not os.path.exists(item):
+        # The surplus paths are all top-most, so they can be removed in
+        # any order, and concurrently.
+        plan = []
+        for item in sorted(surplus):
+            item_relpath = inventory.relpath(item)
+            info = inventory.get(item_relpath)
+            if info is None:
                 continue
-            try:
-                if os.path.isdir(item):
-                    fix_tree_perms(item)
-                    shutil.rmtree(item)
-                    removed.append(("rmtree", item))
-                elif os.path.isfile(item):
-                    if not os.access(item, os.W_OK):  # native winXX sem
-                        os.chmod(item, 0o600)
-                    os.unlink(item)
-                    removed.append(("unlink", item))
-                else:
-                    logger.warning(
-                        "Filesystem entry “%s” has an unknown type",
-                        item,
-                    )
-            except Exception:
-                logger.exception("Failed to delete “%s”", item)
+            mode = info[1]
+            if stat.S_ISDIR(mode):
+                action = "rmtree"
+            elif stat.S_ISREG(mode):
+                action = "unlink"
+            else:
+                logger.warning(
+                    "Filesystem entry “%s” has an unknown type",
+                    item,
+                )
+                continue
+            plan.append((action, item, item_relpath))
+        logger.info("Deleting %d surplus files and folders…", len(plan))
 
+        # The log is written in plan order as removals complete.
         deletelog = os.path.normpath(root) + "-deletelog.txt"
-        with open(deletelog, "a", encoding="utf-8") as fp:
-            for a, p in removed:
-                print("{action} {path}".format(action=a, path=p), file=fp)
-
-    def _write_zip_distfile(self, root, output_dir):
+        with open(deletelog, "a", encoding="utf-8") as fp, \
+                concurrent.futures.ThreadPoolExecutor() as pool:
+            futures = [
+                pool.submit(remove_path, item, (action == "rmtree"))
+                for (action, item, item_relpath) in plan
+            ]
+            for (action, item, item_relpath), future in zip(plan, futures):
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception("Failed to delete “%s”", item)
+                    continue
+                inventory.remove(item_relpath)
+                print("{action} {path}".format(action=action, path=item),
+                      file=fp)
+
+    def _write_zip_distfile(self, root, output_dir, inventory=None):
         """Package a frozen bundle as a standalone zipfile.
 
         :param str root: Frozen bundle location.
         :param str output_dir: Where to write the output zipfile.
+        :param .inventory.TreeInventory inventory: Index of the bundle.
 
         """
-        output_file_basename = "{stub_name}-{version}-standalone.zip".format(
-            stub_name=self.stub_name,
-            version=self.version,
-        )
+        output_file_basename = self._get_zip_distfile_basename()
         logger.info("Writing “%s”…", output_file_basename)
         output_file_path = os.path.join(output_dir, output_file_basename)
-        cmd = [
-            "zip", "-Xq9r",
-            os.path.abspath(output_file_path),
-            os.path.curdir,
-        ]
-        subprocess.check_call(
-            cmd,
-            cwd=root,
+        previous = self._find_previous_zip_distfile(output_dir)
+        if previous:
+            logger.info(
+                "Reusing unchanged files from “%s”",
+                os.path.basename(previous),
+            )
+        stats = write_zip_tree(
+            output_file_path, root,
+            level=9,
+            previous=previous,
+            policy=self.compression_policy,
+            inventory=inventory,
         )
+        stats.log_summary(output_file_basename)
         return [output_file_path]
 
-    def _write_nsis_distfile(self, root, output_dir):
+    def _find_previous_zip_distfile(self, output_dir):
+        """Find the most recent standalone zipfile from an earlier build.
+
+        :param str output_dir: Where the output zipfile will be written.
+        :returns: Path to the earlier zipfile, or None.
+
+        This is normally a zipfile of the same name, but after a
+        version bump it's the newest one for the same bundle.
+
+        """
+        path = os.path.join(output_dir, self._get_zip_distfile_basename())
+        if os.path.isfile(path):
+            return path
+        pattern = os.path.join(
+            glob.escape(output_dir),
+            glob.escape(self.stub_name) + "-*-standalone.zip",
+        )
+        candidates = [p for p in glob.glob(pattern) if os.path.isfile(p)]
+        if not candidates:
+            return None
+        return max(candidates, key=os.path.getmtime)
+
+    def _get_zip_distfile_basename(self):
+        """The file name of the standalone zipfile."""
+        return "{stub_name}-{version}-standalone.zip".format(
+            stub_name=self.stub_name,
+            version=self.version,
+        )
+
+    def _write_nsis_distfile(self, root, output_dir, nsis_script=None):
         """Package a frozen bundle as an NSIS installer executable.
 
         :param str root: Frozen bundle location.
         :param str output_dir: Where to write the output zipfile.
+        :param tuple nsis_script: Result of _get_nsis_script(), if known.
+
+        """
+        if nsis_script is None:
+            nsis_script = self._get_nsis_script(root)
+        installer_exe_name, nsis = nsis_script
+
+        # Run makensis with a suitable config and includes
+
+        nsi_file_basename = "{stub_name}.nsi".format(
+            stub_name=self.stub_name,
+        )
+        logger.info("Writing “%s”…", nsi_file_basename)
+        nsi_file_path = os.path.join(output_dir, nsi_file_basename)
+        with open(nsi_file_path, "w", encoding="utf-8") as fp:
+            fp.write(nsis)
+
+        nsh_file_basenames = ["assoc.nsh"]
+        for nsh_file_basename in nsh_file_basenames:
+            nsh_src_file_path = os.path.join(
+                os.path.dirname(__file__),
+                consts.PACKAGE_DATA_SUBDIR,
+                nsh_file_basename,
+            )
+            nsh_targ_file_path = os.path.join(output_dir, nsh_file_basename)
+            # Parallel jobs may share an output dir: don't rewrite
+            # an include that another job's makensis may be reading.
+            if os.path.isfile(nsh_targ_file_path):
+                if filecmp.cmp(nsh_src_file_path, nsh_targ_file_path, False):
+                    continue
+            logger.info("Copying “%s”…", nsh_file_basename)
+            shutil.copy(nsh_src_file_path, nsh_targ_file_path)
+
+        makensis_cmd = [
+            "makensis.exe", "-V3",
+            "-INPUTCHARSET", "UTF8",
+            os.path.abspath(nsi_file_path),
+        ]
+        subprocess.check_call(
+            makensis_cmd,
+            cwd=output_dir,
+        )
+        installer_exe_path = os.path.join(output_dir, installer_exe_name)
+        if not os.path.isfile(installer_exe_path):
+            raise RuntimeError(
+                "Missing output. "
+                "Expected output file %r does not exist."
+                % (installer_exe_path,),
+            )
+
+        return [installer_exe_path]
+
+    def _get_nsis_script(self, root, inventory=None):
+        """Generates the NSIS script for a frozen bundle.
+
+        :param str root: Frozen bundle location.
+        :param .inventory.TreeInventory inventory: Index of the bundle.
+        :returns: (installer_exe_name, nsis_script_text)
+        :rtype: tuple
 
         """
 
         # Get the size
-        bundle_size = 0
-        for dir_path, subdirs, files in os.walk(root):
-            for file_name in files:
-                file_path = os.path.join(dir_path, file_name)
-                bundle_size += os.path.getsize(file_path)
+        if inventory is None:
+            inventory = TreeInventory(root)
+        bundle_size = inventory.total_size(inventory.relpath(root))
         bundle_size /= 1024   # to KiB
         bundle_size += 128   # uninstaller, plus a bit more for luck
 
@@ -844,105 +1680,163 @@ class NativeBundle:
         with open(nsi_template_file, "r", encoding="utf-8") as fp:
             nsis = fp.read()
         nsis = nsis % substs
+        return (installer_exe_name, nsis)
 
-        # Run makensis with a suitable config and includes
 
-        nsi_file_basename = "{stub_name}.nsi".format(**substs)
-        logger.info("Writing “%s”…", nsi_file_basename)
-        nsi_file_path = os.path.join(output_dir, nsi_file_basename)
-        with open(nsi_file_path, "w", encoding="utf-8") as fp:
-            fp.write(nsis)
+def find_surplus(root, del_patterns, keep_patterns, inventory=None):
+    """Find "surplus" files and folders within a root.
 
-        nsh_file_basenames = ["assoc.nsh"]
-        for nsh_file_basename in nsh_file_basenames:
-            logger.info("Copying “%s”…", nsh_file_basename)
-            nsh_src_file_path = os.path.join(
-                os.path.dirname(__file__),
-                consts.PACKAGE_DATA_SUBDIR,
-                nsh_file_basename,
-            )
-            nsh_targ_file_path = os.path.join(output_dir, nsh_file_basename)
-            shutil.copy(nsh_src_file_path, nsh_targ_file_path)
+    :param str root: The folder to search.
+    :param list del_patterns: Glob patterns for things to delete.
+    :param list keep_patterns: Glob patterns for things to keep.
+    :param .inventory.TreeInventory inventory: Index containing root.
+    :returns: Normalized paths of the top-most things to delete.
+    :rtype: set
 
-        makensis_cmd = [
-            "makensis.exe", "-V3",
-            "-INPUTCHARSET", "UTF8",
-            os.path.abspath(nsi_file_path),
-        ]
-        subprocess.check_call(
-            makensis_cmd,
-            cwd=output_dir,
-        )
-        installer_exe_path = os.path.join(output_dir, installer_exe_name)
-        if not os.path.isfile(installer_exe_path):
-            raise RuntimeError(
-                "Missing output. "
-                "Expected output file %r does not exist."
-                % (installer_exe_path,),
-            )
+    Everything matched by a delete pattern is surplus, and so are the
+    contents of matched folders, unless they are kept. A path is kept
+    if it is matched by a keep pattern, is inside a matched folder, or
+    is a folder between the root and a match. Folder contents here
+    means what a "**" glob would match, so names starting with "."
+    are not included.
 
-        return [installer_exe_path]
+    Nothing inside a surplus folder can be kept, so only the top-most
+    surplus paths are returned. Deleting a returned folder means
+    deleting all of it.
 
+    The patterns are compiled into two GlobMatchers, and the tree is
+    walked once. Being inside a matched folder is tracked as a flag
+    on the way down, and whether anything is kept as a flag on the
+    way back up, so memory use doesn't grow with the size of the
+    tree. Subtrees which no pattern can reach are skipped, and so are
+    surplus subtrees where nothing can be kept.
 
-def find_surplus(root, del_patterns, keep_patterns):
-    """Find "surplus" files and folders within a root."""
+    The inventory is made by scanning the root if it isn't given.
+    If it is given, the root needn't exist.
 
-    if not os.path.isdir(root):
+    """
+
+    if inventory is None and not os.path.isdir(root):
         raise ValueError("Root path %r is not a directory" % (root,))
 
     root = os.path.abspath(root)
     root = os.path.normpath(root)
     root = os.path.normcase(root)
 
-    glob_opts = dict(recursive=True)
-    try:
-        glob.iglob("/nonexistent/**.foo", **glob_opts)
-    except Exception:
-        logger.error(
-            "Glob options %r are not supported on this Python version.",
-            glob_opts,
-        )
-        return []
-
-    # Keep every matched path, its contents if it's a folder,
-    # and every folder path between the root and the match.
-    keep_paths = set([root])
-    for pattern in keep_patterns:
-        pattern = os.path.join(glob.escape(root), pattern)
-        for path in glob.iglob(pattern, **glob_opts):
-            # Item itself
-            path = os.path.normpath(path)
-            keep_paths.add(path)
-            # Recursive contents
-            if os.path.isdir(path):
-                c_pattern = os.path.join(glob.escape(path), "**")
-                for c_path in glob.iglob(c_pattern, **glob_opts):
-                    c_path = os.path.normpath(c_path)
-                    keep_paths.add(c_path)
-            # Paths between root and match
-            p, t = path, None
-            root_pfx = root
-            if not root_pfx.endswith(os.path.sep):
-                root_pfx += os.path.sep
-            while p is not None and p.startswith(root_pfx):
-                p = os.path.normpath(p)
-                keep_paths.add(p)
-                p, t = os.path.split(p)
-
-    # Everything matched by the delete patterns minus those matched by
-    # the keep patterns is surplus.
-    surplus_paths = set()
-    for pattern in del_patterns:
-        pattern = os.path.join(glob.escape(root), pattern)
-        for path in glob.glob(pattern, **glob_opts):
-            path = os.path.normpath(path)
-            if path not in keep_paths:
-                surplus_paths.add(path)
-            if os.path.isdir(path):
-                c_pattern = os.path.join(glob.escape(path), "**")
-                for c_path in glob.glob(c_pattern, **glob_opts):
-                    c_path = os.path.normpath(c_path)
-                    if c_path not in keep_paths:
-                        surplus_paths.add(c_path)
+    if inventory is None:
+        inventory = TreeInventory(root)
+    root_relpath = inventory.relpath(root)
+    keep = GlobMatcher(keep_patterns)
+    delete = GlobMatcher(del_patterns)
+
+    # Patterns like "missing/**" match even if there's nothing there,
+    # and the folders leading up to such a path are kept.
+    kept_unchecked = set()
+    for path in keep.unchecked_matches():
+        inv_path = root_relpath + "/" + path if root_relpath else path
+        if inv_path in inventory:
+            continue
+        while path:
+            kept_unchecked.add(path)
+            path = path.rpartition("/")[0]
+
+    def _visit(relpath, inv_relpath, keep_state, in_kept_dir,
+               del_state, in_deleted_dir):
+        """Walk a folder's contents.
+
+        Returns whether anything inside it is kept, and the top-most
+        surplus paths inside it.
 
-    return surplus_paths
+        """
+        any_kept = False
+        surplus = []
+        for name, inv_child, info in inventory.iterdir(inv_relpath):
+            child = relpath + "/" + name if relpath else name
+            is_dir = stat.S_ISDIR(info[1])
+            hidden = name.startswith(".")
+
+            child_keep_state = keep.step(keep_state, name, is_dir)
+            is_keep_match = keep.matches(child_keep_state, is_dir)
+            in_kept = in_kept_dir and not hidden
+            is_kept = is_keep_match or in_kept or (child in kept_unchecked)
+
+            child_del_state = delete.step(del_state, name, is_dir)
+            is_del_match = delete.matches(child_del_state, is_dir)
+            in_deleted = in_deleted_dir and not hidden
+            is_surplus = (is_del_match or in_deleted) and not is_kept
+
+            child_in_kept_dir = in_kept or is_keep_match
+            child_in_deleted_dir = in_deleted or is_del_match
+            kept_inside = False
+            child_surplus = []
+            if not is_dir:
+                pass
+            elif child_keep_state is None and not child_in_kept_dir:
+                # Nothing in here can be kept
+                can_delete = (child_del_state is not None
+                              or child_in_deleted_dir)
+                if can_delete and not is_surplus:
+                    kept_inside, child_surplus = _visit(
+                        child, inv_child,
+                        None, False,
+                        child_del_state, child_in_deleted_dir,
+                    )
+            else:
+                kept_inside, child_surplus = _visit(
+                    child, inv_child,
+                    child_keep_state, child_in_kept_dir,
+                    child_del_state, child_in_deleted_dir,
+                )
+
+            if is_kept or kept_inside:
+                any_kept = True
+            if is_surplus and not kept_inside:
+                surplus.append(child)
+            else:
+                surplus.extend(child_surplus)
+        return (any_kept, surplus)
+
+    is_root_kept = keep.matches(keep.start, True)
+    is_root_deleted = delete.matches(delete.start, True)
+    any_kept, surplus = _visit(
+        "", root_relpath,
+        keep.start, is_root_kept,
+        delete.start, is_root_deleted,
+    )
+
+    root_pfx = root
+    if not root_pfx.endswith(os.path.sep):
+        root_pfx += os.path.sep
+    return set(root_pfx + p.replace("/", os.path.sep) for p in surplus)
+
+
+def find_retained_pe_files(root, surplus, inventory=None):
+    """Find the executables and modules that deletion will leave.
+
+    :param str root: The folder that was searched for surplus.
+    :param surplus: Paths to be deleted, from find_surplus().
+    :param .inventory.TreeInventory inventory: Index containing root.
+    :returns: Iterator yielding the paths of retained .exe, .dll, and
+        .pyd files.
+
+    """
+    root = os.path.normpath(os.path.abspath(root))
+    if inventory is None:
+        inventory = TreeInventory(root)
+    surplus = set(
+        os.path.normcase(os.path.relpath(p, root)).replace(os.path.sep, "/")
+        for p in surplus
+    )
+    stack = [("", inventory.relpath(root))]
+    while stack:
+        relpath, inv_relpath = stack.pop()
+        for name, inv_child, info in inventory.iterdir(inv_relpath):
+            child = relpath + "/" + name if relpath else name
+            if os.path.normcase(child) in surplus:
+                continue
+            mode = info[1]
+            if stat.S_ISDIR(mode):
+                stack.append((child, inv_child))
+            elif stat.S_ISREG(mode):
+                if name.lower().endswith(PE_FILE_EXTENSIONS):
+                    yield inventory.abspath(inv_child)
@@ -0,0 +1,413 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Persistent on-disk caches, shared between runs."""
+
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import contextlib
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+#: Default size limit for each cache, in MiB.
+DEFAULT_CACHE_SIZE = 256
+
+#: Default freshness limit for the shared sync databases, in minutes.
+DEFAULT_SYNC_DB_TTL = 60
+
+#: Subfolder of a FileCache holding the entries' last-used stamps.
+_STAMPS_SUBDIR = ".used"
+
+
+# Helper funcs:
+
+def get_default_cache_dir():
+    """The default location for Styrene's caches.
+
+    This is a "styrene" folder inside $XDG_CACHE_HOME, or inside
+    ~/.cache if that's not set.
+
+    """
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "styrene")
+
+
+def get_cache_dir(options):
+    """The cache dir configured by the command line options.
+
+    :param options: Parsed command line options.
+    :returns: The cache dir's path, or None if caching is turned off.
+
+    """
+    if not options.use_cache:
+        return None
+    return options.cache_dir or get_default_cache_dir()
+
+
+def link_or_copy(src, dest):
+    """Hardlink a file into place, falling back to a copy.
+
+    :param str src: The file to link or copy.
+    :param str dest: Where to put it. Any existing file is replaced.
+
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Context manager: hold an exclusive lock on a lock file.
+
+    :param str path: The lock file, created if needed.
+
+    This blocks until any other process holding the lock releases it.
+    Locks are released by the OS if their process dies.
+
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+b") as fp:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                fp.seek(0)
+                try:
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    logger.debug("Still waiting for lock %r", path)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+            else:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# Class defs:
+
+class FileCache:
+    """A content-addressed store of files, with a size limit.
+
+    Files are stored under keys, which are normally hex digests of
+    whatever inputs determine the file's content. Writes are atomic,
+    so several processes can share a cache safely.
+
+    When the cache grows beyond its size limit, the least recently
+    used files are removed by prune(). Use is recorded by touching an
+    empty stamp file for each entry, not the entry itself: entries are
+    often hardlinked into bundle trees, and share their mtimes.
+
+    """
+
+    def __init__(self, root, max_size=DEFAULT_CACHE_SIZE):
+        """Initialize, creating the cache folder if needed.
+
+        :param str root: Folder for the cache.
+        :param int max_size: Size limit in MiB, or None for no limit.
+
+        """
+        super().__init__()
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_options(cls, options, name):
+        """Get a named cache as configured by the command line.
+
+        :param options: Parsed command line options.
+        :param str name: Subfolder of the cache dir to use.
+        :returns: A new cache, or None if caching is turned off.
+
+        """
+        cache_dir = get_cache_dir(options)
+        if cache_dir is None:
+            return None
+        return cls(os.path.join(cache_dir, name), options.cache_size)
+
+    def _get_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _get_stamp_path(self, key):
+        return os.path.join(self.root, _STAMPS_SUBDIR, key)
+
+    def _touch(self, key):
+        """Record that an entry was just used, for prune()."""
+        stamp_path = self._get_stamp_path(key)
+        try:
+            os.makedirs(os.path.dirname(stamp_path), exist_ok=True)
+            with open(stamp_path, "ab"):
+                pass
+            os.utime(stamp_path)
+        except OSError:
+            logger.debug("cache: cannot touch %r", stamp_path, exc_info=True)
+
+    def get(self, key):
+        """Look up a cached file.
+
+        :param str key: The key to look up.
+        :returns: The path to the cached file, or None.
+
+        """
+        path = self._get_path(key)
+        if not os.path.isfile(path):
+            return None
+        self._touch(key)
+        return path
+
+    def fetch(self, key, dest):
+        """Copy or hardlink a cached file into place, if it exists.
+
+        :param str key: The key to look up.
+        :param str dest: Where to put the file.
+        :returns: True if the key was found, False otherwise.
+
+        """
+        path = self.get(key)
+        if path is None:
+            return False
+        link_or_copy(path, dest)
+        return True
+
+    def put(self, key, src):
+        """Store a copy of a file in the cache.
+
+        :param str key: The key to store the file under.
+        :param str src: The file to copy into the cache.
+        :returns: The path to the cached copy.
+
+        """
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            prefix=".tmp",
+        )
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Most likely another process has just stored it.
+            logger.debug("cache: cannot store %r", path, exc_info=True)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self._touch(key)
+        return path
+
+    def prune(self):
+        """Remove least recently used files until within the size limit.
+
+        :returns: The number of files removed.
+        :rtype: int
+
+        """
+        if self.max_size is None:
+            return 0
+        entries = []
+        total_size = 0
+        for dir_path, subdirs, files in os.walk(self.root):
+            if dir_path == self.root and _STAMPS_SUBDIR in subdirs:
+                subdirs.remove(_STAMPS_SUBDIR)
+            for file_name in files:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                used = st.st_mtime
+                try:
+                    stamp_st = os.stat(self._get_stamp_path(file_name))
+                    used = max(used, stamp_st.st_mtime)
+                except OSError:
+                    pass
+                entries.append((used, st.st_size, path))
+                total_size += st.st_size
+        max_bytes = self.max_size * 1024 * 1024
+        entries.sort()
+        removed = 0
+        for used, size, path in entries:
+            if total_size <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            try:
+                os.unlink(self._get_stamp_path(os.path.basename(path)))
+            except OSError:
+                pass
+            total_size -= size
+            removed += 1
+        if removed:
+            logger.info(
+                "Removed %d old files from the cache in “%s”",
+                removed, self.root,
+            )
+        return removed
+
+
+class SyncDBStore:
+    """Shared copies of pacman's sync databases for one architecture.
+
+    Refreshing the sync databases downloads and unpacks every repo's
+    package list, and doing that for each new bundle tree is slow.
+    A store keeps one refreshed set of sync databases in its own
+    pacman root, and bundle trees are seeded from it. The store is
+    only refreshed when it is older than its freshness limit.
+
+    Refreshing and seeding happen while holding a lock, so parallel
+    builds can share a store safely.
+
+    """
+
+    _SYNC_SUBDIR = os.path.join("var", "lib", "pacman", "sync")
+    _STAMP_FILE = "last-refresh"
+    _LOCK_FILE = "lock"
+
+    def __init__(self, root, ttl=DEFAULT_SYNC_DB_TTL):
+        """Initialize.
+
+        :param str root: Folder for the store.
+        :param int ttl: Freshness limit in minutes.
+
+        """
+        super().__init__()
+        self.root = root
+        self.ttl = ttl
+
+    @classmethod
+    def from_options(cls, options, arch):
+        """Get the store for an architecture, as configured.
+
+        :param options: Parsed command line options.
+        :param str arch: Architecture, e.g. "x86_64".
+        :returns: A new store, or None if caching is turned off.
+
+        """
+        cache_dir = get_cache_dir(options)
+        if cache_dir is None:
+            return None
+        return cls(os.path.join(cache_dir, "syncdb", arch), options.sync_ttl)
+
+    @property
+    def _pacman_root(self):
+        return os.path.join(self.root, "root")
+
+    @property
+    def sync_dir(self):
+        """Where the store keeps its sync databases."""
+        return os.path.join(self._pacman_root, self._SYNC_SUBDIR)
+
+    def lock(self):
+        """Context manager: lock the store."""
+        return file_lock(os.path.join(self.root, self._LOCK_FILE))
+
+    def is_stale(self):
+        """Whether the store needs refreshing. Call with the lock held."""
+        stamp_path = os.path.join(self.root, self._STAMP_FILE)
+        try:
+            age = time.time() - os.stat(stamp_path).st_mtime
+        except OSError:
+            return True
+        if not os.path.isdir(self.sync_dir) or not os.listdir(self.sync_dir):
+            return True
+        return not (0 <= age < self.ttl * 60)
+
+    def refresh(self, pacman_opts=()):
+        """Refresh the store's databases. Call with the lock held.
+
+        :param list pacman_opts: Extra options for pacman.
+
+        """
+        logger.info("Refreshing the sync databases in “%s”…", self.root)
+        for subpath in ["var/lib/pacman", "var/log", "tmp"]:
+            os.makedirs(os.path.join(self._pacman_root, subpath),
+                        exist_ok=True)
+        self._unshare()
+        cmd = [
+            "pacman", "--sync", "--refresh",
+            "--quiet",
+            "--root", self._pacman_root,
+            "--noprogressbar",
+        ]
+        cmd += list(pacman_opts)
+        subprocess.check_call(cmd)
+        stamp_path = os.path.join(self.root, self._STAMP_FILE)
+        with open(stamp_path, "w", encoding="utf-8") as fp:
+            fp.write("%f\n" % (time.time(),))
+
+    def _unshare(self):
+        """Give the databases new inodes, before pacman writes to them.
+
+        The trees seeded from the store may have hardlinks to its
+        files. Copying each one to a new file preserves their content,
+        whatever pacman does to the store's files.
+
+        """
+        if not os.path.isdir(self.sync_dir):
+            return
+        for name in os.listdir(self.sync_dir):
+            path = os.path.join(self.sync_dir, name)
+            if not os.path.isfile(path) or os.stat(path).st_nlink < 2:
+                continue
+            tmp_path = path + ".tmp"
+            shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, path)
+
+    def seed(self, root):
+        """Hardlink or copy the databases into a pacman root.
+
+        :param str root: The pacman root to seed, e.g. a bundle tree.
+
+        Call with the lock held.
+
+        """
+        dest_dir = os.path.join(root, self._SYNC_SUBDIR)
+        os.makedirs(dest_dir, exist_ok=True)
+        for name in sorted(os.listdir(self.sync_dir)):
+            src = os.path.join(self.sync_dir, name)
+            if not os.path.isfile(src):
+                continue
+            link_or_copy(src, os.path.join(dest_dir, name))
+        logger.debug("Seeded “%s” from “%s”", dest_dir, self.sync_dir)
@@ -19,7 +19,11 @@
 """Launching from the command line."""
 
 from .bundle import NativeBundle
+from .bundle import INSTALLERS
 from .utils import fix_tree_perms
+from .cache import DEFAULT_CACHE_SIZE
+from .cache import DEFAULT_SYNC_DB_TTL
+from . import consts
 
 import optparse
 import configparser
@@ -30,6 +34,8 @@ import tempfile
 import shutil
 from textwrap import dedent
 import re
+import contextlib
+import concurrent.futures
 import logging
 
 logger = logging.getLogger(__name__)
@@ -100,11 +106,46 @@ class ColorFormatter (logging.Formatter):
         return super(ColorFormatter, self).format(record)
 
 
+class JobPrefixFilter (logging.Filter):
+    """Adds a ``job_prefix`` field naming the current job to log records.
+
+    Worker processes building several spec files at once set the
+    current job's name on the filter, so that their interleaved output
+    can be told apart on the console.
+
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.job = None
+
+    def filter(self, record):
+        record.job_prefix = ""
+        if self.job:
+            record.job_prefix = "[%s] " % (self.job,)
+        return True
+
+
+#: Filter for the console log handler, set up by init_logging().
+_job_prefix_filter = JobPrefixFilter()
+
+
 # Top-level commands:
 
-def process_spec_file(spec, options):
-    """Prepare the bundle as specified in the spec."""
-    bundle = NativeBundle(spec)
+def process_spec_file(spec, options, msystem=None):
+    """Prepare the bundle as specified in the spec.
+
+    :param configparser.ConfigParser spec: The loaded bundle spec.
+    :param options: Parsed command line options.
+    :param consts.MSYSTEM msystem: Target (default: from environment).
+
+    """
+    bundle = NativeBundle(spec, msystem=msystem)
+    if options.plan:
+        if options.output_dir:
+            os.makedirs(options.output_dir, exist_ok=True)
+        bundle.write_plan(options)
+        return
     bundle.check_runtime_dependencies()
     output_dir = options.output_dir
     if not output_dir:
@@ -138,6 +179,169 @@ def process_spec_file(spec, options):
         bundle.write_distributables(output_dir, options)
 
 
+@contextlib.contextmanager
+def msystem_environ(msystem):
+    """Context manager: run this process's tools for a given MSYSTEM.
+
+    :param consts.MSYSTEM msystem: Target, or None for no change.
+
+    """
+    if msystem is None:
+        yield
+        return
+    saved_environ = dict(os.environ)
+    os.environ.update(msystem.environ())
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+
+def get_job_name(spec_file, msystem=None):
+    """Short name for a job, for log prefixes and summaries."""
+    name = os.path.basename(spec_file)
+    if msystem is not None:
+        name += ":" + msystem.value
+    return name
+
+
+def process_spec_job(spec_file, options, msystem=None):
+    """Load and process one spec file, as a single independent job.
+
+    :param str spec_file: Path to the bundle spec file.
+    :param options: Parsed command line options.
+    :param consts.MSYSTEM msystem: Target (default: from environment).
+    :returns: (job_name, succeeded)
+    :rtype: tuple
+
+    Failures are logged here rather than raised, so that one broken
+    spec does not stop any of the others from being built.
+
+    """
+    job_name = get_job_name(spec_file, msystem)
+    if options.jobs > 1:
+        _job_prefix_filter.job = job_name
+    try:
+        try:
+            spec = configparser.SafeConfigParser()
+            spec.read(spec_file, encoding="utf-8")
+        except Exception:
+            logger.exception(
+                "Failed to load bundle spec file “%s”",
+                spec_file,
+            )
+            return (job_name, False)
+        try:
+            with msystem_environ(msystem):
+                process_spec_file(spec, options, msystem=msystem)
+        except Exception:
+            logger.exception(
+                "Unexpected error while processing “%s”",
+                spec_file,
+            )
+            return (job_name, False)
+        return (job_name, True)
+    finally:
+        _job_prefix_filter.job = None
+
+
+def init_logging(options):
+    """Set up console logging as requested by the command line options."""
+    colourize = {
+        "yes".casefold(): True,
+        "no".casefold(): False,
+    }.get(options.colour.casefold(), sys.stderr.isatty())
+    if colourize:
+        log_format = (
+            "%(job_prefix)s"
+            "%(levelCol)s%(levelname)s: "
+            "%(bold)s%(name)s%(boldOff)s: "
+            "%(message)s%(reset)s"
+        )
+        console_formatter = ColorFormatter(log_format)
+    else:
+        log_format = "%(job_prefix)s%(levelname)s: %(name)s: %(message)s"
+        console_formatter = logging.Formatter(log_format)
+    console_handler = logging.StreamHandler(stream=sys.stderr)
+    console_handler.setFormatter(console_formatter)
+    console_handler.addFilter(_job_prefix_filter)
+    root_logger = logging.getLogger(None)
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(console_handler)
+    if options.quiet:
+        loglevel = logging.WARNING
+    elif options.debug:
+        loglevel = logging.DEBUG
+    else:
+        loglevel = logging.INFO
+    root_logger.setLevel(loglevel)
+
+
+def run_jobs(spec_files, options, msystems=(None,)):
+    """Process spec files, possibly in parallel, and summarize.
+
+    :param list spec_files: Paths to the bundle spec files.
+    :param options: Parsed command line options.
+    :param list msystems: Targets to build each spec for.
+    :returns: The names of the jobs which failed.
+    :rtype: list
+
+    One job is run for each combination of spec file and target.
+    A target of None means the one named by the MSYSTEM environment
+    variable.
+
+    With ``--jobs`` greater than one, the jobs are run in a pool of
+    worker processes. Each build uses its own temporary or output
+    tree, and its log messages are prefixed with the job's name.
+
+    """
+    jobs = max(1, options.jobs)
+    job_args = [
+        (spec_file, options, msystem)
+        for spec_file in spec_files
+        for msystem in msystems
+    ]
+    results = []
+    if jobs == 1 or len(job_args) == 1:
+        for args in job_args:
+            results.append(process_spec_job(*args))
+    else:
+        logger.info(
+            "Running %d jobs using %d worker processes…",
+            len(job_args), jobs,
+        )
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=init_logging,
+            initargs=(options,),
+        )
+        with pool:
+            futures = [pool.submit(process_spec_job, *a) for a in job_args]
+            for args, future in zip(job_args, futures):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    spec_file, options, msystem = args
+                    job_name = get_job_name(spec_file, msystem)
+                    logger.exception(
+                        "Worker process failed while running “%s”",
+                        job_name,
+                    )
+                    results.append((job_name, False))
+
+    failed = [name for (name, ok) in results if not ok]
+    if len(results) > 1:
+        logger.info(
+            "Ran %d jobs: %d succeeded, %d failed.",
+            len(results), len(results) - len(failed), len(failed),
+        )
+    for job_name in failed:
+        logger.error("Failed to build “%s”", job_name)
+    return failed
+
+
 # Startup:
 
 def main():
@@ -161,6 +365,8 @@ def main():
             and all output will be retained there, not copied out.
             The temporary bundle tree is kept too,
             for inspection and testing.
+            When the same output dir is used again,
+            build stages whose inputs have not changed are skipped.
 
             More: http://styrene.readthedocs.io/
         """).strip(),
@@ -205,6 +411,89 @@ def main():
         dest="build_zip",
         default=True,
     )
+    parser.add_option(
+        "--cache-dir",
+        help="where to keep caches (default: ~/.cache/styrene)",
+        metavar="DIR",
+        default=None,
+    )
+    parser.add_option(
+        "--cache-size",
+        help="size limit for each cache, in MiB (default: %d)" % (
+            DEFAULT_CACHE_SIZE,
+        ),
+        metavar="MB",
+        type="int",
+        default=DEFAULT_CACHE_SIZE,
+    )
+    parser.add_option(
+        "--no-cache",
+        help="do not use or update any caches",
+        action="store_false",
+        dest="use_cache",
+        default=True,
+    )
+    parser.add_option(
+        "--refresh",
+        help="refresh the shared sync databases, even if they are fresh",
+        action="store_true",
+        default=False,
+    )
+    parser.add_option(
+        "--sync-ttl",
+        help="refresh the shared sync databases if they are older "
+             "than MIN minutes (default: %d)" % (DEFAULT_SYNC_DB_TTL,),
+        metavar="MIN",
+        type="int",
+        default=DEFAULT_SYNC_DB_TTL,
+    )
+    parser.add_option(
+        "--installer",
+        help="how to install packages: %s (default: from the spec, "
+             "or pacman)" % ("/".join(INSTALLERS),),
+        metavar="NAME",
+        type="choice",
+        choices=list(INSTALLERS),
+        default=None,
+    )
+    parser.add_option(
+        "--pkg-store",
+        help="unpack packages once into the cache, and hardlink them "
+             "into bundle trees (implies --installer=native)",
+        action="store_true",
+        default=False,
+    )
+    parser.add_option(
+        "--rebuild",
+        help="run all build stages, even if their inputs are unchanged",
+        action="store_true",
+        default=False,
+    )
+    parser.add_option(
+        "--explain-delete",
+        help="report what each delete/nodelete pattern matched",
+        action="store_true",
+        default=False,
+    )
+    parser.add_option(
+        "--plan",
+        help="resolve packages and predict the bundle without building it",
+        action="store_true",
+        default=False,
+    )
+    parser.add_option(
+        "-j", "--jobs",
+        help="build up to N spec files or targets in parallel",
+        metavar="N",
+        type="int",
+        default=None,
+    )
+    parser.add_option(
+        "-m", "--msystem",
+        help="targets to build: MINGW64, MINGW32, a list, or “all”",
+        metavar="LIST",
+        default=None,
+    )
     parser.add_option(
         "--colour", "--color",
         help="colourize output: yes/no/auto",
@@ -217,48 +506,20 @@ def main():
         sys.exit(1)
 
     # Initialize logging
-    colourize = {
-        "yes".casefold(): True,
-        "no".casefold(): False,
-    }.get(options.colour.casefold(), sys.stderr.isatty())
-    if colourize:
-        log_format = (
-            "%(levelCol)s%(levelname)s: "
-            "%(bold)s%(name)s%(boldOff)s: "
-            "%(message)s%(reset)s"
-        )
-        console_formatter = ColorFormatter(log_format)
-    else:
-        log_format = "%(levelname)s: %(name)s: %(message)s"
-        console_formatter = logging.Formatter(log_format)
-    console_handler = logging.StreamHandler(stream=sys.stderr)
-    console_handler.setFormatter(console_formatter)
-    root_logger = logging.getLogger(None)
-    root_logger.addHandler(console_handler)
-    if options.quiet:
-        loglevel = logging.WARNING
-    elif options.debug:
-        loglevel = logging.DEBUG
-    else:
-        loglevel = logging.INFO
-    root_logger.setLevel(loglevel)
+    init_logging(options)
 
-    # Process bundles
-    for spec_file in args:
+    # Decide which targets to build for
+    msystems = [None]
+    if options.msystem:
         try:
-            spec = configparser.SafeConfigParser()
-            spec.read(spec_file, encoding="utf-8")
-        except Exception:
-            logger.exception(
-                "Failed to load bundle spec file “%s”",
-                spec_file,
-            )
-            sys.exit(2)
-        try:
-            process_spec_file(spec, options)
-        except Exception:
-            logger.exception(
-                "Unexpected error while processing “%s”",
-                spec_file,
-            )
-            sys.exit(2)
+            msystems = consts.MSYSTEM.from_list_str(options.msystem)
+        except ValueError:
+            logger.error("Cannot parse --msystem=%r", options.msystem)
+            sys.exit(1)
+    if options.jobs is None:
+        options.jobs = len(msystems)
+
+    # Process bundles
+    failed = run_jobs(args, options, msystems)
+    if failed:
+        sys.exit(2)
@@ -16,6 +16,8 @@
 # along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from .utils import find_msys2_root
+
 import enum
 import os
 import logging
@@ -74,6 +76,24 @@ class MSYSTEM (enum.Enum):
             logger.error("Not running in the correct MSYS2 environment.")
             raise
 
+    @classmethod
+    def from_list_str(cls, s):
+        """Get a list of MSYSTEM enum members from a string.
+
+        The string may be "all", or a comma-separated list of values
+        which can be parsed with from_str().
+
+        """
+        s = str(s).strip()
+        if s.casefold() == "all".casefold():
+            return list(cls.__members__.values())
+        members = []
+        for item in s.split(","):
+            member = cls.from_str(item.strip())
+            if member not in members:
+                members.append(member)
+        return members
+
     @classmethod
     def from_str(cls, s):
         """Get the MSYSTEM enum member for a string. Case-insensitive."""
@@ -123,6 +143,36 @@ class MSYSTEM (enum.Enum):
         """Name suffix for generated bundles."""
         return "-w%02d" % (self.bits,)
 
+    def environ(self, base=None):
+        """Environment for running this MSYSTEM's native build tools.
+
+        :param dict base: Environment to extend (default: os.environ).
+        :returns: A new environment dict.
+        :rtype: dict
+
+        The returned environment has MSYSTEM and its related variables
+        set as a login shell for this target would, and this target's
+        native bin folder first on the PATH. This allows builds for
+        different targets to run side by side from a single shell.
+
+        """
+        env = dict(os.environ if base is None else base)
+        prefix = "/" + self.subdir
+        env.update({
+            "MSYSTEM": self.value,
+            "MSYSTEM_PREFIX": prefix,
+            "MSYSTEM_CARCH": self.arch,
+            "MINGW_PREFIX": prefix,
+            "MINGW_PACKAGE_PREFIX": self.package_name_prefix.rstrip("-"),
+        })
+        msys2_root = find_msys2_root()
+        if msys2_root:
+            bin_dir = os.path.join(msys2_root, self.subdir, "bin")
+            if os.path.isdir(bin_dir):
+                path = env.get("PATH", "")
+                env["PATH"] = os.pathsep.join([bin_dir, path])
+        return env
+
     @property
     def substs(self):
         """Standard subsitution variables for templating."""
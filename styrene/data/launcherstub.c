@@ -2,7 +2,8 @@
  * Launcher stub - calls a bash script with its args, without a window.
  * Sometimes they're launched directly, if the command line is simple
  * enough for Windows.
- * One of these is compiled with an icon for each converted .desktop file.
+ * This is compiled once per bundle, then linked with an icon and a small
+ * data object holding the settings for each converted .desktop file.
  *
  * This source code, and any executable code generated from it,
  * is dedicated into the public domain, CC0 v1.0
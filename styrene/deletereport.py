@@ -0,0 +1,401 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Reports explaining what the delete and nodelete rules did."""
+
+from .inventory import TreeInventory
+from .matcher import GlobMatcher
+from .utils import format_size
+
+import os
+import stat
+import json
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+#: How many of the largest retained subtrees a report lists.
+LARGEST_RETAINED_COUNT = 20
+
+_REASON_NO_DELETE_RULE = "no-delete-rule"
+_REASON_KEEP = "keep"
+_REASON_OTHER = "other"
+
+
+# Class defs:
+
+class RuleStats:
+    """What a single delete or keep pattern matched.
+
+    A pattern matches a file if it matches the file's path, or the
+    path of a folder the file is inside. The same "." rules apply as
+    in find_surplus(), except that hidden files deleted along with a
+    matched folder count as matched. Files are counted once for every
+    pattern that matches them.
+
+    For a delete pattern, the matched files are split into those
+    which were removed, and those which were retained because a keep
+    pattern matched them too. For a keep pattern, the retained files
+    are the ones it saved: those which a delete pattern also matched.
+
+    """
+
+    def __init__(self, kind, pattern):
+        super().__init__()
+        self.kind = kind
+        self.pattern = pattern
+        self.entries = 0
+        self.files = 0
+        self.bytes = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self.retained_files = 0
+        self.retained_bytes = 0
+
+    def as_dict(self):
+        return {
+            "kind": self.kind,
+            "pattern": self.pattern,
+            "entries": self.entries,
+            "files": self.files,
+            "bytes": self.bytes,
+            "removed_files": self.removed_files,
+            "removed_bytes": self.removed_bytes,
+            "retained_files": self.retained_files,
+            "retained_bytes": self.retained_bytes,
+        }
+
+
+class DeleteReport:
+    """Attributes the files in a bundle tree to the rules that matched them.
+
+    The report covers each delete and keep (nodelete) pattern, the
+    patterns that match nothing at all, and the largest subtrees which
+    are left after deletion, with the reasons they were retained.
+    It can be written out as plain text, or as JSON.
+
+    """
+
+    def __init__(self, root, del_patterns, keep_patterns, surplus,
+                 inventory=None):
+        """Build the report by walking a tree.
+
+        :param str root: The folder the patterns are relative to.
+        :param list del_patterns: Glob patterns for things to delete.
+        :param list keep_patterns: Glob patterns for things to keep.
+        :param surplus: Paths to be deleted, from find_surplus().
+        :param .inventory.TreeInventory inventory: Index containing root.
+
+        The inventory must still describe the tree before deletion.
+        It is made by scanning the root if it isn't given.
+
+        """
+        super().__init__()
+        self.root = os.path.normpath(os.path.abspath(root))
+        if inventory is None:
+            inventory = TreeInventory(self.root)
+        self.delete_rules = [RuleStats("delete", p) for p in del_patterns]
+        self.keep_rules = [RuleStats("keep", p) for p in keep_patterns]
+        self.totals = RuleStats("total", None)
+        self.largest_retained = []
+        self._surplus = set(
+            os.path.normcase(os.path.relpath(p, self.root))
+            .replace(os.path.sep, "/")
+            for p in surplus
+        )
+        self._walk(inventory, del_patterns, keep_patterns)
+
+    @property
+    def unmatched_rules(self):
+        """The rules whose patterns match no files or folders."""
+        rules = self.delete_rules + self.keep_rules
+        return [r for r in rules if r.entries == 0]
+
+    def _walk(self, inventory, del_patterns, keep_patterns):
+        keep = GlobMatcher(keep_patterns)
+        delete = GlobMatcher(del_patterns)
+        largest = []
+
+        def _visit(relpath, inv_relpath, keep_state, kept_by,
+                   del_state, deleted_by, removed):
+            """Count a folder's contents.
+
+            Returns the number and size of the files retained inside
+            it, the size of its largest retained child folder, and the
+            retained bytes broken down by reason.
+
+            """
+            files = 0
+            size = 0
+            largest_child = 0
+            reasons = {}
+            for name, inv_child, info in inventory.iterdir(inv_relpath):
+                child = relpath + "/" + name if relpath else name
+                mode = info[1]
+                is_dir = stat.S_ISDIR(mode)
+                hidden = name.startswith(".")
+
+                child_removed = removed or (
+                    os.path.normcase(child) in self._surplus
+                )
+                # Hidden things go when their folder is removed whole,
+                # so charge them to the rules that removed it.
+                uninherited = hidden and not removed
+
+                child_keep_state = keep.step(keep_state, name, is_dir)
+                child_kept_by = _merge_matches(
+                    keep.matching(child_keep_state, is_dir),
+                    kept_by, uninherited,
+                    self.keep_rules,
+                )
+                child_del_state = delete.step(del_state, name, is_dir)
+                child_deleted_by = _merge_matches(
+                    delete.matching(child_del_state, is_dir),
+                    deleted_by, uninherited,
+                    self.delete_rules,
+                )
+
+                if is_dir:
+                    sub_files, sub_size, sub_largest, sub_reasons = _visit(
+                        child, inv_child,
+                        child_keep_state, child_kept_by,
+                        child_del_state, child_deleted_by,
+                        child_removed,
+                    )
+                    if sub_size and sub_largest * 2 <= sub_size:
+                        item = (sub_size, child, sub_files, sub_reasons)
+                        if len(largest) < LARGEST_RETAINED_COUNT:
+                            heapq.heappush(largest, item)
+                        else:
+                            heapq.heappushpop(largest, item)
+                    files += sub_files
+                    size += sub_size
+                    largest_child = max(largest_child, sub_size)
+                    for reason, nbytes in sub_reasons.items():
+                        reasons[reason] = reasons.get(reason, 0) + nbytes
+                elif stat.S_ISREG(mode):
+                    file_size = info[0]
+                    self._count(
+                        file_size, child_removed,
+                        child_kept_by, child_deleted_by,
+                    )
+                    if not child_removed:
+                        files += 1
+                        size += file_size
+                        if child_kept_by:
+                            reason = (_REASON_KEEP, child_kept_by[0])
+                        elif not child_deleted_by:
+                            reason = (_REASON_NO_DELETE_RULE, None)
+                        else:
+                            reason = (_REASON_OTHER, None)
+                        reasons[reason] = reasons.get(reason, 0) + file_size
+            return (files, size, largest_child, reasons)
+
+        root_relpath = inventory.relpath(self.root)
+        _visit(
+            "", root_relpath,
+            keep.start, keep.matching(keep.start, True),
+            delete.start, delete.matching(delete.start, True),
+            False,
+        )
+        self.largest_retained = sorted(largest, reverse=True)
+
+    def _count(self, size, removed, kept_by, deleted_by):
+        """Count a regular file against the totals and its rules."""
+        totals = self.totals
+        totals.files += 1
+        totals.bytes += size
+        if removed:
+            totals.removed_files += 1
+            totals.removed_bytes += size
+        else:
+            totals.retained_files += 1
+            totals.retained_bytes += size
+        for pi in kept_by:
+            rule = self.keep_rules[pi]
+            rule.files += 1
+            rule.bytes += size
+            if removed:
+                rule.removed_files += 1
+                rule.removed_bytes += size
+            elif deleted_by:
+                rule.retained_files += 1
+                rule.retained_bytes += size
+        for pi in deleted_by:
+            rule = self.delete_rules[pi]
+            rule.files += 1
+            rule.bytes += size
+            if removed:
+                rule.removed_files += 1
+                rule.removed_bytes += size
+            else:
+                rule.retained_files += 1
+                rule.retained_bytes += size
+
+    def _reason_label(self, reason):
+        kind, pi = reason
+        if kind == _REASON_KEEP:
+            return "kept by nodelete “%s”" % (self.keep_rules[pi].pattern,)
+        elif kind == _REASON_NO_DELETE_RULE:
+            return "not matched by any delete rule"
+        return "inside a folder with kept contents"
+
+    # Output:
+
+    def as_json(self):
+        """The report as a JSON-serializable dict."""
+        subtrees = []
+        for size, relpath, files, reasons in self.largest_retained:
+            retained_by = []
+            for reason, nbytes in _sorted_reasons(reasons):
+                kind, pi = reason
+                pattern = None
+                if kind == _REASON_KEEP:
+                    pattern = self.keep_rules[pi].pattern
+                retained_by.append({
+                    "reason": kind,
+                    "pattern": pattern,
+                    "bytes": nbytes,
+                })
+            subtrees.append({
+                "path": relpath,
+                "files": files,
+                "bytes": size,
+                "retained_by": retained_by,
+            })
+        totals = self.totals.as_dict()
+        del totals["kind"], totals["pattern"], totals["entries"]
+        return {
+            "root": self.root,
+            "totals": totals,
+            "delete_rules": [r.as_dict() for r in self.delete_rules],
+            "keep_rules": [r.as_dict() for r in self.keep_rules],
+            "unmatched_rules": [
+                {"kind": r.kind, "pattern": r.pattern}
+                for r in self.unmatched_rules
+            ],
+            "largest_retained": subtrees,
+        }
+
+    def write_json(self, fp):
+        """Write the report to a text file, as JSON."""
+        json.dump(self.as_json(), fp, indent=2)
+        fp.write("\n")
+
+    def write_text(self, fp):
+        """Write the report to a text file, for reading."""
+        totals = self.totals
+
+        def _p(*args):
+            print(*args, file=fp)
+
+        _p("Delete rule report for “%s”" % (self.root,))
+        _p()
+        _p("Files: %d, %s" % (totals.files, format_size(totals.bytes)))
+        _p("Removed: %d, %s" % (
+            totals.removed_files, format_size(totals.removed_bytes),
+        ))
+        _p("Retained: %d, %s" % (
+            totals.retained_files, format_size(totals.retained_bytes),
+        ))
+
+        row = "{:>8} {:>10}  {:>8} {:>10}  {:>8} {:>10}  {}"
+        for title, rules, heading in [
+            ("Delete rules", self.delete_rules, "RETAINED"),
+            ("Nodelete rules", self.keep_rules, "SAVED"),
+        ]:
+            _p()
+            _p("%s:" % (title,))
+            if not rules:
+                _p("    (none)")
+                continue
+            _p(row.format(
+                "MATCHED", "", "REMOVED", "", heading, "", "PATTERN",
+            ))
+            for rule in rules:
+                _p(row.format(
+                    rule.files, format_size(rule.bytes),
+                    rule.removed_files, format_size(rule.removed_bytes),
+                    rule.retained_files, format_size(rule.retained_bytes),
+                    rule.pattern,
+                ))
+
+        _p()
+        _p("Patterns that match nothing:")
+        unmatched = self.unmatched_rules
+        for rule in unmatched:
+            kind = "nodelete" if rule.kind == "keep" else rule.kind
+            _p("    %-8s  %s" % (kind, rule.pattern))
+        if not unmatched:
+            _p("    (none)")
+
+        _p()
+        _p("Largest retained subtrees:")
+        for size, relpath, files, reasons in self.largest_retained:
+            _p("{:>10}  {:>8} files  {}".format(
+                format_size(size), files, relpath,
+            ))
+            for reason, nbytes in _sorted_reasons(reasons):
+                _p("{:>22}  {}".format(
+                    format_size(nbytes), self._reason_label(reason),
+                ))
+        if not self.largest_retained:
+            _p("    (none)")
+
+    def log_summary(self):
+        """Log the headline figures, and warn about unmatched patterns."""
+        mib = 1024.0 * 1024.0
+        logger.info(
+            "delete rules: removing %d files (%.1f MiB), "
+            "retaining %d files (%.1f MiB)",
+            self.totals.removed_files, self.totals.removed_bytes / mib,
+            self.totals.retained_files, self.totals.retained_bytes / mib,
+        )
+        for rule in self.unmatched_rules:
+            kind = "nodelete" if rule.kind == "keep" else rule.kind
+            logger.warning(
+                "%s pattern “%s” matches nothing",
+                kind, rule.pattern,
+            )
+
+
+# Helper funcs:
+
+def _merge_matches(direct, inherited, uninherited, rules):
+    """Combine the patterns matching an entry and its parent folder.
+
+    Folder contents are what a "**" glob would match, so names
+    starting with "." don't normally inherit matches. The direct
+    matches come first, then the inherited ones, innermost first.
+
+    """
+    for pi in direct:
+        rules[pi].entries += 1
+    if uninherited or not inherited:
+        return direct
+    if not direct:
+        return inherited
+    return direct + [pi for pi in inherited if pi not in direct]
+
+
+def _sorted_reasons(reasons):
+    return sorted(reasons.items(), key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,160 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Index of the icons installed in a bundle's icon themes."""
+
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+#: Themes searched for launcher icons, most preferred first.
+ICON_THEMES = ("Adwaita", "hicolor")
+
+#: Size keys for the themes' scalable and symbolic folders.
+SCALABLE = "scalable"
+SYMBOLIC = "symbolic"
+
+_FIXED_SIZE_DIR_RE = re.compile(r"^(\d+)x\1$")
+
+#: Image types indexed for each kind of theme folder.
+_FIXED_SIZE_EXTENSIONS = (".png",)
+_VECTOR_EXTENSIONS = (".svg", ".png")
+
+
+# Class defs:
+
+class IconThemeIndex:
+    """The icons in some installed themes, by name and size.
+
+    Looking up icons by globbing the themes once per size and icon is
+    slow when whole themes are kept in the bundle. The index is made
+    with one scan of each theme's size and context folders instead,
+    and maps each icon name to a dict of {size: path}.
+
+    Sizes are ints for the fixed-size "NxN" folders, which hold PNGs.
+    The "scalable" and "symbolic" folders are indexed under the
+    SCALABLE and SYMBOLIC keys. Where several themes or contexts have
+    the same icon at the same size, the first theme in the list wins,
+    then the first context in sorted order.
+
+    """
+
+    def __init__(self, root, subdir, themes=ICON_THEMES, inventory=None):
+        """Index the icon themes in a bundle tree.
+
+        :param str root: Bundle root directory.
+        :param str subdir: Prefix the themes are under, e.g. "mingw64".
+        :param list themes: Names of themes to index, preferred first.
+        :param .inventory.TreeInventory inventory: Index of the bundle.
+
+        If an inventory is given, the filesystem is not touched.
+
+        """
+        super().__init__()
+        self.root = root
+        self.themes = tuple(themes)
+        self._inventory = inventory
+        self._icons = {}
+        for theme in self.themes:
+            self._scan_theme("/".join([subdir, "share", "icons", theme]))
+        logger.debug(
+            "icons: indexed %d icons in %d themes",
+            len(self._icons), len(self.themes),
+        )
+
+    def __len__(self):
+        return len(self._icons)
+
+    def __contains__(self, name):
+        return name in self._icons
+
+    def get(self, name):
+        """The sizes and paths of a named icon.
+
+        :param str name: Icon name, as in a desktop file's Icon= key.
+        :returns: A new dict of {size: path}, empty if not found.
+        :rtype: dict
+
+        """
+        return dict(self._icons.get(name, {}))
+
+    def find(self, name, size):
+        """The path to a named icon at one size, or None."""
+        return self._icons.get(name, {}).get(size)
+
+    def fixed_sizes(self, name):
+        """The PNGs of a named icon, as a sorted list of (size, path)."""
+        return sorted(
+            (size, path)
+            for (size, path) in self._icons.get(name, {}).items()
+            if isinstance(size, int)
+        )
+
+    # Scanning:
+
+    def _scan_theme(self, theme_relpath):
+        for size_name, is_dir in self._listdir(theme_relpath):
+            if not is_dir:
+                continue
+            if size_name in (SCALABLE, SYMBOLIC):
+                size = size_name
+                extensions = _VECTOR_EXTENSIONS
+            else:
+                match = _FIXED_SIZE_DIR_RE.match(size_name)
+                if not match:
+                    continue
+                size = int(match.group(1))
+                extensions = _FIXED_SIZE_EXTENSIONS
+            size_relpath = theme_relpath + "/" + size_name
+            contexts = sorted(
+                name for (name, is_dir) in self._listdir(size_relpath)
+                if is_dir
+            )
+            for context in contexts:
+                context_relpath = size_relpath + "/" + context
+                entries = sorted(self._listdir(context_relpath))
+                for filename, is_dir in entries:
+                    name, ext = os.path.splitext(filename)
+                    if is_dir or ext.lower() not in extensions:
+                        continue
+                    sizes = self._icons.setdefault(name, {})
+                    if size in sizes:
+                        continue
+                    sizes[size] = os.path.join(
+                        self.root,
+                        *(context_relpath + "/" + filename).split("/")
+                    )
+
+    def _listdir(self, relpath):
+        """Iterate over (name, is_dir) for a folder's entries."""
+        if self._inventory is not None:
+            for name, child, info in self._inventory.iterdir(relpath):
+                yield (name, self._inventory.isdir(child))
+            return
+        path = os.path.join(self.root, *relpath.split("/"))
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    yield (entry.name, entry.is_dir())
+        except OSError:
+            return
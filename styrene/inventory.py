@@ -0,0 +1,415 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Index of the files in a bundle tree, shared between build stages."""
+
+import os
+import re
+import stat
+import fnmatch
+import posixpath
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+_MAGIC_CHECK = re.compile(r"[*?[]")
+
+#: True if the OS's filenames are compared case-insensitively.
+_CASE_INSENSITIVE = (os.path.normcase("A") == os.path.normcase("a"))
+
+
+# Class defs:
+
+class TreeInventory:
+    """The files and folders in a tree, with their size, mode, and mtime.
+
+    Stat calls are slow on Windows, and several stages need to know
+    what's in the bundle tree. An inventory is built by walking the
+    tree once with os.scandir(), and then consulted instead of the
+    filesystem. Code which changes the tree must keep the inventory
+    up to date by calling refresh() or remove().
+
+    Entries are keyed by their path relative to the root, with "/"
+    separators. The root itself has the relative path "". Each entry
+    is a tuple: (size, mode, mtime). Symlinks are followed.
+
+    """
+
+    def __init__(self, root):
+        """Initialize by scanning a tree.
+
+        :param str root: The tree to scan.
+
+        """
+        super().__init__()
+        self.root = os.path.normpath(root)
+        self._entries = {}
+        self._children = {}
+        self.refresh("")
+        logger.debug(
+            "inventory: %d entries in “%s”",
+            len(self._entries) - 1, self.root,
+        )
+
+    @classmethod
+    def from_entries(cls, root, entries):
+        """Make an inventory from a list, instead of by scanning.
+
+        :param str root: The tree's root. It needn't exist.
+        :param iterable entries: (relpath, size, mode) tuples.
+        :returns: A new inventory.
+        :rtype: TreeInventory
+
+        Parent folders which aren't listed are added. This is useful
+        for predicting what the build stages will do to a tree.
+
+        """
+        inventory = cls.__new__(cls)
+        inventory.root = os.path.normpath(root)
+        inventory._entries = {}
+        inventory._children = {}
+        dir_info = (0, stat.S_IFDIR | 0o755, 0)
+        inventory._add_info("", dir_info)
+        for relpath, size, mode in entries:
+            relpath = "/".join(p for p in relpath.split("/") if p)
+            if not relpath:
+                continue
+            parent = posixpath.dirname(relpath)
+            missing = []
+            while parent not in inventory._entries:
+                missing.append(parent)
+                parent = posixpath.dirname(parent)
+            for parent in reversed(missing):
+                inventory._add_info(parent, dir_info)
+            inventory._add_info(relpath, (size, mode, 0))
+        return inventory
+
+    # Paths:
+
+    def abspath(self, relpath):
+        """Convert a relative path to a filesystem path."""
+        if not relpath:
+            return self.root
+        return os.path.join(self.root, *relpath.split("/"))
+
+    def relpath(self, path):
+        """Convert a filesystem path inside the tree to a relative path."""
+        relpath = os.path.relpath(path, self.root)
+        if relpath == os.curdir:
+            return ""
+        return relpath.replace(os.path.sep, "/")
+
+    def _lookup(self, relpath):
+        """Find the indexed form of a relative path, or None.
+
+        Empty path components are ignored, as they are by the OS.
+        On Windows, the lookup ignores case.
+
+        """
+        relpath = "/".join(p for p in relpath.split("/") if p)
+        if relpath in self._entries:
+            return relpath
+        if not _CASE_INSENSITIVE or not relpath:
+            return None
+        parent, name = posixpath.split(relpath)
+        parent = self._lookup(parent)
+        if parent is None:
+            return None
+        name = os.path.normcase(name)
+        for child in self._children.get(parent, ()):
+            if os.path.normcase(child) == name:
+                return posixpath.join(parent, child) if parent else child
+        return None
+
+    # Queries:
+
+    def get(self, relpath):
+        """Get the (size, mode, mtime) of an entry, or None."""
+        relpath = self._lookup(relpath)
+        if relpath is None:
+            return None
+        return self._entries[relpath]
+
+    def __contains__(self, relpath):
+        return self._lookup(relpath) is not None
+
+    def __len__(self):
+        return len(self._entries) - 1
+
+    def isdir(self, relpath):
+        info = self.get(relpath)
+        return info is not None and stat.S_ISDIR(info[1])
+
+    def isfile(self, relpath):
+        info = self.get(relpath)
+        return info is not None and stat.S_ISREG(info[1])
+
+    def listdir(self, relpath=""):
+        """The sorted names of a folder's entries."""
+        relpath = self._lookup(relpath)
+        if relpath is None:
+            return []
+        return sorted(self._children.get(relpath, ()))
+
+    def iterdir(self, relpath=""):
+        """Iterate over a folder's entries, in no particular order.
+
+        :param str relpath: The folder to list.
+        :returns: Iterator yielding (name, relpath, (size, mode, mtime)).
+
+        """
+        relpath = self._lookup(relpath)
+        if relpath is None:
+            return
+        prefix = relpath + "/" if relpath else ""
+        entries = self._entries
+        for name in self._children.get(relpath, ()):
+            child = prefix + name
+            yield (name, child, entries[child])
+
+    def walk(self, relpath=""):
+        """Iterate over everything inside a folder, top-down.
+
+        :param str relpath: The folder to start from.
+        :returns: Iterator yielding (relpath, (size, mode, mtime)).
+
+        Each folder comes before its contents, and the names in each
+        folder are sorted. The starting folder is not included.
+
+        """
+        start = self._lookup(relpath)
+        if start is None:
+            return
+        stack = [start]
+        while stack:
+            dir_relpath = stack.pop()
+            names = sorted(self._children.get(dir_relpath, ()), reverse=True)
+            for name in names:
+                child = posixpath.join(dir_relpath, name) \
+                    if dir_relpath else name
+                stack.append(child)
+            if dir_relpath != start:
+                yield (dir_relpath, self._entries[dir_relpath])
+
+    def total_size(self, relpath=""):
+        """Total size of the regular files in a folder, in bytes."""
+        total = 0
+        for child, (size, mode, mtime) in self.walk(relpath):
+            if stat.S_ISREG(mode):
+                total += size
+        return total
+
+    def glob(self, pattern):
+        """Find the entries matching a glob pattern.
+
+        :param str pattern: Glob pattern, relative to the root.
+        :returns: Matching relative paths, in sorted order.
+        :rtype: list
+
+        The matching rules are those of glob.glob() with
+        recursive=True, and the results are the same, apart from
+        their order and normalization. The filesystem is not touched.
+
+        """
+        if os.path.sep != "/":
+            pattern = pattern.replace(os.path.sep, "/")
+        pattern = pattern.lstrip("/")
+        results = set()
+        for path in self._iglob(pattern, False):
+            real = self._lookup(path)
+            if real is None:
+                # glob.glob() yields things like "missing/" for
+                # "missing/**", and they have to be kept.
+                real = "/".join(p for p in path.split("/") if p)
+            results.add(real)
+        return sorted(results)
+
+    # Updates:
+
+    def refresh(self, relpath):
+        """Rescan a file or folder after it has changed on disk.
+
+        :param str relpath: What to rescan, relative to the root.
+
+        If the item no longer exists, it is removed from the index.
+        Folders are rescanned recursively, and any unindexed parent
+        folders are indexed.
+
+        """
+        relpath = "/".join(p for p in relpath.split("/") if p)
+        self.remove(relpath)
+        path = self.abspath(relpath)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if relpath:
+            parent = posixpath.dirname(relpath)
+            if parent not in self._entries:
+                self.refresh(parent)
+                return
+        self._add(relpath, st)
+        if stat.S_ISDIR(st.st_mode):
+            self._scan(relpath)
+
+    def remove(self, relpath):
+        """Forget a file or folder, and everything inside it."""
+        relpath = self._lookup(relpath)
+        if relpath is None:
+            return
+        stack = [relpath]
+        while stack:
+            item = stack.pop()
+            self._entries.pop(item, None)
+            for name in self._children.pop(item, ()):
+                stack.append(posixpath.join(item, name) if item else name)
+        if relpath:
+            parent, name = posixpath.split(relpath)
+            self._children.get(parent, set()).discard(name)
+
+    def set_mode(self, relpath, mode):
+        """Record a new mode for an entry, after a chmod."""
+        relpath = self._lookup(relpath)
+        if relpath is None:
+            return
+        size, old_mode, mtime = self._entries[relpath]
+        self._entries[relpath] = (size, mode, mtime)
+
+    def _add(self, relpath, st):
+        self._add_info(relpath, (st.st_size, st.st_mode, st.st_mtime))
+
+    def _add_info(self, relpath, info):
+        self._entries[relpath] = info
+        if stat.S_ISDIR(info[1]):
+            self._children.setdefault(relpath, set())
+        if relpath:
+            parent, name = posixpath.split(relpath)
+            self._children.setdefault(parent, set()).add(name)
+
+    def _scan(self, relpath):
+        """Index the contents of a folder, recursively."""
+        stack = [relpath]
+        while stack:
+            dir_relpath = stack.pop()
+            dir_path = self.abspath(dir_relpath)
+            try:
+                it = os.scandir(dir_path)
+            except OSError:
+                logger.warning("inventory: cannot list “%s”", dir_path)
+                continue
+            with it:
+                for entry in it:
+                    child = posixpath.join(dir_relpath, entry.name) \
+                        if dir_relpath else entry.name
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        st = entry.stat(follow_symlinks=False)
+                    self._add(child, st)
+                    if not stat.S_ISDIR(st.st_mode):
+                        continue
+                    if entry.is_symlink() and _is_loop(entry.path):
+                        continue
+                    stack.append(child)
+
+    # Globbing. These mirror the private helpers in the glob module,
+    # but they consult the index rather than the filesystem.
+
+    def _iglob(self, pathname, dironly):
+        dirname, basename = posixpath.split(pathname)
+        if not _has_magic(pathname):
+            if basename:
+                if self._lookup(pathname) is not None:
+                    yield pathname
+            elif self.isdir(dirname):
+                yield pathname
+            return
+        if dirname and dirname != pathname and _has_magic(dirname):
+            dirs = self._iglob(dirname, True)
+        else:
+            dirs = [dirname]
+        if _has_magic(basename):
+            if basename == "**":
+                glob_in_dir = self._glob2
+            else:
+                glob_in_dir = self._glob1
+        else:
+            glob_in_dir = self._glob0
+        for dirname in dirs:
+            for name in glob_in_dir(dirname, basename, dironly):
+                yield posixpath.join(dirname, name)
+
+    def _glob0(self, dirname, basename, dironly):
+        if basename:
+            if self._lookup(posixpath.join(dirname, basename)) is not None:
+                return [basename]
+        elif self.isdir(dirname):
+            return [basename]
+        return []
+
+    def _glob1(self, dirname, pattern, dironly):
+        names = self._listdir(dirname, dironly)
+        if not _is_hidden(pattern):
+            names = [x for x in names if not _is_hidden(x)]
+        return fnmatch.filter(names, pattern)
+
+    def _glob2(self, dirname, pattern, dironly):
+        yield ""
+        yield from self._rlistdir(dirname, dironly)
+
+    def _rlistdir(self, dirname, dironly):
+        for x in self._listdir(dirname, dironly):
+            if not _is_hidden(x):
+                yield x
+                path = posixpath.join(dirname, x) if dirname else x
+                for y in self._rlistdir(path, dironly):
+                    yield posixpath.join(x, y)
+
+    def _listdir(self, dirname, dironly):
+        dirname = self._lookup(dirname)
+        if dirname is None:
+            return []
+        names = sorted(self._children.get(dirname, ()))
+        if dironly:
+            names = [
+                n for n in names
+                if stat.S_ISDIR(self._entries[
+                    posixpath.join(dirname, n) if dirname else n
+                ][1])
+            ]
+        return names
+
+
+# Helper funcs:
+
+def _has_magic(s):
+    return _MAGIC_CHECK.search(s) is not None
+
+
+def _is_hidden(name):
+    return name.startswith(".")
+
+
+def _is_loop(path):
+    """True if a symlinked folder points at itself or an ancestor."""
+    target = os.path.realpath(path)
+    parent = os.path.realpath(os.path.dirname(path))
+    return (parent + os.path.sep).startswith(target + os.path.sep)
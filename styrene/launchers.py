@@ -26,6 +26,8 @@ from .utils import findexe
 from .utils import nsis_escape
 from .utils import boolify
 from .utils import winsafe_filename
+from .icons import IconThemeIndex
+from .stages import file_digest
 from . import consts
 
 import re
@@ -35,6 +37,9 @@ import glob
 import struct
 import tempfile
 import shutil
+import hashlib
+import functools
+import threading
 from textwrap import dedent
 import subprocess
 import xml.etree.ElementTree as ET
@@ -43,6 +48,16 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Consts:
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_HEADER_SIZE = 24   # signature, then IHDR's length, type, w, and h
+
+#: Prefix for .ico cache keys. Change it if write_ico_file()'s output
+#: changes for the same input.
+_ICO_CACHE_KEY_PREFIX = b"styrene-ico-1\n"
+
+
 # Class defs:
 
 class DesktopEntry:
@@ -82,6 +97,11 @@ class DesktopEntry:
     def __repr__(self):
         return "<DesktopEntry %r>" % (self._basename,)
 
+    @property
+    def icon(self):
+        """The name of the launcher's icon, or an empty string."""
+        return self._icon
+
     # Construction:
 
     def update_from_desktop_file(self, filename):
@@ -208,14 +228,23 @@ class DesktopEntry:
 
     # Actions:
 
-    def install_icon(self, root, msystem):
+    def install_icon(self, root, msystem, inventory=None, icon_index=None,
+                     cache=None):
         """Convert and install .ico icons.
 
         :param str root: Bundle root directory.
         :param consts.MSYSTEM msystem: The MSYSTEM to search.
+        :param .inventory.TreeInventory inventory: Index of the bundle.
+        :param .icons.IconThemeIndex icon_index: Index of the bundle's
+            icon themes. One is made if this isn't given.
+        :param .cache.FileCache cache: Cache of converted icons.
         :returns: the icon basename minus extension, or None if failed
         :rtype: str
 
+        If a cache is given, the source PNGs are hashed to make a key
+        for it, and a cached .ico file is reused instead of being
+        written again.
+
         """
         icon = self._icon
         if not icon:
@@ -223,33 +252,35 @@ class DesktopEntry:
         if os.path.isabs(icon):
             return None
 
-        prefix = os.path.join(root, msystem.subdir)
+        if icon_index is None:
+            icon_index = IconThemeIndex(
+                root, msystem.subdir,
+                inventory=inventory,
+            )
         outdir = os.path.join(root, consts.ICO_FILE_SUBDIR)
 
         pngfile_infos = []
-        for i in range(2, 33):
-            match = None
-            for theme in ["Adwaita", "hicolor"]:
-                patt = "share/icons/{theme}/{s}x{s}/*/{icon}.png"
-                patt = patt.format(
-                    theme=theme,
-                    s=(i * 8),
-                    icon=icon,
-                )
-                patt = os.path.join(prefix, patt)
-                for m in glob.glob(patt):
-                    logger.debug("icon: using “%s”", m)
-                    match = m
-                    break
-                if match:
-                    break
-            if match:
-                pngfile_infos.append((i * 8, i * 8, match))
+        for s, path in icon_index.fixed_sizes(icon):
+            if s < 16 or s > 256 or s % 8 != 0:
+                continue
+            logger.debug("icon: using “%s”", path)
+            pngfile_infos.append((s, s, path))
 
         if pngfile_infos:
             os.makedirs(outdir, exist_ok=True)
             ico_path = os.path.join(outdir, "%s.ico" % (icon,))
+            cache_key = None
+            if cache is not None:
+                h = hashlib.sha256(_ICO_CACHE_KEY_PREFIX)
+                for size, _, path in pngfile_infos:
+                    h.update(("%d %s\n" % (size, file_digest(path))).encode())
+                cache_key = h.hexdigest()
+                if cache.fetch(cache_key, ico_path):
+                    logger.debug("icon: using cached “%s.ico”", icon)
+                    return icon
             write_ico_file(ico_path, pngfile_infos)
+            if cache_key:
+                cache.put(cache_key, ico_path)
             if not os.path.isfile(ico_path):
                 logger.error("Failed to create %r", ico_path)
             else:
@@ -257,33 +288,49 @@ class DesktopEntry:
 
         return None
 
-    def write_exe_launcher(self, root, bundle):
+    def write_exe_launcher(self, root, bundle, stub=None, cache=None,
+                           log=logger):
         """Compile and install a launcher .exe
 
         :param str root: Output folder path for the executable.
         :param .bundle.NativeBundle bundle: The bundle being built.
+        :param LauncherStub stub: Shared launcher stub code.
+        :param .cache.FileCache cache: Cache of built launchers.
+        :param log: Where to log messages (a Logger or BufferedLogger).
+        :raises subprocess.CalledProcessError: if compilation fails.
+
+        The launcher stub is the same for every launcher in a bundle,
+        so it can be compiled just once and shared via a LauncherStub.
+        Each launcher's own settings are compiled into a tiny separate
+        object file, which is linked with the stub and the icon.
+        If no stub is given, the stub is compiled here.
+
+        A built launcher is completely determined by its settings, the
+        stub code, the icon, and the versions of the build tools.
+        If a cache is given, these are hashed to make a key for it,
+        and cached launchers are reused instead of being rebuilt.
+
+        This method is safe to call for several launchers at once from
+        different threads. Each call compiles in its own temp folder.
+        The output of the compiler tools is logged as debug messages,
+        or attached to the exception raised if a tool fails.
 
         """
         app_id = self.get_app_id(bundle)
-        postinst_sh = os.path.join(consts.SCRIPTS_SUBDIR, "postinst.sh")
 
         exe_basename = self._basename + ".exe"
         final_exe_path = os.path.join(root, exe_basename)
-        logger.info("Building launcher “%s”…", exe_basename)
-        data_dir = os.path.join(
-            os.path.dirname(__file__),
-            consts.PACKAGE_DATA_SUBDIR,
-        )
+        log.info("Building launcher “%s”…", exe_basename)
 
         # Decide if the launcher should be invoking bash to parse the
         # command line.
         use_helper = True
         resolved_exe = ""
-        logger.debug("%s: cmdline: %r", self._basename, self._cmdline)
+        log.debug("%s: cmdline: %r", self._basename, self._cmdline)
         prefix = os.path.join(root, bundle.msystem.subdir)
         exe = self._cmdline[0]
         exe, args = self._resolve_exe(prefix)
-        logger.debug(
+        log.debug(
             "%s: resolved exe: %r, args: %r",
             self._basename, exe, args,
         )
@@ -293,13 +340,13 @@ class DesktopEntry:
                 resolved_exe = exe
 
         if not use_helper:
-            logger.info(
+            log.info(
                 "Launcher %s will directly invoke “%s”",
                 self._basename,
                 resolved_exe,
             )
         elif self._terminal:
-            logger.info(
+            log.info(
                 "Launcher %s will use bash to invoke %r in a visible window "
                 "and then wait, because %s specifies “Terminal: true”.",
                 self._basename,
@@ -307,7 +354,7 @@ class DesktopEntry:
                 "%s.desktop" % (self._basename,),
             )
         elif self._force_helper:
-            logger.info(
+            log.info(
                 "Launcher %s will use bash to invoke %r in a hidden window "
                 "because %s specifies “StyreneLaunchUsingShell: true”.",
                 self._basename,
@@ -315,112 +362,149 @@ class DesktopEntry:
                 "%s.desktop" % (self._basename,),
             )
         else:
-            logger.warning(
+            log.warning(
                 "Launcher %s needs to use bash to launch %r "
                 "despite %s being “Terminal: false”.",
                 self._basename,
                 self._cmdline,
                 "%s.desktop" % (self._basename,),
             )
-            logger.info(
+            log.info(
                 "It may be possible to override %s’s Exec line "
                 "so that it launches a .exe for the main process. "
                 "The user experience may be slightly better if you can.",
                 self._basename,
             )
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            logger.debug("tmpdir: %r", tmpdir)
-            objects = []
-            config_h_path = os.path.join(tmpdir, "config.h")
-
-            with open(config_h_path, "w", encoding="utf-8") as fp:
-                config_h = dedent("""
-                    #ifndef HAVE_CONFIG_H
-                    #define HAVE_CONFIG_H
-
-                    #define LAUNCHER_POSTINST L"{postinst_sh}"
-                    #define LAUNCHER_USE_HELPER {use_helper}
+        data_c = dedent("""
+            #include <windows.h>
 
-                    const BOOL LAUNCHER_USE_TERMINAL = {use_terminal};
-                    LPCWSTR LAUNCHER_RESOLVED_EXE = L"{resolved_exe}";
-                    LPCWSTR LAUNCHER_APP_ID = L"{app_id}";
-                    LPCWSTR LAUNCHER_LOCATION_STATE_FILE = L"{state_file}";
+            const BOOL LAUNCHER_USE_HELPER = {use_helper};
+            const BOOL LAUNCHER_USE_TERMINAL = {use_terminal};
+            LPCWSTR LAUNCHER_RESOLVED_EXE = L"{resolved_exe}";
+            LPCWSTR LAUNCHER_APP_ID = L"{app_id}";
 
-                    const WCHAR *LAUNCHER_CMDLINE_TEMPLATE[] =
-                """).format(
-                    postinst_sh=c_escape(postinst_sh),
-                    use_terminal=int(self._terminal),
-                    use_helper=int(use_helper),
-                    app_id=c_escape(app_id),
-                    resolved_exe=c_escape(resolved_exe),
-                    state_file=c_escape(consts.LAUNCHER_LOCATION_STATE_FILE),
-                )
+            const WCHAR *LAUNCHER_CMDLINE_TEMPLATE[] =
+        """).format(
+            use_terminal=int(self._terminal),
+            use_helper=int(use_helper),
+            app_id=c_escape(app_id),
+            resolved_exe=c_escape(resolved_exe),
+        )
+        data_c += "{\n"
+        for s in self._cmdline:
+            data_c += 'L"%s",\n' % (c_escape(s),)
+        data_c += "NULL\n};\n"
+
+        orig_ico_path = None
+        if self._icon:
+            orig_ico_path = os.path.join(
+                root, consts.ICO_FILE_SUBDIR,
+                "%s.ico" % (self._icon,),
+            )
+            if not os.path.exists(orig_ico_path):
+                orig_ico_path = None
 
-                config_h += "{\n"
-                for s in self._cmdline:
-                    config_h += 'L"%s",\n' % (c_escape(s),)
-                config_h += "NULL\n};\n"
-
-                config_h += dedent("""
-                    #endif // HAVE_CONFIG_H
-                """)
-                print(config_h, file=fp)
-
-            orig_c_path = os.path.join(data_dir, "launcherstub.c")
-            c_basename = self._basename + ".c"
-            c_path = os.path.join(tmpdir, c_basename)
-            shutil.copy(orig_c_path, c_path)
-            subprocess.check_call(
-                ["gcc", "-municode", "-std=c11", "-c", c_basename],
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log.debug("tmpdir: %r", tmpdir)
+            objects = []
+            if stub is None:
+                stub = LauncherStub(tmpdir)
+
+            cache_key = None
+            if cache is not None:
+                h = hashlib.sha256()
+                h.update(stub.digest.encode("utf-8"))
+                h.update(data_c.encode("utf-8"))
+                if orig_ico_path:
+                    with open(orig_ico_path, "rb") as ico_fp:
+                        h.update(ico_fp.read())
+                cache_key = h.hexdigest()
+                if cache.fetch(cache_key, final_exe_path):
+                    log.info("Using cached build of “%s”", exe_basename)
+                    return
+
+            objects.append(os.path.abspath(stub.get_object(log=log)))
+
+            data_c_basename = self._basename + "-data.c"
+            data_c_path = os.path.join(tmpdir, data_c_basename)
+            with open(data_c_path, "w", encoding="utf-8") as fp:
+                print(data_c, file=fp)
+            _run_build_tool(
+                ["gcc", "-municode", "-std=c11", "-c", data_c_basename],
                 cwd=tmpdir,
+                log=log,
             )
-            o_basename = self._basename + ".o"
-            o_path = os.path.join(tmpdir, o_basename)
-            assert os.path.exists(o_path)
-            objects.append(o_basename)
-
-            if self._icon:
-                ico_basename = "%s.ico" % (self._icon,)
-                orig_ico_path = os.path.join(
-                    root, consts.ICO_FILE_SUBDIR,
-                    ico_basename,
-                )
-                if os.path.exists(orig_ico_path):
-                    logger.debug("icon: %r" % (self._icon,))
-                    ico_rc = "icon.rc"
-                    ico_o = "icon.o"
-                    ico_path = os.path.join(tmpdir, ico_basename)
-                    shutil.copy(orig_ico_path, ico_path)
-                    ico_rc_path = os.path.join(tmpdir, ico_rc)
-                    with open(ico_rc_path, "w", encoding="utf-8") as rc_fp:
-                        print('1 ICON "%s"' % (ico_basename,), file=rc_fp)
-                    try:
-                        subprocess.check_call(
-                            ["windres", ico_rc, ico_o],
-                            cwd=tmpdir,
-                        )
-                    except Exception:
-                        logger.exception(
-                            "Icon creation with windres failed",
-                        )
-                    else:
-                        ico_o_path = os.path.join(tmpdir, ico_o)
-                        if os.path.exists(ico_o_path):
-                            objects.append(ico_o)
+            data_o_basename = self._basename + "-data.o"
+            data_o_path = os.path.join(tmpdir, data_o_basename)
+            assert os.path.exists(data_o_path)
+            objects.append(data_o_basename)
+
+            complete = True
+            if orig_ico_path:
+                ico_basename = os.path.basename(orig_ico_path)
+                log.debug("icon: %r" % (self._icon,))
+                ico_rc = "icon.rc"
+                ico_o = "icon.o"
+                ico_path = os.path.join(tmpdir, ico_basename)
+                shutil.copy(orig_ico_path, ico_path)
+                ico_rc_path = os.path.join(tmpdir, ico_rc)
+                with open(ico_rc_path, "w", encoding="utf-8") as rc_fp:
+                    print('1 ICON "%s"' % (ico_basename,), file=rc_fp)
+                complete = False
+                try:
+                    _run_build_tool(
+                        ["windres", ico_rc, ico_o],
+                        cwd=tmpdir,
+                        log=log,
+                    )
+                except subprocess.CalledProcessError as e:
+                    log.error(
+                        "Icon creation with windres failed: %s",
+                        e.output.strip(),
+                    )
+                except Exception:
+                    log.exception(
+                        "Icon creation with windres failed",
+                    )
+                else:
+                    ico_o_path = os.path.join(tmpdir, ico_o)
+                    if os.path.exists(ico_o_path):
+                        objects.append(ico_o)
+                        complete = True
 
             link_cmd = ["gcc", "-municode", "-std=c11", "-mwindows", "-o"]
             link_cmd.append(exe_basename)
             link_cmd.extend(objects)
-            subprocess.check_call(
+            _run_build_tool(
                 link_cmd,
                 cwd=tmpdir,
+                log=log,
             )
             exe_path = os.path.join(tmpdir, exe_basename)
             assert os.path.exists(exe_path)
             shutil.copy(exe_path, final_exe_path)
+            if cache_key and complete:
+                cache.put(cache_key, exe_path)
         assert os.path.exists(final_exe_path)
 
+    def get_exe_launcher_inputs(self, bundle):
+        """Get the settings which affect the compiled .exe launcher.
+
+        :param .bundle.NativeBundle bundle: The bundle being built.
+        :returns: A JSON-serializable list, used for fingerprinting.
+        :rtype: list
+
+        """
+        return [
+            self._basename,
+            self._cmdline,
+            self._icon,
+            self._terminal,
+            self._force_helper,
+            self.get_app_id(bundle),
+        ]
+
     def _resolve_exe(self, prefix):
         """Resolves the 1st element of self._cmdline to a Windows subpath.
 
@@ -641,6 +725,167 @@ class DesktopEntry:
 
 # Helper funcs:
 
+class LauncherStub:
+    """The launcher stub code shared by all of a bundle's launchers.
+
+    The stub is compiled on first use, and only once, even if several
+    threads need it at the same time. The compiled object must be
+    linked with a launcher data object, as made by
+    DesktopEntry.write_exe_launcher(). Only settings which are the
+    same for every launcher are compiled into the stub.
+
+    """
+
+    _STUB_BASENAME = "launcherstub"
+
+    def __init__(self, build_dir):
+        """Initialize, without compiling anything yet.
+
+        :param str build_dir: Folder to compile in.
+
+        """
+        super().__init__()
+        self.build_dir = build_dir
+        self._lock = threading.Lock()
+        self._o_path = None
+        self._digest = None
+
+    @property
+    def _c_path(self):
+        return os.path.join(
+            os.path.dirname(__file__),
+            consts.PACKAGE_DATA_SUBDIR,
+            self._STUB_BASENAME + ".c",
+        )
+
+    @property
+    def _config_h(self):
+        postinst_sh = os.path.join(consts.SCRIPTS_SUBDIR, "postinst.sh")
+        return dedent("""
+            #ifndef HAVE_CONFIG_H
+            #define HAVE_CONFIG_H
+
+            #define LAUNCHER_POSTINST L"{postinst_sh}"
+            #define LAUNCHER_LOCATION_STATE_FILE L"{state_file}"
+
+            // Per-launcher settings, defined in a separate object.
+            extern const BOOL LAUNCHER_USE_HELPER;
+            extern const BOOL LAUNCHER_USE_TERMINAL;
+            extern LPCWSTR LAUNCHER_RESOLVED_EXE;
+            extern LPCWSTR LAUNCHER_APP_ID;
+            extern const WCHAR *LAUNCHER_CMDLINE_TEMPLATE[];
+
+            #endif // HAVE_CONFIG_H
+        """).format(
+            postinst_sh=c_escape(postinst_sh),
+            state_file=c_escape(consts.LAUNCHER_LOCATION_STATE_FILE),
+        )
+
+    @property
+    def digest(self):
+        """Hex digest of the stub's code, config, and the build tools.
+
+        This covers everything that goes into a launcher apart from its
+        own settings and icon.
+
+        """
+        if self._digest is None:
+            h = hashlib.sha256()
+            h.update(self._config_h.encode("utf-8"))
+            with open(self._c_path, "rb") as fp:
+                h.update(fp.read())
+            for tool in ["gcc", "windres"]:
+                h.update(_get_build_tool_version(shutil.which(tool)))
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def get_object(self, log=logger):
+        """Gets the compiled stub, compiling it if needed.
+
+        :param log: Where to log messages (a Logger or BufferedLogger).
+        :returns: The path to the compiled object file.
+        :rtype: str
+        :raises subprocess.CalledProcessError: if compilation fails.
+
+        """
+        with self._lock:
+            if self._o_path is None:
+                self._o_path = self._compile(log)
+            return self._o_path
+
+    def _compile(self, log):
+        log.info("Compiling the launcher stub…")
+        config_h_path = os.path.join(self.build_dir, "config.h")
+        with open(config_h_path, "w", encoding="utf-8") as fp:
+            print(self._config_h, file=fp)
+        c_basename = self._STUB_BASENAME + ".c"
+        shutil.copy(self._c_path, os.path.join(self.build_dir, c_basename))
+        _run_build_tool(
+            ["gcc", "-municode", "-std=c11", "-c", c_basename],
+            cwd=self.build_dir,
+            log=log,
+        )
+        o_path = os.path.join(self.build_dir, self._STUB_BASENAME + ".o")
+        assert os.path.exists(o_path)
+        return o_path
+
+
+@functools.lru_cache()
+def _get_build_tool_version(tool_path):
+    """Gets the version banner of a build tool, as bytes."""
+    if tool_path is None:
+        return b""
+    try:
+        return subprocess.check_output(
+            [tool_path, "--version"],
+            stderr=subprocess.STDOUT,
+        )
+    except Exception:
+        logger.warning("Cannot get the version of “%s”", tool_path)
+        return b""
+
+
+def _run_build_tool(cmd, cwd, log=logger):
+    """Runs a compiler tool, capturing its output.
+
+    :param list cmd: The command to run.
+    :param str cwd: Folder to run it in.
+    :param log: Where to log the tool's output.
+    :raises subprocess.CalledProcessError: if the tool fails.
+
+    """
+    log.debug("Running “%s”…", " ".join(cmd))
+    output = subprocess.check_output(
+        cmd,
+        cwd=cwd,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    output = output.strip()
+    if output:
+        log.debug("%s: %s", cmd[0], output)
+    return output
+
+
+def read_png_size(path):
+    """Read the width and height of a PNG image from its IHDR chunk.
+
+    :param str path: The PNG file.
+    :returns: (width, height)
+    :rtype: tuple
+    :raises ValueError: if the file doesn't start like a PNG.
+
+    """
+    with open(path, "rb") as fp:
+        header = fp.read(_PNG_HEADER_SIZE)
+    if len(header) < _PNG_HEADER_SIZE or header[:8] != _PNG_SIGNATURE:
+        raise ValueError("“%s” is not a PNG file" % (path,))
+    length, chunk_type, w, h = struct.unpack(">I4sII", header[8:])
+    if chunk_type != b"IHDR" or length < 8:
+        raise ValueError("“%s” has no IHDR chunk" % (path,))
+    return (w, h)
+
+
 def write_ico_file(filename, pngfile_infos):
     """Concatenate PNG images into a .ico file.
 
@@ -651,8 +896,10 @@ def write_ico_file(filename, pngfile_infos):
     png2ico won't generate .ico files with 256x256 icons, and because
     Pillow isn't available for MSYS2's Cygwin-like environment.
 
-    This code requires valid PNG file input, and trusts the sizes you
-    give it. It will filter out images of the wrong size.
+    The sizes you give are checked against each PNG's IHDR chunk, and
+    images of the wrong size or which aren't PNGs are filtered out,
+    as are repeated sizes. The images are copied into the .ico file
+    without being read into memory.
 
     Ref https://en.wikipedia.org/wiki/ICO_(file_format)#PNG_format
 
@@ -660,8 +907,20 @@ def write_ico_file(filename, pngfile_infos):
 
     # Check that the images are all OK for an icon.
     entries = []
+    seen_sizes = set()
     for i, pngfile_info in enumerate(pngfile_infos):
         w, h, pngfile_path = pngfile_info
+        try:
+            actual_w, actual_h = read_png_size(pngfile_path)
+        except (OSError, ValueError) as e:
+            logger.warning("image #%d: ignored: %s", i, e)
+            continue
+        if (actual_w, actual_h) != (w, h):
+            logger.warning(
+                "image #%d: ignored: “%s” is %dx%d, not %dx%d",
+                i, pngfile_path, actual_w, actual_h, w, h,
+            )
+            continue
         if w != h:
             logger.warning("image #%d: ignored: not square", i)
             continue
@@ -675,56 +934,72 @@ def write_ico_file(filename, pngfile_infos):
         if s > 256:
             logger.warning("image #%d: ignored: > 256x256", i)
             continue
-        with open(pngfile_path, "rb") as png_fp:
-            image_data = png_fp.read()
-        assert len(image_data) > 0
+        if s in seen_sizes:
+            logger.warning("image #%d: ignored: repeats %dx%d", i, s, s)
+            continue
+        seen_sizes.add(s)
+        image_size = os.path.getsize(pngfile_path)
+        assert image_size > 0
         # The height and width fields are written as 0 to mean 256.
         if s == 256:
             s = 0
-        entries.append((s, image_data))
+        entries.append((s, image_size, pngfile_path))
     if not entries:
         raise RuntimeError("No valid images, ICO file not written")
 
     # Sort by image dimensions, largest first except for any 256x256 icon.
     entries.sort(reverse=True)
 
-    # Write the ICO file
-    with open(filename, "wb") as ico_fp:
-        # ICONDIR
-        icondir_fmt = "<HHH"
-        icondir_size = struct.calcsize(icondir_fmt)
-        assert(icondir_size) == 6
-        icondir = struct.pack(
-            icondir_fmt,
-            0,  # H. Reserved.
-            1,  # H. Icon (".ICO") format.
-            len(entries),  # H. Number of entries.
-        )
-        ico_fp.write(icondir)
-        # ICONDIRENTRY
-        icondirentry_fmt = "<BBBBHHII"
-        icondirentry_size = struct.calcsize(icondirentry_fmt)
-        assert(icondirentry_size) == 16
-        image_offset = icondir_size + (icondirentry_size * len(entries))
-        for entry in entries:
-            s, image_data = entry
-            assert image_offset <= 0xffffffff
-            image_size = len(image_data)
-            assert image_size <= 0xffffffff
-            icondirentry = struct.pack(
-                icondirentry_fmt,
-                s,  # B. Width, or 0 if that's 256.
-                s,  # B. Height, or 0 if it's 256.
-                0,  # B. Number of entries in palette, 0 if no palette.
-                0,  # B. Reserved.
-                0,  # H. Colour planes, either 0 or 1.
-                32,  # H. Bits per pixel. Always 32 for PIL RGBA.
-                image_size,    # H. Size of image data in bytes.
-                image_offset,  # H. Offset of image data from start of file.
+    # Write the ICO file. It's written under a temporary name and then
+    # renamed, so that an interrupted write never leaves a broken icon.
+    tmp_filename = "%s.%d.tmp" % (filename, threading.get_ident())
+    try:
+        with open(tmp_filename, "wb") as ico_fp:
+            # ICONDIR
+            icondir_fmt = "<HHH"
+            icondir_size = struct.calcsize(icondir_fmt)
+            assert(icondir_size) == 6
+            icondir = struct.pack(
+                icondir_fmt,
+                0,  # H. Reserved.
+                1,  # H. Icon (".ICO") format.
+                len(entries),  # H. Number of entries.
             )
-            ico_fp.write(icondirentry)
-            image_offset += len(image_data)
-        # Image data, concatenated, as previously indexed
-        for entry in entries:
-            s, image_data = entry
-            ico_fp.write(image_data)
+            ico_fp.write(icondir)
+            # ICONDIRENTRY
+            icondirentry_fmt = "<BBBBHHII"
+            icondirentry_size = struct.calcsize(icondirentry_fmt)
+            assert(icondirentry_size) == 16
+            image_offset = icondir_size + (icondirentry_size * len(entries))
+            for entry in entries:
+                s, image_size, pngfile_path = entry
+                assert image_offset <= 0xffffffff
+                assert image_size <= 0xffffffff
+                icondirentry = struct.pack(
+                    icondirentry_fmt,
+                    s,  # B. Width, or 0 if that's 256.
+                    s,  # B. Height, or 0 if it's 256.
+                    0,  # B. Number of entries in palette, 0 if no palette.
+                    0,  # B. Reserved.
+                    0,  # H. Colour planes, either 0 or 1.
+                    32,  # H. Bits per pixel. Always 32 for PIL RGBA.
+                    image_size,    # H. Size of image data in bytes.
+                    image_offset,  # H. Offset of image data from file start.
+                )
+                ico_fp.write(icondirentry)
+                image_offset += image_size
+            # Image data, streamed in, as previously indexed
+            for entry in entries:
+                s, image_size, pngfile_path = entry
+                start = ico_fp.tell()
+                with open(pngfile_path, "rb") as png_fp:
+                    shutil.copyfileobj(png_fp, ico_fp)
+                if ico_fp.tell() - start != image_size:
+                    raise RuntimeError(
+                        "“%s” changed while being written to “%s”"
+                        % (pngfile_path, filename)
+                    )
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
@@ -0,0 +1,276 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Match many glob patterns at once while walking a tree.
+
+Running glob.glob() once per pattern lists the same folders over and
+over. A GlobMatcher compiles a list of patterns into a single
+automaton instead. Its state is carried down the tree during one
+walk, and stepped once per entry. Subtrees that no pattern can match
+anything inside are skipped entirely.
+
+The matching rules are those of glob.glob() with recursive=True:
+
+* Components are matched one at a time with fnmatch, using the OS's
+  case rules. Components without wildcards must match exactly.
+* Wildcards don't match names starting with a ".", unless the
+  pattern component starts with one too.
+* A "**" component matches zero or more folders, or with nothing
+  after it, zero or more files and folders. It doesn't descend into
+  folders whose names start with ".".
+* A trailing "/" matches folders only.
+
+"""
+
+import os
+import re
+import fnmatch
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+_MAGIC_CHECK = re.compile(r"[*?[]")
+
+_GLOBSTAR = "**"
+
+#: Step results remembered per state. Names repeat a lot in trees.
+_STEP_CACHE_SIZE = 4096
+
+
+# Class defs:
+
+class _Pattern:
+    """A glob pattern, split into components."""
+
+    def __init__(self, pattern):
+        super().__init__()
+        self.text = pattern
+        if os.path.sep != "/":
+            pattern = pattern.replace(os.path.sep, "/")
+        self.dir_only = pattern.endswith("/")
+        self.parts = [p for p in pattern.split("/") if p]
+        self.magic = [_has_magic(p) for p in self.parts]
+
+    def needs_dir(self, i):
+        """Whether a wildcard component only matches folders.
+
+        glob only lists folders when matching the wildcard components
+        of the folder part of a pattern.
+
+        """
+        if not self.magic[i]:
+            return False
+        return (i < len(self.parts) - 1) or self.dir_only
+
+    @property
+    def unchecked_match(self):
+        """A literal path glob will yield even if it doesn't exist.
+
+        glob yields the path before a trailing "**" without checking
+        it when it has no wildcards, e.g. "missing" for "missing/**".
+
+        """
+        n = len(self.parts)
+        while n > 0 and self.parts[n-1] == _GLOBSTAR:
+            n -= 1
+        if n == len(self.parts) or n == 0 or self.dir_only:
+            return None
+        if any(self.magic[:n]):
+            return None
+        return "/".join(self.parts[:n])
+
+
+class _State:
+    """A set of positions within the patterns, with its transitions."""
+
+    def __init__(self, matcher, positions):
+        super().__init__()
+        self.positions = positions
+        patterns = matcher.patterns
+        self.accepts = False
+        self.accepts_dir = False
+        self.accepting = []
+        self.literals = {}
+        self.wildcards = []
+        self.globstars = []
+        quick = []
+        for pi, i in positions:
+            pattern = patterns[pi]
+            if i == len(pattern.parts):
+                self.accepting.append((pi, pattern.dir_only))
+                if pattern.dir_only:
+                    self.accepts_dir = True
+                else:
+                    self.accepts = True
+                continue
+            part = pattern.parts[i]
+            needs_dir = pattern.needs_dir(i)
+            if part == _GLOBSTAR:
+                self.globstars.append(((pi, i), needs_dir))
+            elif pattern.magic[i]:
+                regex = fnmatch.translate(os.path.normcase(part))
+                quick.append(regex)
+                self.wildcards.append((
+                    re.compile(regex).match,
+                    part.startswith("."),
+                    (pi, i + 1),
+                    needs_dir,
+                ))
+            else:
+                key = os.path.normcase(part)
+                self.literals.setdefault(key, []).append((pi, i + 1))
+        self.step_cache = {}
+        self.quick_match = None
+        if quick:
+            self.quick_match = re.compile("|".join(quick)).match
+
+    def matches(self, is_dir):
+        return self.accepts or (self.accepts_dir and is_dir)
+
+    def matching(self, is_dir):
+        return sorted(
+            pi for (pi, dir_only) in self.accepting
+            if is_dir or not dir_only
+        )
+
+
+class GlobMatcher:
+    """Matches paths against a list of glob patterns, one step at a time.
+
+    Start with the state for the walk's root, and step it with the
+    name of each entry on the way down. A state of None means that
+    nothing at or below that entry can match.
+
+    """
+
+    def __init__(self, patterns):
+        """Compile a list of glob patterns.
+
+        :param list patterns: Patterns, relative to the walk's root.
+
+        """
+        super().__init__()
+        self.patterns = [_Pattern(p) for p in patterns]
+        self._states = {}
+        start = set()
+        for pi, pattern in enumerate(self.patterns):
+            self._add_position(start, pi, 0)
+        self.start = self._get_state(start)
+
+    def _add_position(self, positions, pi, i):
+        """Add a position, and any that a "**" can skip to."""
+        parts = self.patterns[pi].parts
+        positions.add((pi, i))
+        while i < len(parts) and parts[i] == _GLOBSTAR:
+            i += 1
+            positions.add((pi, i))
+
+    def _get_state(self, positions):
+        if not positions:
+            return None
+        positions = frozenset(positions)
+        state = self._states.get(positions)
+        if state is None:
+            state = _State(self, positions)
+            self._states[positions] = state
+        return state
+
+    def step(self, state, name, is_dir):
+        """Step a state with the next entry name in a path.
+
+        :param state: The state for the entry's parent folder.
+        :param str name: The entry's name.
+        :param bool is_dir: Whether the entry is a folder.
+        :returns: The state for the entry, or None.
+
+        """
+        if state is None:
+            return None
+        cache_key = (name, is_dir)
+        try:
+            return state.step_cache[cache_key]
+        except KeyError:
+            pass
+        next_state = self._step(state, name, is_dir)
+        if len(state.step_cache) < _STEP_CACHE_SIZE:
+            state.step_cache[cache_key] = next_state
+        return next_state
+
+    def _step(self, state, name, is_dir):
+        hidden = name.startswith(".")
+        key = os.path.normcase(name)
+        positions = set()
+        for pi, i in state.literals.get(key, ()):
+            self._add_position(positions, pi, i)
+        if state.quick_match is not None and state.quick_match(key):
+            for match, hidden_ok, (pi, i), needs_dir in state.wildcards:
+                if needs_dir and not is_dir:
+                    continue
+                if hidden and not hidden_ok:
+                    continue
+                if match(key):
+                    self._add_position(positions, pi, i)
+        if not hidden:
+            for (pi, i), needs_dir in state.globstars:
+                if needs_dir and not is_dir:
+                    continue
+                self._add_position(positions, pi, i)
+        return self._get_state(positions)
+
+    @staticmethod
+    def matches(state, is_dir):
+        """Whether an entry whose state this is matches any pattern."""
+        return state is not None and state.matches(is_dir)
+
+    @staticmethod
+    def matching(state, is_dir):
+        """Which patterns an entry whose state this is matches.
+
+        :returns: Indices into the list of patterns, in order.
+        :rtype: list
+
+        """
+        if state is None:
+            return []
+        return state.matching(is_dir)
+
+    def unchecked_matches(self):
+        """Literal paths which glob would yield without checking them.
+
+        :returns: "/"-separated paths, relative to the walk's root.
+        :rtype: list
+
+        These should be treated as matches if they're not in the tree.
+        See _Pattern.unchecked_match.
+
+        """
+        paths = []
+        for pattern in self.patterns:
+            path = pattern.unchecked_match
+            if path is not None:
+                paths.append(path)
+        return paths
+
+
+# Helper funcs:
+
+def _has_magic(s):
+    return _MAGIC_CHECK.search(s) is not None
@@ -0,0 +1,611 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Pure-Python implementations of bits of pacman and libalpm."""
+
+from .utils import find_msys2_root
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+import subprocess
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+_DIGITS = frozenset("0123456789")
+_ALPHAS = frozenset(
+    "abcdefghijklmnopqrstuvwxyz"
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+)
+_ALNUMS = _DIGITS | _ALPHAS
+
+#: How many version comparisons to remember.
+_VERCMP_CACHE_SIZE = 8192
+
+#: Package file names: "{name}-{pkgver}-{pkgrel}-{arch}.pkg.tar[.ext]".
+_PACKAGE_FILE_RE = re.compile(r'''
+    ^ (?P<name> .+ )
+    - (?P<version> [^-]+ - \d+ (?: [.]\d+ )? )
+    - (?P<arch> [^-]+ )
+    [.]pkg[.]tar
+    (?: [.](?: gz|bz2|xz|zst|lz4|lzo|lrz|Z ) )?
+    $
+''', re.X | re.I)
+
+
+#: Where a tree's local package database lives.
+LOCAL_DB_SUBDIR = os.path.join("var", "lib", "pacman", "local")
+
+#: Database desc sections → metadata keys.
+#: The keys are the str2key()ed headings of "pacman --query --info",
+#: or of "pacman --sync --info" for sync database sections.
+_DESC_KEYS = {
+    "FILENAME": "filename",
+    "CSIZE": "download_size",
+    "ISIZE": "installed_size",
+    "NAME": "name",
+    "VERSION": "version",
+    "BASE": "base",
+    "DESC": "description",
+    "URL": "url",
+    "ARCH": "architecture",
+    "BUILDDATE": "build_date",
+    "INSTALLDATE": "install_date",
+    "PACKAGER": "packager",
+    "SIZE": "installed_size",
+    "REASON": "install_reason",
+    "VALIDATION": "validated_by",
+    "GROUPS": "groups",
+    "LICENSE": "licenses",
+    "REPLACES": "replaces",
+    "DEPENDS": "depends_on",
+    "OPTDEPENDS": "optional_deps",
+    "CONFLICTS": "conflicts_with",
+    "PROVIDES": "provides",
+}
+
+#: Desc sections which can have several values.
+_DESC_LIST_SECTIONS = {
+    "GROUPS", "LICENSE", "REPLACES", "DEPENDS", "OPTDEPENDS",
+    "CONFLICTS", "PROVIDES", "VALIDATION",
+}
+
+#: Dependency strings: "name", or "name<op>version".
+_DEPEND_RE = re.compile(r'''
+    ^ (?P<name> [^<>=]+ )
+    (?: (?P<op> <= | >= | = | < | > ) (?P<version> .+ ) )?
+    $
+''', re.X)
+
+#: Set when checked_vercmp() can't run the vercmp binary.
+_vercmp_external_failed = False
+
+
+# Class defs:
+
+class PackageDirIndex:
+    """The package files in a folder, indexed by package name.
+
+    Checking every file name in a big local repository folder for
+    every package wanted is slow, so an index parses each name once.
+    Indexes are kept for the life of the process, and can be saved in
+    a cache folder too. A saved index is only used if the folder's
+    mtime is unchanged, which it is unless files have been added,
+    removed, or renamed since.
+
+    Package names are looked up case-insensitively.
+
+    """
+
+    #: Version of the saved index format.
+    _FORMAT = 1
+
+    #: Indexes loaded by this process, by absolute path.
+    _loaded = {}
+
+    def __init__(self, pkgdir, mtime_ns, entries):
+        """Initialize from parsed entries: use get() instead."""
+        super().__init__()
+        self.pkgdir = pkgdir
+        self.mtime_ns = mtime_ns
+        self._entries = entries
+
+    @classmethod
+    def get(cls, pkgdir, cache_dir=None):
+        """Get an up to date index for a folder.
+
+        :param str pkgdir: Folder containing package files.
+        :param str cache_dir: Where to save indexes, or None.
+        :returns: The index.
+        :rtype: PackageDirIndex
+        :raises OSError: if the folder can't be read.
+
+        """
+        pkgdir = os.path.abspath(pkgdir)
+        mtime_ns = os.stat(pkgdir).st_mtime_ns
+        index = cls._loaded.get(pkgdir)
+        if index is not None and index.mtime_ns == mtime_ns:
+            return index
+        index = None
+        cache_path = None
+        if cache_dir:
+            key = hashlib.sha256(pkgdir.encode("utf-8")).hexdigest()
+            cache_path = os.path.join(cache_dir, key + ".json")
+            index = cls._load(cache_path, pkgdir, mtime_ns)
+        if index is None:
+            index = cls._scan(pkgdir, mtime_ns)
+            if cache_path:
+                index._save(cache_path)
+        cls._loaded[pkgdir] = index
+        return index
+
+    @classmethod
+    def _scan(cls, pkgdir, mtime_ns):
+        entries = {}
+        for filename in os.listdir(pkgdir):
+            m = _PACKAGE_FILE_RE.match(filename)
+            if not m:
+                continue
+            key = m.group("name").casefold()
+            entry = (m.group("version"), m.group("arch"), filename)
+            entries.setdefault(key, []).append(entry)
+        logger.debug(
+            "Indexed %d packages in “%s”",
+            len(entries), pkgdir,
+        )
+        return cls(pkgdir, mtime_ns, entries)
+
+    @classmethod
+    def _load(cls, path, pkgdir, mtime_ns):
+        """Load a saved index, if it's still valid."""
+        try:
+            with open(path, "r", encoding="utf-8") as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        valid = (
+            isinstance(data, dict)
+            and data.get("format") == cls._FORMAT
+            and data.get("pkgdir") == pkgdir
+            and data.get("mtime_ns") == mtime_ns
+        )
+        if not valid:
+            return None
+        entries = {
+            key: [tuple(e) for e in entries]
+            for (key, entries) in data["entries"].items()
+        }
+        logger.debug("Using saved package index for “%s”", pkgdir)
+        return cls(pkgdir, mtime_ns, entries)
+
+    def _save(self, path):
+        """Save the index atomically. Failures are only logged."""
+        data = {
+            "format": self._FORMAT,
+            "pkgdir": self.pkgdir,
+            "mtime_ns": self.mtime_ns,
+            "entries": self._entries,
+        }
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path),
+                prefix=".tmp",
+            )
+            with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                json.dump(data, fp)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.debug("Cannot save package index %r", path, exc_info=True)
+
+    def find(self, name, archs=None):
+        """Find the files for a package.
+
+        :param str name: The package name.
+        :param archs: Architectures to accept, or None for any.
+        :returns: List of (version, path) pairs, in no particular order.
+        :rtype: list
+
+        """
+        found = []
+        for version, arch, filename in self._entries.get(name.casefold(), ()):
+            if archs is not None and arch not in archs:
+                continue
+            found.append((version, os.path.join(self.pkgdir, filename)))
+        return found
+
+
+class LocalPackageDB:
+    """The installed packages in a tree's local pacman database.
+
+    The database is read straight from the desc files in
+    "var/lib/pacman/local", without running pacman. Each package's
+    desc file is parsed at most once, and the parsed metadata is kept
+    for the life of the process. It's only read again if the local
+    database folder's mtime changes, which happens when a package is
+    installed, upgraded, or removed.
+
+    """
+
+    #: Databases loaded by this process, by absolute root path.
+    _loaded = {}
+
+    def __init__(self, root, mtime_ns, entries):
+        """Initialize from a folder listing: use get() instead."""
+        super().__init__()
+        self.root = root
+        self.mtime_ns = mtime_ns
+        self._entries = entries
+        self._metadata = {}
+
+    @classmethod
+    def get(cls, root):
+        """Get an up to date view of a tree's local database.
+
+        :param str root: The tree.
+        :returns: The database.
+        :rtype: LocalPackageDB
+
+        A tree without a local database has no packages installed.
+
+        """
+        root = os.path.abspath(root)
+        local_dir = os.path.join(root, LOCAL_DB_SUBDIR)
+        try:
+            mtime_ns = os.stat(local_dir).st_mtime_ns
+        except FileNotFoundError:
+            return cls(root, None, {})
+        db = cls._loaded.get(root)
+        if db is not None and db.mtime_ns == mtime_ns:
+            return db
+        entries = {}
+        with os.scandir(local_dir) as scan:
+            for dir_entry in scan:
+                if not dir_entry.is_dir():
+                    continue
+                name = dir_entry.name.rsplit("-", 2)[0]
+                entries[name] = dir_entry.path
+        db = cls(root, mtime_ns, entries)
+        cls._loaded[root] = db
+        return db
+
+    @property
+    def names(self):
+        """The names of the installed packages, sorted."""
+        return sorted(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def metadata(self, name):
+        """Get the metadata for an installed package.
+
+        :param str name: The package name.
+        :returns: Metadata, keyed like the output of pacman --query
+            --info, passed through str2key(). Multi-valued fields
+            like "depends_on" are lists, and the rest are strings.
+        :rtype: dict
+        :raises KeyError: if the package isn't installed.
+
+        """
+        metadata = self._metadata.get(name)
+        if metadata is None:
+            entry_dir = self._entries[name]
+            try:
+                metadata = _read_desc(os.path.join(entry_dir, "desc"))
+            except FileNotFoundError:
+                raise KeyError(name)
+            self._metadata[name] = metadata
+        return metadata
+
+    def all_metadata(self, names=None):
+        """Get metadata for several installed packages in one pass.
+
+        :param iterable names: Package names, or None for all.
+        :returns: Mapping of names to metadata dicts, as returned by
+            metadata(). Names which aren't installed are omitted.
+        :rtype: dict
+
+        """
+        if names is None:
+            names = self._entries
+        return {n: self.metadata(n) for n in names if n in self._entries}
+
+
+# Helper funcs:
+
+def find_installed(names):
+    """Find which packages are installed on the host.
+
+    :param iterable names: Package names.
+    :returns: The names which are installed.
+    :rtype: set
+
+    The host's local database is read directly, and cached for the
+    rest of the process, as a LocalPackageDB. If it can't be found, a
+    single batched pacman query is run instead.
+
+    """
+    names = list(names)
+    root = find_msys2_root()
+    if root is not None:
+        db = LocalPackageDB.get(root)
+        if db.mtime_ns is not None:
+            return {n for n in names if n in db}
+    cmd = ["pacman", "--query", "--quiet"] + names
+    logger.debug("Running “%s”…", " ".join(cmd))
+    proc = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    return set(proc.stdout.split()) & set(names)
+
+
+def _read_desc(path):
+    """Parse a local database desc file."""
+    with open(path, "r", encoding="utf-8", errors="replace") as fp:
+        return parse_desc(fp)
+
+
+def parse_desc(lines):
+    """Parse the lines of a local or sync database desc file.
+
+    :param iterable lines: Lines of text.
+    :returns: Metadata, as returned by LocalPackageDB.metadata().
+    :rtype: dict
+
+    """
+    metadata = {}
+    section = None
+    for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith("%") and line.endswith("%") and len(line) > 2:
+            section = line[1:-1]
+            if section in _DESC_LIST_SECTIONS:
+                metadata[_DESC_KEYS[section]] = []
+            continue
+        if not line or section not in _DESC_KEYS:
+            continue
+        key = _DESC_KEYS[section]
+        if section in _DESC_LIST_SECTIONS:
+            metadata[key].append(line)
+        elif key in metadata:
+            metadata[key] += "\n" + line
+        else:
+            metadata[key] = line
+    return metadata
+
+
+def parse_depend(dep):
+    """Split a dependency string into (name, operator, version).
+
+    :param str dep: A dependency, like "foo", or "foo>=1.2-1".
+    :returns: The operator and version are None if there aren't any.
+    :rtype: tuple
+
+    Descriptions after a ": ", as in optional dependencies, are
+    ignored.
+
+    """
+    dep = dep.partition(": ")[0].strip()
+    m = _DEPEND_RE.match(dep)
+    if not m:
+        return (dep, None, None)
+    return (m.group("name"), m.group("op"), m.group("version"))
+
+
+def satisfies(name, version, provides, dep):
+    """Whether a package satisfies a dependency, as in libalpm.
+
+    :param str name: The package's name.
+    :param str version: The package's version.
+    :param list provides: The package's provisions, like "foo=1.2".
+    :param tuple dep: A dependency, as returned by parse_depend().
+    :rtype: bool
+
+    Provisions without a version only satisfy unversioned
+    dependencies.
+
+    """
+    dep_name, op, dep_version = dep
+    if name == dep_name and _version_satisfies(version, op, dep_version):
+        return True
+    for provision in provides:
+        prov_name, prov_op, prov_version = parse_depend(provision)
+        if prov_name != dep_name or prov_op not in (None, "="):
+            continue
+        if _version_satisfies(prov_version, op, dep_version):
+            return True
+    return False
+
+
+def _version_satisfies(version, op, dep_version):
+    if op is None:
+        return True
+    if version is None:
+        return False
+    result = vercmp(version, dep_version)
+    return {
+        "=": result == 0,
+        ">=": result >= 0,
+        "<=": result <= 0,
+        ">": result > 0,
+        "<": result < 0,
+    }[op]
+
+
+@functools.lru_cache(maxsize=_VERCMP_CACHE_SIZE)
+def vercmp(v1, v2):
+    """Compare two package version strings, like pacman's vercmp.
+
+    :param str v1: A version, "[epoch:]version[-release]".
+    :param str v2: Another version.
+    :returns: -1 if v1 is older than v2, 0 if they're the same, and 1
+        if v1 is newer.
+    :rtype: int
+
+    This is a port of alpm_pkg_vercmp() from libalpm. Results are
+    memoized, because sorting package files compares the same
+    versions many times.
+
+    """
+    v1 = str(v1)
+    v2 = str(v2)
+    if v1 == v2:
+        return 0
+    epoch1, ver1, rel1 = _parse_evr(v1)
+    epoch2, ver2, rel2 = _parse_evr(v2)
+    result = _rpmvercmp(epoch1, epoch2)
+    if result == 0:
+        result = _rpmvercmp(ver1, ver2)
+        if result == 0 and rel1 is not None and rel2 is not None:
+            result = _rpmvercmp(rel1, rel2)
+    return result
+
+
+def vercmp_external(v1, v2):
+    """Compare two package version strings by running vercmp.
+
+    This is slow, and is only needed to cross-check vercmp().
+
+    """
+    sign_str = subprocess.check_output(["vercmp", str(v1), str(v2)])
+    return int(sign_str.strip())
+
+
+def checked_vercmp(v1, v2):
+    """Compare versions with vercmp(), cross-checking with the binary.
+
+    Disagreements are logged as warnings. The in-process result is
+    returned. If the binary can't be run, cross-checking stops.
+
+    """
+    global _vercmp_external_failed
+    result = vercmp(v1, v2)
+    if _vercmp_external_failed:
+        return result
+    try:
+        external = vercmp_external(v1, v2)
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        logger.warning("Cannot run vercmp to cross-check versions: %s", e)
+        _vercmp_external_failed = True
+        return result
+    if (external > 0) - (external < 0) != result:
+        logger.warning(
+            "vercmp(%r, %r): got %d, but pacman's vercmp says %d",
+            v1, v2, result, external,
+        )
+    return result
+
+
+def _parse_evr(evr):
+    """Split a version into (epoch, version, release).
+
+    The epoch defaults to "0". The release is None if there isn't one.
+
+    """
+    i = 0
+    while i < len(evr) and evr[i] in _DIGITS:
+        i += 1
+    release = None
+    sep = evr.rfind("-", i)
+    if sep >= 0:
+        release = evr[sep+1:]
+        evr = evr[:sep]
+    if i < len(evr) and evr[i] == ":":
+        epoch = evr[:i] or "0"
+        version = evr[i+1:]
+    else:
+        epoch = "0"
+        version = evr
+    return (epoch, version, release)
+
+
+def _rpmvercmp(a, b):
+    """Compare two version segments, like rpmvercmp() in libalpm.
+
+    The strings are split into runs of digits and runs of letters.
+    Numeric runs are compared as numbers, and beat alphabetic ones.
+    Anything else is a separator.
+
+    """
+    if a == b:
+        return 0
+    len_a = len(a)
+    len_b = len(b)
+    one = ptr1 = 0
+    two = ptr2 = 0
+    while one < len_a and two < len_b:
+        while one < len_a and a[one] not in _ALNUMS:
+            one += 1
+        while two < len_b and b[two] not in _ALNUMS:
+            two += 1
+        if not (one < len_a and two < len_b):
+            break
+
+        # Different separator lengths decide it
+        if (one - ptr1) != (two - ptr2):
+            return -1 if (one - ptr1) < (two - ptr2) else 1
+
+        ptr1 = one
+        ptr2 = two
+        if a[ptr1] in _DIGITS:
+            chars = _DIGITS
+            is_num = True
+        else:
+            chars = _ALPHAS
+            is_num = False
+        while ptr1 < len_a and a[ptr1] in chars:
+            ptr1 += 1
+        while ptr2 < len_b and b[ptr2] in chars:
+            ptr2 += 1
+
+        # Numeric segments are always newer than alpha segments
+        if two == ptr2:
+            return 1 if is_num else -1
+
+        seg1 = a[one:ptr1]
+        seg2 = b[two:ptr2]
+        if is_num:
+            seg1 = seg1.lstrip("0")
+            seg2 = seg2.lstrip("0")
+            if len(seg1) != len(seg2):
+                return 1 if len(seg1) > len(seg2) else -1
+        if seg1 != seg2:
+            return 1 if seg1 > seg2 else -1
+        one = ptr1
+        two = ptr2
+
+    if one >= len_a and two >= len_b:
+        return 0
+
+    # A remaining alpha segment never beats an empty string
+    rest1 = a[one] if one < len_a else ""
+    rest2 = b[two] if two < len_b else ""
+    if (not rest1 and rest2 not in _ALPHAS) or (rest1 in _ALPHAS):
+        return -1
+    return 1
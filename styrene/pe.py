@@ -0,0 +1,284 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Read the DLL imports of Windows executables, in pure Python.
+
+Only the headers, section table, and import directories of a PE/COFF
+image are read, so this works on any platform, and it doesn't need
+any of the binutils. Both the ordinary import table and the
+delay-load import table are read.
+
+Ref: https://docs.microsoft.com/en-us/windows/desktop/debug/pe-format
+
+"""
+
+import os
+import struct
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+#: File extensions of the PE images found in bundles.
+PE_FILE_EXTENSIONS = (".exe", ".dll", ".pyd")
+
+_DOS_MAGIC = b"MZ"
+_PE_SIGNATURE = b"PE\0\0"
+_DOS_HEADER_SIZE = 64
+_DOS_LFANEW_OFFSET = 0x3c
+
+_COFF_HEADER = struct.Struct("<HHIIIHH")
+_SECTION_HEADER = struct.Struct("<8sIIII")
+_SECTION_HEADER_SIZE = 40
+
+_PE32_MAGIC = 0x10b
+_PE32_PLUS_MAGIC = 0x20b
+
+#: Optional header magic → (ImageBase format and offset,
+#: NumberOfRvaAndSizes offset, data directories offset).
+_OPTIONAL_HEADER_LAYOUTS = {
+    _PE32_MAGIC: ("<I", 28, 92, 96),
+    _PE32_PLUS_MAGIC: ("<Q", 24, 108, 112),
+}
+
+_DATA_DIRECTORY = struct.Struct("<II")
+_IMPORT_DIRECTORY_INDEX = 1
+_DELAY_IMPORT_DIRECTORY_INDEX = 13
+
+_IMPORT_DESCRIPTOR = struct.Struct("<IIIII")
+_DELAY_IMPORT_DESCRIPTOR = struct.Struct("<IIIIIIII")
+
+#: Delay-load descriptor attribute: addresses are RVAs, not VAs.
+_DELAY_ATTR_RVA_BASED = 0x1
+
+#: Sanity limits, so that damaged files can't run away with us.
+_MAX_SECTIONS = 96
+_MAX_DESCRIPTORS = 4096
+_MAX_NAME_LENGTH = 1024
+
+
+# Class defs:
+
+class PEError (Exception):
+    """The file is not a PE image, or it is damaged."""
+
+
+class _PEFile:
+    """Random access to the parts of a PE image, by RVA."""
+
+    def __init__(self, fp):
+        super().__init__()
+        self._fp = fp
+        dos_header = self._read(0, _DOS_HEADER_SIZE)
+        if not dos_header.startswith(_DOS_MAGIC):
+            raise PEError("no DOS header")
+        (pe_offset,) = struct.unpack_from("<I", dos_header, _DOS_LFANEW_OFFSET)
+        coff_offset = pe_offset + len(_PE_SIGNATURE)
+        if self._read(pe_offset, len(_PE_SIGNATURE)) != _PE_SIGNATURE:
+            raise PEError("no PE signature")
+        (machine, num_sections, timestamp, symtab_ptr, num_symbols,
+         opt_header_size, characteristics) = _COFF_HEADER.unpack(
+            self._read(coff_offset, _COFF_HEADER.size),
+        )
+        if num_sections > _MAX_SECTIONS:
+            raise PEError("too many sections (%d)" % (num_sections,))
+
+        opt_offset = coff_offset + _COFF_HEADER.size
+        opt_header = self._read(opt_offset, opt_header_size)
+        if len(opt_header) < 2:
+            raise PEError("no optional header")
+        (magic,) = struct.unpack_from("<H", opt_header, 0)
+        layout = _OPTIONAL_HEADER_LAYOUTS.get(magic)
+        if layout is None:
+            raise PEError("unknown optional header magic 0x%x" % (magic,))
+        base_fmt, base_offset, num_dirs_offset, dirs_offset = layout
+        if len(opt_header) < dirs_offset:
+            raise PEError("optional header is too short")
+        (self.image_base,) = struct.unpack_from(
+            base_fmt, opt_header, base_offset,
+        )
+        (num_dirs,) = struct.unpack_from("<I", opt_header, num_dirs_offset)
+        num_dirs = min(
+            num_dirs,
+            (len(opt_header) - dirs_offset) // _DATA_DIRECTORY.size,
+        )
+        self.data_dirs = [
+            _DATA_DIRECTORY.unpack_from(
+                opt_header,
+                dirs_offset + i * _DATA_DIRECTORY.size,
+            )
+            for i in range(num_dirs)
+        ]
+
+        sections_offset = opt_offset + opt_header_size
+        sections_data = self._read(
+            sections_offset,
+            num_sections * _SECTION_HEADER_SIZE,
+        )
+        self.sections = []
+        for i in range(num_sections):
+            (name, vsize, vaddr, raw_size, raw_ptr) = \
+                _SECTION_HEADER.unpack_from(
+                    sections_data, i * _SECTION_HEADER_SIZE,
+                )
+            self.sections.append((vaddr, max(vsize, raw_size),
+                                  raw_ptr, raw_size))
+
+    def _read(self, offset, size):
+        self._fp.seek(offset)
+        data = self._fp.read(size)
+        if len(data) != size:
+            raise PEError("truncated at offset 0x%x" % (offset,))
+        return data
+
+    def data_dir(self, index):
+        """The (rva, size) of a data directory, or None if it's empty."""
+        if index >= len(self.data_dirs):
+            return None
+        rva, size = self.data_dirs[index]
+        if not (rva and size):
+            return None
+        return (rva, size)
+
+    def offset(self, rva):
+        """Convert an RVA to a file offset."""
+        for vaddr, vsize, raw_ptr, raw_size in self.sections:
+            if vaddr <= rva < vaddr + vsize:
+                delta = rva - vaddr
+                if delta >= raw_size:
+                    raise PEError("RVA 0x%x is not in the file" % (rva,))
+                return raw_ptr + delta
+        raise PEError("RVA 0x%x is not in any section" % (rva,))
+
+    def read(self, rva, size):
+        return self._read(self.offset(rva), size)
+
+    def read_cstring(self, rva):
+        """Read a NUL-terminated ASCII string."""
+        self._fp.seek(self.offset(rva))
+        data = self._fp.read(_MAX_NAME_LENGTH)
+        end = data.find(b"\0")
+        if end < 0:
+            raise PEError("unterminated string at RVA 0x%x" % (rva,))
+        return data[:end].decode("latin-1")
+
+    def descriptors(self, index, struct_):
+        """Iterate over the descriptors in an import directory."""
+        data_dir = self.data_dir(index)
+        if data_dir is None:
+            return
+        rva = data_dir[0]
+        for i in range(_MAX_DESCRIPTORS):
+            fields = struct_.unpack(self.read(rva, struct_.size))
+            if not any(fields):
+                return
+            yield fields
+            rva += struct_.size
+        raise PEError("too many import descriptors")
+
+
+# Helper funcs:
+
+def read_imports(path):
+    """Get the names of the DLLs a PE image imports.
+
+    :param str path: An .exe, .dll, or .pyd file.
+    :returns: DLL names as written in the file, in order, without
+        duplicates. Delay-loaded DLLs are included.
+    :rtype: list
+    :raises PEError: if the file can't be parsed.
+    :raises OSError: if the file can't be read.
+
+    """
+    names = []
+    seen = set()
+
+    def _add(name):
+        key = name.lower()
+        if name and key not in seen:
+            seen.add(key)
+            names.append(name)
+
+    with open(path, "rb") as fp:
+        image = _PEFile(fp)
+        for fields in image.descriptors(_IMPORT_DIRECTORY_INDEX,
+                                        _IMPORT_DESCRIPTOR):
+            name_rva = fields[3]
+            if name_rva:
+                _add(image.read_cstring(name_rva))
+        for fields in image.descriptors(_DELAY_IMPORT_DIRECTORY_INDEX,
+                                        _DELAY_IMPORT_DESCRIPTOR):
+            attributes, name_addr = fields[:2]
+            if not name_addr:
+                continue
+            if not (attributes & _DELAY_ATTR_RVA_BASED):
+                name_addr -= image.image_base
+            _add(image.read_cstring(name_addr))
+    return names
+
+
+def dll_closure(roots, search_dirs):
+    """Find the DLLs a set of executables needs, directly or indirectly.
+
+    :param iterable roots: Paths of the executables and modules whose
+        dependencies are wanted.
+    :param iterable search_dirs: Folders which contain DLLs.
+    :returns: Paths of the DLLs from search_dirs which are needed.
+    :rtype: set
+
+    DLL names are matched case-insensitively, and the first search
+    folder containing a name wins. Names which aren't found in any
+    search folder are assumed to be provided by Windows. Files which
+    can't be parsed are logged and skipped.
+
+    """
+    available = {}
+    for search_dir in search_dirs:
+        try:
+            names = os.listdir(search_dir)
+        except OSError:
+            logger.warning("Cannot list “%s”", search_dir)
+            continue
+        for name in names:
+            path = os.path.join(search_dir, name)
+            available.setdefault(name.lower(), path)
+
+    needed = set()
+    queue = collections.deque(roots)
+    scanned = set()
+    while queue:
+        path = queue.popleft()
+        if path in scanned:
+            continue
+        scanned.add(path)
+        try:
+            imports = read_imports(path)
+        except (PEError, OSError) as e:
+            logger.warning("Cannot read the imports of “%s”: %s", path, e)
+            continue
+        for name in imports:
+            dll_path = available.get(name.lower())
+            if dll_path is None:
+                continue
+            if dll_path not in needed:
+                needed.add(dll_path)
+                queue.append(dll_path)
+    return needed
@@ -0,0 +1,529 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Installing package files in-process, optionally via a store.
+
+Pacman unpacks packages one at a time, but several package files can
+be unpacked at once with install_package(). Unpacking is still slow:
+most packages are xz or zstd compressed. A PackageStore unpacks each
+package file just once, keyed by a hash of its contents. Bundle trees
+are then populated by hardlinking the unpacked files into place,
+which is a metadata-only operation.
+
+Installing a package either way also writes its entry in the tree's
+local pacman database, so the tree looks just as if pacman had
+installed the package with --noscriptlet.
+
+"""
+
+from .cache import get_cache_dir
+from .cache import link_or_copy
+from .pacman import LOCAL_DB_SUBDIR
+from .utils import msys2_native_path
+
+import os
+import io
+import time
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import subprocess
+import contextlib
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+#: Local database format version, as written by pacman 5 and 6.
+ALPM_DB_VERSION = 9
+
+DEFAULT_PACMAN_CACHE_DIR = "/var/cache/pacman/pkg/"
+
+#: Package metadata members, which are not installed as files.
+_META_MEMBERS = {
+    ".PKGINFO", ".BUILDINFO", ".MTREE", ".INSTALL", ".CHANGELOG",
+}
+
+#: .PKGINFO keys → local db desc sections, in pacman's order.
+_DESC_FIELDS = [
+    ("pkgname", "NAME"),
+    ("pkgver", "VERSION"),
+    ("pkgbase", "BASE"),
+    ("pkgdesc", "DESC"),
+    ("group", "GROUPS"),
+    ("url", "URL"),
+    ("arch", "ARCH"),
+    ("builddate", "BUILDDATE"),
+    (None, "INSTALLDATE"),
+    ("packager", "PACKAGER"),
+    ("size", "SIZE"),
+    (None, "REASON"),
+    ("license", "LICENSE"),
+    (None, "VALIDATION"),
+    ("replaces", "REPLACES"),
+    ("depend", "DEPENDS"),
+    ("optdepend", "OPTDEPENDS"),
+    ("conflict", "CONFLICTS"),
+    ("provides", "PROVIDES"),
+]
+
+#: Tar extraction options: refuse absolute paths and the like.
+_EXTRACT_KWARGS = {}
+_TAR_FILTER = getattr(tarfile, "tar_filter", None)
+if _TAR_FILTER is not None:
+    _EXTRACT_KWARGS["filter"] = "tar"
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+# Class defs:
+
+class PackageStore:
+    """Unpacked package files, keyed by the package file's SHA-256.
+
+    Each entry is a folder containing "files", the package's payload,
+    and "meta", its .PKGINFO, .MTREE, and .INSTALL, plus the lines of
+    the local database "files" entry. Entries are unpacked into a
+    temp folder and renamed into place, so several processes can
+    share a store safely.
+
+    """
+
+    def __init__(self, root):
+        """Initialize, creating the store folder if needed.
+
+        :param str root: Folder for the store.
+
+        """
+        super().__init__()
+        self.root = root
+        self._digests = {}
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def from_options(cls, options):
+        """Get the store, if the command line asks for one.
+
+        :param options: Parsed command line options.
+        :returns: A new store, or None.
+
+        """
+        if not options.pkg_store:
+            return None
+        cache_dir = get_cache_dir(options)
+        if cache_dir is None:
+            logger.warning("--pkg-store needs a cache: not using it")
+            return None
+        return cls(os.path.join(cache_dir, "packages"))
+
+    def _digest(self, pkg_path):
+        st = os.stat(pkg_path)
+        memo_key = (os.path.abspath(pkg_path), st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(memo_key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(pkg_path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(_HASH_CHUNK_SIZE), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            self._digests[memo_key] = digest
+        return digest
+
+    def get(self, pkg_path):
+        """Get the entry for a package file, unpacking it if needed.
+
+        :param str pkg_path: The package file.
+        :returns: The entry's folder.
+        :rtype: str
+
+        """
+        digest = self._digest(pkg_path)
+        entry = os.path.join(self.root, digest[:2], digest)
+        if os.path.isdir(entry):
+            logger.debug("Found “%s” in the package store", pkg_path)
+            return entry
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(
+            dir=os.path.dirname(entry),
+            prefix=".tmp",
+        )
+        try:
+            logger.info("Unpacking “%s”…", os.path.basename(pkg_path))
+            unpack_package(
+                pkg_path,
+                os.path.join(tmp_entry, "files"),
+                os.path.join(tmp_entry, "meta"),
+            )
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:
+                # Most likely another process has just stored it.
+                if not os.path.isdir(entry):
+                    raise
+        finally:
+            if os.path.isdir(tmp_entry):
+                shutil.rmtree(tmp_entry)
+        return entry
+
+    def install(self, pkg_path, root, explicit=True):
+        """Install a package file into a tree from the store.
+
+        :param str pkg_path: The package file.
+        :param str root: The tree to install into.
+        :param bool explicit: Whether the package was asked for by
+            name, rather than being pulled in as a dependency.
+        :returns: The package's .PKGINFO fields.
+        :rtype: dict
+
+        Files are hardlinked into the tree where possible, and
+        copied otherwise. Install scriptlets are not run.
+
+        """
+        entry = self.get(pkg_path)
+        files_dir = os.path.join(entry, "files")
+        meta_dir = os.path.join(entry, "meta")
+        for dir_path, subdirs, files in os.walk(files_dir):
+            rel_dir = os.path.relpath(dir_path, files_dir)
+            dest_dir = os.path.normpath(os.path.join(root, rel_dir))
+            os.makedirs(dest_dir, exist_ok=True)
+            # os.walk() lists symlinks to folders as subdirs.
+            links = [
+                d for d in subdirs
+                if os.path.islink(os.path.join(dir_path, d))
+            ]
+            for name in files + links:
+                src = os.path.join(dir_path, name)
+                dest = os.path.join(dest_dir, name)
+                if os.path.islink(src):
+                    if not _make_symlink(os.readlink(src), dest):
+                        _copy_link_target(src, dest)
+                else:
+                    link_or_copy(src, dest)
+        pkginfo = read_pkginfo(os.path.join(meta_dir, ".PKGINFO"))
+        write_local_db_entry(root, pkginfo, meta_dir, explicit=explicit)
+        return pkginfo
+
+
+# Helper funcs:
+
+def pacman_cache_dirs():
+    """Get the folders pacman keeps downloaded package files in.
+
+    :returns: Native folder paths, in pacman's search order.
+    :rtype: list
+
+    Pacman-conf prints MSYS2 paths, which are converted with
+    .utils.msys2_native_path().
+
+    """
+    try:
+        output = subprocess.check_output(
+            ["pacman-conf", "CacheDir"],
+            universal_newlines=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        logger.debug("Cannot run pacman-conf", exc_info=True)
+        output = ""
+    dirs = [line.strip() for line in output.splitlines() if line.strip()]
+    dirs = dirs or [DEFAULT_PACMAN_CACHE_DIR]
+    return [msys2_native_path(d) for d in dirs]
+
+
+@contextlib.contextmanager
+def open_package(pkg_path):
+    """Context manager: open a package file as a streaming TarFile.
+
+    :param str pkg_path: A .pkg.tar file, which may be compressed
+        with gzip, bzip2, xz, or zstd. Pacman database files work too.
+
+    The compression is detected from the file's contents. Zstandard
+    is only supported natively by recent Pythons. Otherwise the
+    zstandard module is used if it's installed, or else the zstd
+    command line tool.
+
+    """
+    with open(pkg_path, "rb") as fp:
+        magic = fp.read(len(_ZSTD_MAGIC))
+    if magic != _ZSTD_MAGIC:
+        with tarfile.open(pkg_path, mode="r|*") as tar:
+            yield tar
+        return
+    try:
+        tar = tarfile.open(pkg_path, mode="r|zst")
+    except tarfile.CompressionError:
+        pass
+    else:
+        with tar:
+            yield tar
+        return
+    if zstandard is not None:
+        with open(pkg_path, "rb") as fp:
+            decompressor = zstandard.ZstdDecompressor()
+            with decompressor.stream_reader(fp) as reader:
+                with tarfile.open(fileobj=reader, mode="r|") as tar:
+                    yield tar
+        return
+    proc = subprocess.Popen(
+        ["zstd", "--decompress", "--stdout", "--quiet", pkg_path],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+            yield tar
+    finally:
+        stopped_early = proc.poll() is None
+        if stopped_early:
+            proc.kill()
+        proc.stdout.close()
+        if proc.wait() != 0 and not stopped_early:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def unpack_package(pkg_path, files_dir, meta_dir):
+    """Unpack a package file.
+
+    :param str pkg_path: The package file.
+    :param str files_dir: Where to unpack the payload files.
+    :param str meta_dir: Where to put .PKGINFO, .MTREE, .INSTALL etc.,
+        plus a "files" list in local database format.
+
+    The archive is read in a single streaming pass. Symlinks are made
+    by hand, because tarfile's fallback for them needs to seek. Where
+    symlinks can't be made, the link's target is copied instead, once
+    the whole payload has been unpacked.
+
+    """
+    os.makedirs(files_dir, exist_ok=True)
+    os.makedirs(meta_dir, exist_ok=True)
+    installed = []
+    unlinked = []
+    with open_package(pkg_path) as tar:
+        for member in tar:
+            name = member.name
+            while name.startswith("./"):
+                name = name[2:]
+            if name in _META_MEMBERS:
+                if member.isfile():
+                    data = tar.extractfile(member).read()
+                    with open(os.path.join(meta_dir, name), "wb") as fp:
+                        fp.write(data)
+                continue
+            member.name = name
+            dest = os.path.join(files_dir, *name.rstrip("/").split("/"))
+            # Other packages may be unpacking into the same tree, and
+            # tarfile doesn't allow for the parent dirs existing.
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if not member.isdir():
+                # Replace, never overwrite: it may be a hardlink.
+                if os.path.lexists(dest) and not os.path.isdir(dest):
+                    os.unlink(dest)
+            if member.issym():
+                if _TAR_FILTER is not None:
+                    member = _TAR_FILTER(member, files_dir)
+                if not _make_symlink(member.linkname, dest):
+                    unlinked.append((member.linkname, dest))
+            else:
+                tar.extract(member, path=files_dir, **_EXTRACT_KWARGS)
+            if member.isdir():
+                name = name.rstrip("/") + "/"
+            installed.append(name)
+    # Links to links are copied once their targets exist.
+    while unlinked:
+        pending = []
+        for target, dest in unlinked:
+            src = os.path.join(os.path.dirname(dest), target)
+            if os.path.exists(src):
+                _copy_link_target(src, dest)
+            else:
+                pending.append((target, dest))
+        if len(pending) == len(unlinked):
+            for target, dest in pending:
+                logger.warning(
+                    "Cannot copy “%s” in place of a symlink to it: "
+                    "skipped “%s”",
+                    target, dest,
+                )
+            break
+        unlinked = pending
+    installed.sort()
+    with open(os.path.join(meta_dir, "files"), "w", encoding="utf-8") as fp:
+        fp.write("%FILES%\n")
+        for name in installed:
+            fp.write(name + "\n")
+        fp.write("\n")
+
+
+def _make_symlink(target, dest):
+    """Make a symlink, or return False if that isn't permitted.
+
+    Windows needs a privilege or Developer Mode for symlinks.
+
+    """
+    try:
+        os.symlink(target, dest)
+    except (OSError, NotImplementedError) as e:
+        logger.debug("Cannot symlink “%s” to “%s”: %s", dest, target, e)
+        return False
+    return True
+
+
+def _copy_link_target(src, dest):
+    """Copy or hardlink what a path points to, in place of a symlink."""
+    if os.path.lexists(dest) and not os.path.isdir(dest):
+        os.unlink(dest)
+    if not os.path.exists(src):
+        logger.warning("Dangling symlink “%s”: skipped", dest)
+    elif os.path.isdir(src):
+        if os.path.isdir(dest):
+            logger.warning("Cannot replace folder “%s”: skipped", dest)
+            return
+        shutil.copytree(src, dest, copy_function=link_or_copy)
+    else:
+        link_or_copy(os.path.realpath(src), dest)
+
+
+def install_package(pkg_path, root, explicit=True):
+    """Install a package file straight into a tree.
+
+    :param str pkg_path: The package file.
+    :param str root: The tree to install into.
+    :param bool explicit: Whether the package was asked for by name.
+    :returns: The package's .PKGINFO fields.
+    :rtype: dict
+
+    The package is unpacked in one streaming pass, and its local
+    database entry is written. Install scriptlets are not run.
+
+    """
+    with tempfile.TemporaryDirectory() as meta_dir:
+        unpack_package(pkg_path, root, meta_dir)
+        pkginfo = read_pkginfo(os.path.join(meta_dir, ".PKGINFO"))
+        write_local_db_entry(root, pkginfo, meta_dir, explicit=explicit)
+    return pkginfo
+
+
+def read_pkginfo(path):
+    """Read a .PKGINFO file.
+
+    :param str path: The file.
+    :returns: Mapping of keys to lists of values.
+    :rtype: dict
+
+    """
+    with io.open(path, "r", encoding="utf-8", errors="replace") as fp:
+        return _parse_pkginfo(fp)
+
+
+def read_package_pkginfo(pkg_path):
+    """Read the .PKGINFO inside a package file, without unpacking it.
+
+    :param str pkg_path: The package file.
+    :returns: Mapping of keys to lists of values.
+    :rtype: dict
+    :raises ValueError: if the package has no .PKGINFO.
+
+    Only the start of the archive is read, because .PKGINFO normally
+    comes first.
+
+    """
+    with open_package(pkg_path) as tar:
+        for member in tar:
+            name = member.name
+            while name.startswith("./"):
+                name = name[2:]
+            if name == ".PKGINFO" and member.isfile():
+                data = tar.extractfile(member).read()
+                text = data.decode("utf-8", errors="replace")
+                return _parse_pkginfo(text.splitlines())
+    raise ValueError("No .PKGINFO in %r" % (pkg_path,))
+
+
+def _parse_pkginfo(lines):
+    info = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        key, sep, value = line.partition("=")
+        if not sep:
+            continue
+        info.setdefault(key.strip(), []).append(value.strip())
+    return info
+
+
+def write_local_db_entry(root, pkginfo, meta_dir, explicit=True):
+    """Write a package's entry in a tree's local pacman database.
+
+    :param str root: The tree.
+    :param dict pkginfo: The package's .PKGINFO fields.
+    :param str meta_dir: Folder with the package's metadata files.
+    :param bool explicit: Whether the package was asked for by name.
+
+    Any existing entry for a different version is removed first.
+
+    """
+    local_dir = os.path.join(root, LOCAL_DB_SUBDIR)
+    os.makedirs(local_dir, exist_ok=True)
+    version_file = os.path.join(local_dir, "ALPM_DB_VERSION")
+    if not os.path.exists(version_file):
+        with open(version_file, "w", encoding="utf-8") as fp:
+            fp.write("%d\n" % (ALPM_DB_VERSION,))
+
+    name = pkginfo["pkgname"][0]
+    version = pkginfo["pkgver"][0]
+    for entry_name in os.listdir(local_dir):
+        if entry_name.rsplit("-", 2)[0] == name:
+            shutil.rmtree(os.path.join(local_dir, entry_name))
+    entry_dir = os.path.join(local_dir, "%s-%s" % (name, version))
+    os.makedirs(entry_dir)
+
+    extras = {
+        "INSTALLDATE": [str(int(time.time()))],
+        "REASON": [] if explicit else ["1"],
+        "VALIDATION": ["none"],
+    }
+    with open(os.path.join(entry_dir, "desc"), "w", encoding="utf-8") as fp:
+        for key, section in _DESC_FIELDS:
+            if key is None:
+                values = extras[section]
+            else:
+                values = pkginfo.get(key, [])
+            if not values:
+                continue
+            fp.write("%%%s%%\n" % (section,))
+            for value in values:
+                fp.write(value + "\n")
+            fp.write("\n")
+    shutil.copyfile(
+        os.path.join(meta_dir, "files"),
+        os.path.join(entry_dir, "files"),
+    )
+    for src_name, dest_name in [(".MTREE", "mtree"), (".INSTALL", "install")]:
+        src = os.path.join(meta_dir, src_name)
+        if os.path.exists(src):
+            shutil.copyfile(src, os.path.join(entry_dir, dest_name))
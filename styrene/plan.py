@@ -0,0 +1,507 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Build plans: what a bundle will contain, worked out in advance.
+
+A BuildPlan resolves the dependency closure of a bundle's packages
+from the sync databases, which are read in Python. Nothing is
+installed, so a plan takes seconds rather than minutes. If files
+databases are available too, the paths each package installs can be
+run through the delete rules to predict what the bundle will hold.
+
+"""
+
+from .pacman import parse_desc
+from .pacman import parse_depend
+from .pacman import satisfies
+from .pkgstore import open_package
+from .pkgstore import read_package_pkginfo
+from .inventory import TreeInventory
+from .utils import format_size
+
+import os
+import stat
+import json
+import subprocess
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+_FILE_MODE = stat.S_IFREG | 0o644
+_DIR_MODE = stat.S_IFDIR | 0o755
+
+
+# Class defs:
+
+class BuildPlan:
+    """The packages a bundle needs, and what installing them would do.
+
+    The plan's packages are metadata dicts like those returned by
+    .pacman.LocalPackageDB.metadata(), plus:
+
+    * "repo": the sync database it comes from, or None for a local
+      package file.
+    * "path": the local package file, or None.
+    * "required_by": names of the packages which depend on it. This
+      is empty for the packages asked for by name.
+    * "cached": whether the package file is already downloaded.
+
+    The sizes are ints.
+
+    """
+
+    def __init__(self, targets, sync_dbs, archs=None, assume_installed=(),
+                 local_packages=None, cache_dirs=()):
+        """Resolve the dependency closure of a list of packages.
+
+        :param list targets: Names of the packages or groups asked for.
+        :param list sync_dbs: (repo, path) pairs for the sync
+            databases, in pacman's order of preference.
+        :param archs: Architectures to accept, or None for any.
+        :param list assume_installed: Dependencies to treat as met,
+            as with pacman's --assume-installed.
+        :param dict local_packages: Package files to use instead of
+            the sync databases' packages, by package name.
+        :param list cache_dirs: Pacman's package cache folders, as
+            native paths: see .pkgstore.pacman_cache_dirs().
+
+        Dependencies which can't be met are listed in self.missing.
+
+        """
+        super().__init__()
+        self.targets = list(targets)
+        self.packages = []
+        self.missing = []
+        self.prediction = None
+        self._by_name = {}      # name → packages, in db order
+        self._providers = {}
+        self._groups = {}       # group name → member names, in db order
+        for repo, path in sync_dbs:
+            for meta in read_sync_db(path):
+                if archs is not None and meta.get("architecture") not in archs:
+                    continue
+                meta["repo"] = repo
+                self._add_candidate(meta)
+        self._local = {}
+        for name, path in (local_packages or {}).items():
+            self._local[name] = _read_local_package(path)
+        self._assumed = [parse_depend(a) for a in assume_installed]
+        self._resolve()
+        for meta in self.packages:
+            meta["cached"] = meta["path"] is not None or any(
+                os.path.isfile(os.path.join(d, meta.get("filename", "")))
+                for d in cache_dirs
+            )
+
+    def _add_candidate(self, meta):
+        meta["path"] = None
+        for key in ("download_size", "installed_size"):
+            meta[key] = int(meta.get(key, 0))
+        self._by_name.setdefault(meta["name"], []).append(meta)
+        for group in meta.get("groups", []):
+            members = self._groups.setdefault(group, [])
+            if meta["name"] not in members:
+                members.append(meta["name"])
+        for provision in meta.get("provides", []):
+            prov_name = parse_depend(provision)[0]
+            self._providers.setdefault(prov_name, []).append(meta)
+
+    def _resolve(self):
+        selected = {}   # provided name → packages providing it
+        queue = collections.deque((t, None) for t in self.targets)
+        while queue:
+            dep_str, required_by = queue.popleft()
+            dep = parse_depend(dep_str)
+            meta = self._find_selected(selected, dep)
+            if meta is None and self._is_assumed(dep):
+                continue
+            if meta is None:
+                meta = self._find_satisfier(dep)
+                if meta is None and required_by is None \
+                        and dep_str in self._groups:
+                    # Like pacman --sync, a target that no package
+                    # satisfies can name a group of packages instead.
+                    members = self._groups[dep_str]
+                    logger.debug(
+                        "plan: group “%s” is %s",
+                        dep_str, " ".join(members),
+                    )
+                    queue.extend((m, None) for m in members)
+                    continue
+                if meta is None:
+                    self.missing.append((dep_str, required_by))
+                    continue
+                meta["required_by"] = []
+                self.packages.append(meta)
+                provided = [meta["name"]] + [
+                    parse_depend(p)[0] for p in meta.get("provides", [])
+                ]
+                for name in provided:
+                    selected.setdefault(name, []).append(meta)
+                for d in meta.get("depends_on", []):
+                    queue.append((d, meta["name"]))
+            if required_by and required_by not in meta["required_by"]:
+                meta["required_by"].append(required_by)
+
+    @staticmethod
+    def _find_selected(selected, dep):
+        for meta in selected.get(dep[0], ()):
+            if _satisfies(meta, dep):
+                return meta
+        return None
+
+    def _is_assumed(self, dep):
+        for name, op, version in self._assumed:
+            if satisfies(name, version, [], dep):
+                return True
+        return False
+
+    def _find_satisfier(self, dep):
+        """Find a package for a dependency, roughly as libalpm does.
+
+        Packages with the dependency's name are tried first, in db
+        order, then the packages which provide it.
+
+        """
+        name = dep[0]
+        candidates = self._by_name.get(name, [])
+        if name in self._local:
+            candidates = [self._local[name]] + candidates
+        for meta in candidates:
+            if _satisfies(meta, dep):
+                return meta
+        for meta in self._providers.get(name, ()):
+            if _satisfies(meta, dep):
+                return meta
+        return None
+
+    # Totals:
+
+    @property
+    def installed_size(self):
+        return sum(m["installed_size"] for m in self.packages)
+
+    @property
+    def download_size(self):
+        """Size of the package files which need to be downloaded."""
+        return sum(
+            m["download_size"] for m in self.packages
+            if not m["cached"]
+        )
+
+    # Predicting the bundle's contents:
+
+    def files_inventory(self, root, files_dbs):
+        """Make an inventory of what installing the packages would do.
+
+        :param str root: Where the bundle tree would be.
+        :param list files_dbs: Paths to pacman files databases.
+        :returns: The predicted inventory, or None if the files
+            installed by some package aren't known.
+        :rtype: .inventory.TreeInventory
+
+        File sizes aren't recorded in files databases, so each
+        package's installed size is shared equally among its files.
+
+        """
+        wanted = {
+            "%s-%s" % (m["name"], m["version"]): m
+            for m in self.packages
+            if m["path"] is None
+        }
+        file_lists = {}
+        for path in files_dbs:
+            file_lists.update(read_files_db(path, wanted))
+        for meta in self.packages:
+            if meta["path"] is not None:
+                file_lists[meta["name"]] = _list_package_files(meta["path"])
+            else:
+                entry_name = "%s-%s" % (meta["name"], meta["version"])
+                if entry_name in file_lists:
+                    file_lists[meta["name"]] = file_lists.pop(entry_name)
+        unknown = [m["name"] for m in self.packages
+                   if m["name"] not in file_lists]
+        if unknown:
+            logger.warning(
+                "No files database lists the files in %s",
+                ", ".join(sorted(unknown)),
+            )
+            return None
+        entries = []
+        for meta in self.packages:
+            paths = file_lists[meta["name"]]
+            files = [p for p in paths if not p.endswith("/")]
+            share, remainder = divmod(meta["installed_size"],
+                                      max(1, len(files)))
+            for path in paths:
+                if path.endswith("/"):
+                    entries.append((path, 0, _DIR_MODE))
+                    continue
+                size = share
+                if remainder:
+                    size += 1
+                    remainder -= 1
+                entries.append((path, size, _FILE_MODE))
+        return TreeInventory.from_entries(root, entries)
+
+    def predict(self, inventory, surplus):
+        """Record what the delete rules would leave.
+
+        :param .inventory.TreeInventory inventory: From files_inventory().
+        :param iterable surplus: Its surplus paths, from find_surplus().
+
+        """
+        files = removed_files = 0
+        size = removed_size = 0
+        for relpath, (nbytes, mode, mtime) in inventory.walk():
+            if stat.S_ISREG(mode):
+                files += 1
+                size += nbytes
+        for path in surplus:
+            relpath = inventory.relpath(path)
+            info = inventory.get(relpath)
+            if info is None:
+                continue
+            items = [(relpath, info)]
+            if stat.S_ISDIR(info[1]):
+                items = inventory.walk(relpath)
+            for relpath, (nbytes, mode, mtime) in items:
+                if stat.S_ISREG(mode):
+                    removed_files += 1
+                    removed_size += nbytes
+        self.prediction = {
+            "files": files,
+            "bytes": size,
+            "removed_files": removed_files,
+            "removed_bytes": removed_size,
+            "retained_files": files - removed_files,
+            "retained_bytes": size - removed_size,
+        }
+
+    # Output:
+
+    def as_json(self):
+        """The plan as a JSON-serializable dict."""
+        packages = []
+        for meta in self.packages:
+            packages.append({
+                "name": meta["name"],
+                "version": meta["version"],
+                "repo": meta["repo"],
+                "path": meta["path"],
+                "installed_size": meta["installed_size"],
+                "download_size": meta["download_size"],
+                "cached": meta["cached"],
+                "required_by": meta["required_by"],
+            })
+        return {
+            "targets": self.targets,
+            "packages": packages,
+            "installed_size": self.installed_size,
+            "download_size": self.download_size,
+            "missing": [
+                {"depend": dep, "required_by": required_by}
+                for (dep, required_by) in self.missing
+            ],
+            "prediction": self.prediction,
+        }
+
+    def write_json(self, fp):
+        """Write the plan to a text file, as JSON."""
+        json.dump(self.as_json(), fp, indent=2)
+        fp.write("\n")
+
+    def write_text(self, fp):
+        """Write the plan to a text file, for reading."""
+
+        def _p(*args):
+            print(*args, file=fp)
+
+        _p("Build plan for %s" % (" ".join(self.targets),))
+        _p()
+        row = "{:>10} {:>10}  {:<8} {}"
+        _p(row.format("INSTALLED", "DOWNLOAD", "REPO", "PACKAGE"))
+        for meta in sorted(self.packages, key=lambda m: m["name"]):
+            download = "cached"
+            if not meta["cached"]:
+                download = format_size(meta["download_size"])
+            _p(row.format(
+                format_size(meta["installed_size"]),
+                download,
+                meta["repo"] or "local",
+                "%s %s" % (meta["name"], meta["version"]),
+            ))
+        _p()
+        _p("Packages: %d" % (len(self.packages),))
+        _p("Installed size: %s" % (format_size(self.installed_size),))
+        _p("Download size: %s" % (format_size(self.download_size),))
+
+        if self.missing:
+            _p()
+            _p("Dependencies that can't be met:")
+            for dep, required_by in self.missing:
+                _p("    %s (required by %s)" % (dep, required_by or "spec"))
+
+        _p()
+        _p("Predicted bundle contents:")
+        prediction = self.prediction
+        if prediction is None:
+            _p("    (no files databases: run “pacman -Fy”)")
+            return
+        for label, files_key, bytes_key in [
+            ("Installed", "files", "bytes"),
+            ("Removed", "removed_files", "removed_bytes"),
+            ("Retained", "retained_files", "retained_bytes"),
+        ]:
+            _p("    %s: %d files, about %s" % (
+                label, prediction[files_key],
+                format_size(prediction[bytes_key]),
+            ))
+
+    def log_summary(self):
+        """Log the headline figures, and the dependencies not met."""
+        mib = 1024.0 * 1024.0
+        logger.info(
+            "plan: %d packages, %.1f MiB installed, %.1f MiB to download",
+            len(self.packages),
+            self.installed_size / mib,
+            self.download_size / mib,
+        )
+        if self.prediction is not None:
+            logger.info(
+                "plan: the bundle would keep %d of %d files, "
+                "about %.1f MiB",
+                self.prediction["retained_files"],
+                self.prediction["files"],
+                self.prediction["retained_bytes"] / mib,
+            )
+        for dep, required_by in self.missing:
+            logger.error(
+                "plan: cannot find a package for “%s” (required by %s)",
+                dep, required_by or "the spec",
+            )
+
+
+# Helper funcs:
+
+def read_sync_db(path):
+    """Read the package entries in a pacman sync database.
+
+    :param str path: A .db file.
+    :returns: Iterator yielding metadata dicts: see .pacman.parse_desc().
+
+    """
+    with open_package(path) as tar:
+        for member in tar:
+            if not (member.isfile() and member.name.endswith("/desc")):
+                continue
+            data = tar.extractfile(member).read()
+            text = data.decode("utf-8", errors="replace")
+            yield parse_desc(text.splitlines())
+
+
+def read_files_db(path, entry_names):
+    """Read the file lists in a pacman files database.
+
+    :param str path: A .files file.
+    :param entry_names: Entries to read, named "{name}-{version}".
+    :returns: Mapping of entry names to lists of installed paths.
+        Folder paths end with "/".
+    :rtype: dict
+
+    """
+    file_lists = {}
+    with open_package(path) as tar:
+        for member in tar:
+            entry_name, sep, name = member.name.rpartition("/")
+            if name != "files" or entry_name not in entry_names:
+                continue
+            data = tar.extractfile(member).read()
+            text = data.decode("utf-8", errors="replace")
+            paths = []
+            section = None
+            for line in text.splitlines():
+                if line.startswith("%") and line.endswith("%"):
+                    section = line
+                elif line and section == "%FILES%":
+                    paths.append(line)
+            file_lists[entry_name] = paths
+    return file_lists
+
+
+def get_repo_list():
+    """Get the names of the sync repositories, in pacman's order.
+
+    :returns: Repository names, or None if pacman-conf can't be run.
+    :rtype: list
+
+    """
+    try:
+        output = subprocess.check_output(
+            ["pacman-conf", "--repo-list"],
+            universal_newlines=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        logger.debug("Cannot run pacman-conf", exc_info=True)
+        return None
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def _satisfies(meta, dep):
+    return satisfies(
+        meta["name"], meta["version"],
+        meta.get("provides", []),
+        dep,
+    )
+
+
+def _read_local_package(path):
+    """Metadata for a package file, in the same form as a sync db's."""
+    info = read_package_pkginfo(path)
+    return {
+        "name": info["pkgname"][0],
+        "version": info["pkgver"][0],
+        "architecture": info.get("arch", [""])[0],
+        "filename": os.path.basename(path),
+        "installed_size": int(info.get("size", ["0"])[0]),
+        "download_size": 0,
+        "depends_on": info.get("depend", []),
+        "provides": info.get("provides", []),
+        "repo": None,
+        "path": path,
+    }
+
+
+def _list_package_files(path):
+    """The paths a package file would install, like a files db's list."""
+    paths = []
+    with open_package(path) as tar:
+        for member in tar:
+            name = member.name
+            while name.startswith("./"):
+                name = name[2:]
+            if not name or name.startswith("."):
+                continue
+            if member.isdir():
+                name = name.rstrip("/") + "/"
+            paths.append(name)
+    return paths
@@ -0,0 +1,201 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Build stages, skipped on re-runs if their inputs are unchanged."""
+
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Fingerprinting helpers:
+
+def fingerprint(*parts):
+    """Returns a hex digest for a JSON-serializable structure."""
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def file_digest(path, chunk_size=1024*1024):
+    """Returns the hex digest of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_stat_info(path):
+    """Returns cheap identifying info for a file: (size, mtime).
+
+    Missing files are represented as None.
+
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def files_fingerprint(paths, contents=True):
+    """Returns a fingerprint for a list of files.
+
+    :param list paths: The files to fingerprint.
+    :param bool contents: Hash file contents, not just size and mtime.
+
+    """
+    info = []
+    for path in sorted(paths):
+        if contents and os.path.isfile(path):
+            info.append((os.path.basename(path), file_digest(path)))
+        else:
+            info.append((os.path.basename(path), file_stat_info(path)))
+    return fingerprint(info)
+
+
+def tree_fingerprint(root, contents=True):
+    """Returns a fingerprint for the files in a folder tree.
+
+    :param str root: The folder to fingerprint.
+    :param bool contents: Hash file contents, not just size and mtime.
+
+    A missing folder has a fingerprint too.
+
+    """
+    info = []
+    for dir_path, subdirs, files in os.walk(root):
+        subdirs.sort()
+        for file_name in sorted(files):
+            path = os.path.join(dir_path, file_name)
+            relpath = os.path.relpath(path, root).replace(os.path.sep, "/")
+            if contents:
+                info.append((relpath, file_digest(path)))
+            else:
+                info.append((relpath, file_stat_info(path)))
+    return fingerprint(info)
+
+
+# Class defs:
+
+class StageRecord:
+    """Fingerprints of the build stages which made a bundle tree.
+
+    Each stage is named, and its fingerprint is derived from its
+    explicit inputs and the output fingerprints of the upstream stages
+    it depends on. When a bundle is built again into the same tree,
+    stages whose fingerprint has not changed are skipped.
+
+    The record is stored as a JSON file alongside the bundle tree.
+    A stage's entry is removed before the stage runs, and rewritten
+    only when it completes, so interrupted stages always run again.
+
+    """
+
+    #: Suffix for the record file, appended to the bundle tree's path.
+    FILE_SUFFIX = "-stages.json"
+
+    def __init__(self, root, enabled=True):
+        """Loads the stage record for a bundle tree.
+
+        :param str root: The bundle tree.
+        :param bool enabled: Whether stages may be skipped at all.
+
+        When not enabled, every stage runs, but the record is still
+        written so that later runs can use it.
+
+        """
+        super().__init__()
+        self.path = os.path.normpath(root) + self.FILE_SUFFIX
+        self.enabled = enabled
+        self._recorded = {}
+        self._outputs = {}
+        if enabled and os.path.isfile(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as fp:
+                    self._recorded = dict(json.load(fp))
+            except Exception:
+                logger.warning(
+                    "Cannot read “%s”: all stages will be rerun.",
+                    self.path,
+                )
+                self._recorded = {}
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump(self._recorded, fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def outputs(self, name):
+        """The output fingerprint of a stage that ran or was skipped."""
+        return self._outputs.get(name)
+
+    def run(self, name, func, inputs=(), upstream=(), outputs=None,
+            always=False):
+        """Runs a stage, unless its fingerprint is unchanged.
+
+        :param str name: Unique name for the stage.
+        :param callable func: Runs the stage, and returns its result.
+        :param list inputs: JSON-serializable stage inputs.
+        :param list upstream: Names of the stages this one depends on.
+        :param callable outputs: Returns the stage's output fingerprint.
+        :param bool always: Always run the stage.
+        :returns: The result of func(), or its recorded result.
+
+        Stage results must be JSON-serializable too, because they're
+        recorded for use when the stage is skipped.
+
+        If an outputs() callable is given, it is also checked when
+        deciding whether to skip the stage. This allows stages to be
+        rerun if their outputs were deleted or altered. Stages with no
+        outputs() use their input fingerprint as their output
+        fingerprint.
+
+        """
+        upstream_outputs = [(u, self.outputs(u)) for u in upstream]
+        inputs_fp = fingerprint(name, list(inputs), upstream_outputs)
+
+        recorded = self._recorded.get(name)
+        if self.enabled and recorded and not always:
+            up_to_date = (recorded.get("inputs") == inputs_fp)
+            if up_to_date and outputs is not None:
+                up_to_date = (recorded.get("outputs") == outputs())
+            if up_to_date:
+                logger.info("Stage “%s” is up to date, skipping it.", name)
+                self._outputs[name] = recorded.get("outputs")
+                return recorded.get("result")
+
+        logger.debug("Stage “%s”: running (inputs %s)", name, inputs_fp)
+        self._recorded.pop(name, None)
+        self._save()
+        result = func()
+        outputs_fp = inputs_fp
+        if outputs is not None:
+            outputs_fp = outputs()
+        self._outputs[name] = outputs_fp
+        self._recorded[name] = {
+            "inputs": inputs_fp,
+            "outputs": outputs_fp,
+            "result": result,
+        }
+        self._save()
+        return result
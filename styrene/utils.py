@@ -21,10 +21,16 @@
 import re
 import os
 import os.path
+import shutil
+import stat
+import sys
+import urllib.parse
 import logging
 
 logger = logging.getLogger(__name__)
 
+_MSYS2_DRIVE_MOUNT_RE = re.compile(r"^/(?:cygdrive/)?([a-zA-Z])(?:/(.*))?$")
+
 
 def nsis_escape(s):
     """Escapes a string for interpolating into an NSIS quoted string."""
@@ -89,6 +95,61 @@ def findexe(basename, prefix, exts=(".exe",)):
     return None
 
 
+def find_msys2_root():
+    """Locate the root folder of the running MSYS2 installation.
+
+    :returns: Native path to the MSYS2 root folder, or None.
+    :rtype: str
+
+    The root is found by looking for pacman on the PATH. In an MSYS2
+    installation it lives in ``usr/bin`` beneath the root.
+
+    """
+    pacman = shutil.which("pacman")
+    if not pacman:
+        return None
+    bin_dir = os.path.dirname(os.path.abspath(pacman))
+    usr_dir, bin_name = os.path.split(bin_dir)
+    root, usr_name = os.path.split(usr_dir)
+    if (bin_name, usr_name) != ("bin", "usr"):
+        return None
+    return root
+
+
+def msys2_native_path(path):
+    """Convert a path or file URL printed by an MSYS2 tool to a native path.
+
+    :param str path: A POSIX path like "/var/cache/pacman/pkg/", or a
+        "file://" URL like those pacman --print gives for local files.
+    :returns: The same location as a path this process can open.
+    :rtype: str
+
+    MSYS2's tools see its root folder as "/", but native Windows
+    Pythons resolve "/var" against the current drive. Absolute POSIX
+    paths are therefore rebased onto find_msys2_root(), except for
+    MSYS2's "/c/..." style drive mounts on Windows. Anything else is
+    returned as it is.
+
+    """
+    if path.startswith("file://"):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path)
+    if not path.startswith("/") or path.startswith("//"):
+        return path
+    if os.name == "nt":
+        m = _MSYS2_DRIVE_MOUNT_RE.match(path)
+        if m:
+            drive, rest = m.groups()
+            return os.path.normpath("%s:/%s" % (drive.upper(), rest or ""))
+    root = find_msys2_root()
+    if root is None:
+        return path
+    parts = [p for p in path.split("/") if p]
+    native = os.path.join(root, *parts)
+    if path.endswith("/") and parts:
+        native = os.path.join(native, "")
+    return native
+
+
 def js_escape(s):
     """Escapes a string for interpolation into a JS string constant."""
     s = str(s)
@@ -114,6 +175,13 @@ def c_escape(s):
     return s
 
 
+def format_size(nbytes):
+    """Format a size in bytes as KiB or MiB, for reports."""
+    if nbytes < 1024 * 1024:
+        return "%.1f KiB" % (nbytes / 1024.0,)
+    return "%.1f MiB" % (nbytes / (1024.0 * 1024.0),)
+
+
 def boolify(s):
     """Lax convertsion of strings to bools."""
     s = str(s).strip()
@@ -126,7 +194,7 @@ def boolify(s):
     )
 
 
-def fix_tree_perms(root, filemask=0o600, dirmask=0o700):
+def fix_tree_perms(root, filemask=0o600, dirmask=0o700, inventory=None):
     """Recursively set file/folder permission bits to allow removal.
 
     The defaults are designed to allow the tree to be removed with
@@ -135,7 +203,24 @@ def fix_tree_perms(root, filemask=0o600, dirmask=0o700):
     is installed to its temporary spaces, so we have to do this before
     any recursive cleanups.
 
+    If a .inventory.TreeInventory containing the folder is given,
+    the modes recorded in it are used instead of calling os.stat().
+
     """
+    if inventory is not None:
+        relpath = inventory.relpath(root)
+        for item, (size, mode, mtime) in inventory.walk(relpath):
+            mask = dirmask if stat.S_ISDIR(mode) else filemask
+            if (mode & mask) == mask:
+                continue
+            path = inventory.abspath(item)
+            logger.debug(
+                "fix_tree_perms: adding 0o%03o to %r",
+                mode, path,
+            )
+            os.chmod(path, (mode | mask))
+            inventory.set_mode(item, mode | mask)
+        return
     for dirpath, dirnames, filenames in os.walk(root, topdown=True):
         for names, mask in [(dirnames, dirmask), (filenames, filemask)]:
             for name in names:
@@ -148,3 +233,74 @@ def fix_tree_perms(root, filemask=0o600, dirmask=0o700):
                     mode, path,
                 )
                 os.chmod(path, (mode | mask))
+
+
+def remove_path(path, is_dir):
+    """Remove a file, or a folder and everything in it.
+
+    :param str path: What to remove.
+    :param bool is_dir: Whether path is a folder.
+
+    Permissions are only fixed up if removal fails the first time,
+    most likely because of read-only files, and then it's retried.
+    This function is safe to call from several threads at once for
+    different paths.
+
+    """
+    remove = shutil.rmtree if is_dir else os.unlink
+    try:
+        remove(path)
+        return
+    except OSError as e:
+        logger.debug("Cannot remove %r (%s), fixing permissions", path, e)
+    if is_dir:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+        os.chmod(path, mode | 0o700)
+        fix_tree_perms(path)
+    else:
+        os.chmod(path, 0o600)
+    remove(path)
+
+
+class BufferedLogger:
+    """Collects log messages, and passes them on as a group later.
+
+    This is used to keep the messages from concurrent workers grouped
+    together. It supports the common Logger methods.
+
+    """
+
+    def __init__(self, logger):
+        """Initialize, buffering for a Logger.
+
+        :param logging.Logger logger: Where to send buffered messages.
+
+        """
+        super().__init__()
+        self._logger = logger
+        self._records = []
+
+    def log(self, level, msg, *args, exc_info=None):
+        self._records.append((level, msg, args, exc_info))
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
+
+    def exception(self, msg, *args):
+        self.log(logging.ERROR, msg, *args, exc_info=sys.exc_info())
+
+    def flush(self):
+        """Send all buffered messages to the real logger."""
+        records = self._records
+        self._records = []
+        for level, msg, args, exc_info in records:
+            self._logger.log(level, msg, *args, exc_info=exc_info)
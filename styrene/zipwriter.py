@@ -0,0 +1,728 @@
+# Copyright © 2017 Andrew Chadwick.
+#
+# This file is part of ’Styrene.
+#
+# ’Styrene is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# ’Styrene is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ’Styrene.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Zipfile writer which compresses members in parallel.
+
+Python's zipfile module compresses one member at a time, and so does
+Info-ZIP's zip. Deflating is CPU-bound, but zlib releases the GIL
+while it works, so this module compresses members concurrently in a
+pool of threads and writes them out in a fixed order. The output can
+be read by zipfile or any other unzip tool, and uses the ZIP64
+extensions when it needs to.
+
+When a previous version of the zipfile exists, the compressed data of
+members whose content has not changed can be copied straight across
+from it, and only new or changed files are compressed.
+
+Ref: https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+
+"""
+
+from .inventory import TreeInventory
+
+import os
+import stat
+import time
+import fnmatch
+import zlib
+import shutil
+import struct
+import tempfile
+import zipfile
+import concurrent.futures
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Consts:
+
+_LOCAL_HEADER_FMT = "<IHHHHHIIIHH"
+_LOCAL_HEADER_SIG = 0x04034b50
+_LOCAL_HEADER_SIZE = struct.calcsize(_LOCAL_HEADER_FMT)
+_CENTRAL_HEADER_FMT = "<IHHHHHHIIIHHHHHII"
+_CENTRAL_HEADER_SIG = 0x02014b50
+_END_RECORD_FMT = "<IHHHHIIH"
+_END_RECORD_SIG = 0x06054b50
+_END_RECORD64_FMT = "<IQHHIIQQQQ"
+_END_RECORD64_SIG = 0x06064b50
+_END_LOCATOR64_FMT = "<IIQI"
+_END_LOCATOR64_SIG = 0x07064b50
+_ZIP64_EXTRA_ID = 0x0001
+
+#: Sizes, offsets, and counts above these need ZIP64 fields.
+#: Like zipfile, stay clear of readers that use signed 32-bit ints.
+_ZIP64_LIMIT = (1 << 31) - 1
+_ZIP64_COUNT_LIMIT = (1 << 16) - 1
+
+#: Placeholders for values which are in the ZIP64 fields instead.
+_ZIP32_MAX = 0xffffffff
+_ZIP32_COUNT_MAX = 0xffff
+
+_VERSION_DEFAULT = 20   # 2.0: deflate, folders
+_VERSION_ZIP64 = 45    # 4.5: ZIP64
+_CREATE_SYSTEM_UNIX = 3   # st_mode in the high bits of external_attr
+_FLAG_ENCRYPTED = 0x0001
+_FLAG_UTF8 = 0x0800
+_MSDOS_DIR_ATTR = 0x10
+
+#: Members bigger than this are compressed to a spooled temp file.
+_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+#: Read size for member data.
+_CHUNK_SIZE = 1024 * 1024
+
+#: How much of a file "auto" compression looks at.
+_AUTO_SAMPLE_SIZE = 64 * 1024
+
+#: Files are stored if a sample doesn't shrink to this ratio or less.
+_AUTO_MAX_RATIO = 0.95
+
+#: Policy rules for files that are compressed already.
+DEFAULT_COMPRESSION_RULES = [
+    (pattern, 0) for pattern in [
+        "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp",
+        "*.gz", "*.tgz", "*.bz2", "*.xz", "*.txz", "*.lz", "*.lzma",
+        "*.zst", "*.zip", "*.7z", "*.cab", "*.jar", "*.whl", "*.egg",
+        "*.woff", "*.woff2", "*.ogg", "*.oga", "*.flac", "*.mp3",
+        "*.mp4", "*.webm",
+    ]
+]
+
+
+# Class defs:
+
+class ZipStats:
+    """Statistics about a zipfile that was written."""
+
+    def __init__(self):
+        super().__init__()
+        self.files = 0
+        self.dirs = 0
+        self.reused = 0
+        self.stored = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def log_summary(self, name):
+        """Log the size and throughput of the write."""
+        mib = 1024.0 * 1024.0
+        rate = 0.0
+        if self.seconds > 0:
+            rate = self.bytes_in / mib / self.seconds
+        logger.info(
+            "%s: %d files, %.1f MiB compressed to %.1f MiB "
+            "in %.1fs (%.1f MiB/s)",
+            name, self.files,
+            self.bytes_in / mib, self.bytes_out / mib,
+            self.seconds, rate,
+        )
+        if self.stored:
+            logger.info(
+                "%s: stored %d files without compression",
+                name, self.stored,
+            )
+        if self.reused:
+            logger.info(
+                "%s: reused %d unchanged files from the previous zipfile",
+                name, self.reused,
+            )
+
+
+class CompressionPolicy:
+    """Decides how each member of a zipfile is compressed.
+
+    A policy is a list of (pattern, setting) rules. The last rule
+    whose pattern matches a member's name wins. Patterns containing
+    a "/" are matched against the whole name, and "*" in them can
+    match across folders. Other patterns are matched against the
+    final part of the name only. Matching ignores case.
+
+    A setting is a deflate level from 1 to 9, 0 for storing the file
+    uncompressed, or AUTO. AUTO compresses a sample from the start of
+    the file quickly, and stores the file if the sample doesn't
+    shrink much. Members matching no rule use the zipfile's level.
+
+    """
+
+    AUTO = "auto"
+    STORE = "store"
+
+    def __init__(self, rules=DEFAULT_COMPRESSION_RULES):
+        """Initialize with a list of rules.
+
+        :param list rules: Sequence of (pattern, setting) pairs.
+
+        """
+        super().__init__()
+        self._rules = []
+        for pattern, setting in rules:
+            pattern = pattern.lower()
+            self._rules.append((pattern, "/" in pattern, setting))
+        self._rules.reverse()
+
+    @classmethod
+    def from_spec(cls, spec):
+        """Parse a policy from a bundle spec string.
+
+        :param str spec: Whitespace-separated "pattern=setting" words.
+        :returns: A policy with these rules after the default ones.
+        :raises ValueError: if the spec is invalid.
+
+        Settings are "store", "auto", or a deflate level from 0 to 9.
+
+        """
+        rules = list(DEFAULT_COMPRESSION_RULES)
+        for word in spec.split():
+            pattern, sep, setting = word.rpartition("=")
+            if not (sep and pattern and setting):
+                raise ValueError(
+                    "Compression rule %r is not pattern=setting" % (word,)
+                )
+            setting = setting.lower()
+            if setting == cls.STORE:
+                setting = 0
+            elif setting != cls.AUTO:
+                try:
+                    setting = int(setting)
+                except ValueError:
+                    setting = -1
+                if not (0 <= setting <= 9):
+                    raise ValueError(
+                        "Compression setting in %r must be store, auto, "
+                        "or a level from 0 to 9" % (word,)
+                    )
+            rules.append((pattern, setting))
+        return cls(rules)
+
+    def get(self, name, default=None):
+        """Get the setting for a member name.
+
+        :param str name: Member name, with "/" separators.
+        :param default: Returned if no rule matches.
+        :returns: A deflate level, 0 to store, or AUTO.
+
+        """
+        name = name.lower()
+        basename = name.rsplit("/", 1)[-1]
+        for pattern, match_path, setting in self._rules:
+            subject = name if match_path else basename
+            if fnmatch.fnmatchcase(subject, pattern):
+                return setting
+        return default
+
+
+class _Member:
+    """A file or folder which is to be written to the zipfile."""
+
+    def __init__(self, name, path, size, mode, mtime):
+        super().__init__()
+        self.name = name
+        self.path = path
+        self.is_dir = name.endswith("/")
+        self.size = 0 if self.is_dir else size
+        self.mode = mode
+        self.mtime = mtime
+        # Filled in when compressed
+        self.method = zipfile.ZIP_STORED
+        self.crc = 0
+        self.compress_size = 0
+        self.data = None    # see _ZipFileWriter.write_member()
+        # Filled in when written
+        self.header_offset = 0
+
+    @property
+    def date_time(self):
+        t = time.localtime(self.mtime)
+        if t.tm_year < 1980:
+            return (1980, 1, 1, 0, 0, 0)
+        return t[0:6]
+
+    @property
+    def dos_date_time(self):
+        dt = self.date_time
+        dos_date = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+        dos_time = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+        return (dos_date, dos_time)
+
+    @property
+    def external_attr(self):
+        attr = (self.mode & 0xffff) << 16
+        if self.is_dir:
+            attr |= _MSDOS_DIR_ATTR
+        return attr
+
+    @property
+    def encoded_name(self):
+        try:
+            return (self.name.encode("ascii"), 0)
+        except UnicodeEncodeError:
+            return (self.name.encode("utf-8"), _FLAG_UTF8)
+
+
+class _PreviousZip:
+    """An earlier version of a zipfile, for reusing compressed data."""
+
+    def __init__(self, path):
+        """Read the central directory of a previous zipfile.
+
+        :param str path: The zipfile to read.
+        :raises zipfile.BadZipFile: if it isn't a readable zipfile.
+
+        """
+        super().__init__()
+        self.path = path
+        with zipfile.ZipFile(path, "r") as zf:
+            self._infos = {i.filename: i for i in zf.infolist()}
+        self._fp = open(path, "rb")
+
+    def close(self):
+        self._fp.close()
+
+    def find(self, member):
+        """Find a reusable entry that may match a member.
+
+        :param _Member member: The member about to be written.
+        :returns: An entry with the same name and size, or None.
+        :rtype: zipfile.ZipInfo
+
+        The caller must also compare CRCs before reusing the entry.
+
+        """
+        info = self._infos.get(member.name)
+        if info is None or info.is_dir():
+            return None
+        if info.file_size != member.size:
+            return None
+        if info.compress_type not in (zipfile.ZIP_STORED,
+                                      zipfile.ZIP_DEFLATED):
+            return None
+        if info.flag_bits & _FLAG_ENCRYPTED:
+            return None
+        return info
+
+    def copy_raw(self, info, fp):
+        """Copy an entry's compressed data, as is, to a file."""
+        self._fp.seek(info.header_offset)
+        header = self._fp.read(_LOCAL_HEADER_SIZE)
+        fields = struct.unpack(_LOCAL_HEADER_FMT, header)
+        if fields[0] != _LOCAL_HEADER_SIG:
+            raise zipfile.BadZipFile(
+                "Bad local header for %r in %r" % (info.filename, self.path)
+            )
+        name_len, extra_len = fields[-2:]
+        self._fp.seek(name_len + extra_len, os.SEEK_CUR)
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = self._fp.read(min(remaining, _CHUNK_SIZE))
+            if not chunk:
+                raise zipfile.BadZipFile(
+                    "Truncated data for %r in %r"
+                    % (info.filename, self.path)
+                )
+            fp.write(chunk)
+            remaining -= len(chunk)
+
+
+class _ReusedData:
+    """Member data to be copied from a previous zipfile."""
+
+    def __init__(self, previous, info):
+        super().__init__()
+        self.previous = previous
+        self.info = info
+
+    def copy_to(self, fp):
+        self.previous.copy_raw(self.info, fp)
+
+
+class _ZipFileWriter:
+    """Low-level writer for precompressed zipfile members."""
+
+    def __init__(self, fp):
+        super().__init__()
+        self._fp = fp
+        self._members = []
+
+    def write_member(self, member):
+        """Write a member's local header and data.
+
+        The member's data may be bytes, a file object positioned at
+        the start of the compressed data, a _ReusedData, or None if
+        the member's file is to be copied uncompressed.
+
+        """
+        fp = self._fp
+        member.header_offset = fp.tell()
+        name, flags = member.encoded_name
+        dos_date, dos_time = member.dos_date_time
+        zip64 = (member.size > _ZIP64_LIMIT
+                 or member.compress_size > _ZIP64_LIMIT)
+        extra = b""
+        file_size = member.size
+        compress_size = member.compress_size
+        version = _VERSION_DEFAULT
+        if zip64:
+            extra = struct.pack(
+                "<HHQQ", _ZIP64_EXTRA_ID, 16,
+                member.size, member.compress_size,
+            )
+            file_size = compress_size = _ZIP32_MAX
+            version = _VERSION_ZIP64
+        header = struct.pack(
+            _LOCAL_HEADER_FMT,
+            _LOCAL_HEADER_SIG,
+            version,
+            flags,
+            member.method,
+            dos_time, dos_date,
+            member.crc,
+            compress_size,
+            file_size,
+            len(name),
+            len(extra),
+        )
+        fp.write(header)
+        fp.write(name)
+        fp.write(extra)
+        if member.is_dir:
+            pass
+        elif member.data is None:
+            with open(member.path, "rb") as src:
+                shutil.copyfileobj(src, fp, _CHUNK_SIZE)
+        elif isinstance(member.data, bytes):
+            fp.write(member.data)
+        elif isinstance(member.data, _ReusedData):
+            member.data.copy_to(fp)
+        else:
+            shutil.copyfileobj(member.data, fp, _CHUNK_SIZE)
+            member.data.close()
+        member.data = None
+        self._members.append(member)
+
+    def write_central_directory(self):
+        """Write the central directory and end records."""
+        fp = self._fp
+        cd_offset = fp.tell()
+        for member in self._members:
+            name, flags = member.encoded_name
+            dos_date, dos_time = member.dos_date_time
+            extra_fields = []
+            file_size = member.size
+            compress_size = member.compress_size
+            header_offset = member.header_offset
+            if file_size > _ZIP64_LIMIT:
+                extra_fields.append(file_size)
+                file_size = _ZIP32_MAX
+            if compress_size > _ZIP64_LIMIT:
+                extra_fields.append(compress_size)
+                compress_size = _ZIP32_MAX
+            if header_offset > _ZIP64_LIMIT:
+                extra_fields.append(header_offset)
+                header_offset = _ZIP32_MAX
+            extra = b""
+            version = _VERSION_DEFAULT
+            if extra_fields:
+                extra = struct.pack(
+                    "<HH" + "Q" * len(extra_fields),
+                    _ZIP64_EXTRA_ID, 8 * len(extra_fields),
+                    *extra_fields
+                )
+                version = _VERSION_ZIP64
+            header = struct.pack(
+                _CENTRAL_HEADER_FMT,
+                _CENTRAL_HEADER_SIG,
+                _CREATE_SYSTEM_UNIX << 8 | version,
+                version,
+                flags,
+                member.method,
+                dos_time, dos_date,
+                member.crc,
+                compress_size,
+                file_size,
+                len(name),
+                len(extra),
+                0,  # comment length
+                0,  # disk number start
+                0,  # internal attrs
+                member.external_attr,
+                header_offset,
+            )
+            fp.write(header)
+            fp.write(name)
+            fp.write(extra)
+        cd_end = fp.tell()
+        cd_size = cd_end - cd_offset
+        count = len(self._members)
+
+        zip64 = (count >= _ZIP64_COUNT_LIMIT
+                 or cd_offset > _ZIP64_LIMIT
+                 or cd_size > _ZIP64_LIMIT)
+        if zip64:
+            record = struct.pack(
+                _END_RECORD64_FMT,
+                _END_RECORD64_SIG,
+                struct.calcsize(_END_RECORD64_FMT) - 12,
+                _CREATE_SYSTEM_UNIX << 8 | _VERSION_ZIP64,
+                _VERSION_ZIP64,
+                0, 0,  # this disk, disk with the central dir
+                count, count,
+                cd_size, cd_offset,
+            )
+            locator = struct.pack(
+                _END_LOCATOR64_FMT,
+                _END_LOCATOR64_SIG,
+                0,  # disk with the ZIP64 end record
+                cd_end,
+                1,  # total disks
+            )
+            fp.write(record)
+            fp.write(locator)
+            count = _ZIP32_COUNT_MAX
+            cd_size = _ZIP32_MAX
+            cd_offset = _ZIP32_MAX
+        record = struct.pack(
+            _END_RECORD_FMT,
+            _END_RECORD_SIG,
+            0, 0,  # this disk, disk with the central dir
+            count, count,
+            cd_size, cd_offset,
+            0,  # comment length
+        )
+        fp.write(record)
+
+
+# Helper funcs:
+
+def _file_crc(path):
+    crc = 0
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _sample_is_compressible(path):
+    """Test whether the start of a file deflates worthwhile."""
+    with open(path, "rb") as fp:
+        sample = fp.read(_AUTO_SAMPLE_SIZE)
+    if not sample:
+        return False
+    compressed = zlib.compress(sample, 1)
+    return len(compressed) <= len(sample) * _AUTO_MAX_RATIO
+
+
+def _compress_member(member, level, previous=None, policy=None):
+    """Compress a member's data. Runs in a worker thread.
+
+    The compression level for the member comes from the policy, if
+    there is one, or the level param. See CompressionPolicy.
+
+    If the previous zipfile has a suitable entry with the same name,
+    size and CRC, its compressed data is reused instead.
+
+    Small members are compressed into memory. Larger ones are
+    compressed into a spooled temp file, to bound memory use.
+    If deflating doesn't make the data any smaller, the member is
+    stored uncompressed instead, and its data is copied from its
+    file when it's written.
+
+    """
+    if member.is_dir:
+        return member
+    setting = level
+    if policy is not None:
+        setting = policy.get(member.name, level)
+    if setting == CompressionPolicy.AUTO:
+        setting = level if _sample_is_compressible(member.path) else 0
+    level = setting
+    if previous is not None:
+        info = previous.find(member)
+        if level == 0 and info is not None:
+            if info.compress_type != zipfile.ZIP_STORED:
+                info = None
+        if info is not None:
+            crc = _file_crc(member.path)
+            if crc == info.CRC:
+                member.crc = crc
+                member.method = info.compress_type
+                member.compress_size = info.compress_size
+                member.data = _ReusedData(previous, info)
+                return member
+    if level == 0:
+        member.crc = _file_crc(member.path)
+        member.method = zipfile.ZIP_STORED
+        member.compress_size = member.size
+        member.data = None
+        return member
+    crc = 0
+    if member.size <= _SPOOL_MAX_SIZE:
+        out = None
+        chunks = []
+    else:
+        out = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+    compress_size = 0
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    with open(member.path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            cdata = compressor.compress(chunk)
+            compress_size += len(cdata)
+            if out is None:
+                chunks.append(cdata)
+            else:
+                out.write(cdata)
+        cdata = compressor.flush()
+        compress_size += len(cdata)
+        if out is None:
+            chunks.append(cdata)
+        else:
+            out.write(cdata)
+    member.crc = crc
+    if compress_size < member.size:
+        member.method = zipfile.ZIP_DEFLATED
+        member.compress_size = compress_size
+        if out is None:
+            member.data = b"".join(chunks)
+        else:
+            out.seek(0)
+            member.data = out
+    else:
+        if out is not None:
+            out.close()
+        member.method = zipfile.ZIP_STORED
+        member.compress_size = member.size
+        member.data = None
+    return member
+
+
+def _list_members(root, inventory=None):
+    """List the files and folders in a tree, in a fixed order.
+
+    Folders come before their contents, and names are sorted
+    component by component. If an inventory of the tree is given,
+    it's used instead of scanning the tree.
+
+    """
+    if inventory is None:
+        inventory = TreeInventory(root)
+    start = inventory.relpath(root)
+    prefix_len = len(start) + 1 if start else 0
+    members = []
+    for relpath, (size, mode, mtime) in inventory.walk(start):
+        name = relpath[prefix_len:]
+        if stat.S_ISDIR(mode):
+            name += "/"
+        path = inventory.abspath(relpath)
+        members.append(_Member(name, path, size, mode, mtime))
+    members.sort(key=lambda m: m.name.split("/"))
+    return members
+
+
+def _open_previous(path):
+    """Open a previous zipfile for reuse, or return None."""
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        return _PreviousZip(path)
+    except (OSError, zipfile.BadZipFile):
+        logger.warning(
+            "Cannot read “%s”: not reusing anything from it.",
+            path,
+        )
+        return None
+
+
+def _write_members(fp, members, level, policy, max_workers, previous,
+                   stats):
+    """Compress and write members, then the central directory."""
+    max_pending = max_workers * 4
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        writer = _ZipFileWriter(fp)
+        pending = []
+        members_iter = iter(members)
+        while True:
+            # Keep a bounded number of members in flight, and write
+            # them out in the order they were listed.
+            for member in members_iter:
+                future = pool.submit(
+                    _compress_member, member, level, previous, policy,
+                )
+                pending.append(future)
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            member = pending.pop(0).result()
+            if isinstance(member.data, _ReusedData):
+                stats.reused += 1
+            writer.write_member(member)
+            if member.is_dir:
+                stats.dirs += 1
+            else:
+                stats.files += 1
+                if member.method == zipfile.ZIP_STORED:
+                    stats.stored += 1
+                stats.bytes_in += member.size
+        writer.write_central_directory()
+        stats.bytes_out = fp.tell()
+
+
+def write_zip_tree(zip_path, root, level=9, max_workers=None,
+                   previous=None, policy=None, inventory=None):
+    """Write a folder tree's contents to a new zipfile.
+
+    :param str zip_path: The zipfile to write. Any existing file is
+        replaced only once the new zipfile is complete.
+    :param str root: The tree to write. Member names are relative
+        to this folder.
+    :param int level: Deflate compression level, 0 to 9, for members
+        which the policy doesn't cover.
+    :param int max_workers: Number of compression threads.
+    :param str previous: An older zipfile to reuse unchanged members'
+        compressed data from. It may be the same file as zip_path.
+    :param CompressionPolicy policy: Per-member compression levels.
+    :param .inventory.TreeInventory inventory: Index of the tree.
+    :returns: Statistics about what was written.
+    :rtype: ZipStats
+
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    t0 = time.perf_counter()
+    stats = ZipStats()
+    members = _list_members(root, inventory)
+    tmp_path = zip_path + ".tmp"
+    prev_zip = _open_previous(previous)
+    try:
+        with open(tmp_path, "wb") as fp:
+            _write_members(
+                fp, members, level, policy,
+                max_workers, prev_zip, stats,
+            )
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    finally:
+        if prev_zip is not None:
+            prev_zip.close()
+    os.replace(tmp_path, zip_path)
+    stats.seconds = time.perf_counter() - t0
+    return stats